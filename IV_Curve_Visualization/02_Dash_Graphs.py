@@ -22,32 +22,33 @@ Author: John Stayner
 
 # Imports
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
-from datetime import datetime
-
-import plotly.express as px
-from plotly.subplots import make_subplots
-import plotly.graph_objects as go
 
 import dash
-import dash_core_components as dcc
-import dash_html_components as html
-from dash.dependencies import Input, Output, State
+from dash import dcc, html
+from dash.dependencies import ClientsideFunction, Input, Output, State
+
+from hover_engine import HoverDetails, hover_value
+from iv_extract import extract_iv_params
+from iv_render import fill_figure, iv_axis_layout, iv_curve_figure_template, iv_curve_trace_data, patch_figure, \
+    power_figure_template, power_trace_data
+from iv_store import CurveIndex, load_iv_curves
 
 #### Data Entry/Variables
 
 # Load IV Curves
 path_iv = 'data/sundae_day_5_iv_curves.xlsx'
-iv_curves = pd.read_excel(path_iv)
+iv_store = load_iv_curves(path_iv)  # Cached as columns after the first load (see iv_store.py)
+curve_index = CurveIndex(iv_store)  # (mppt_id, curve_num) -> rows of that curve, for fast lookups on hover
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
-# Get Isc, Voc, and Pmax from each IV Curve (Last thing we need to do before making this work)
-iv_params = iv_curves \
-    .groupby(['mppt_id', 'curve_num']) \
-    .aggregate({'time': np.min, 'current': np.max, 'voltage': np.max, 'power': np.max}) \
-    .reset_index()
+# Get Isc, Voc, and Pmax from each IV Curve (fitted, see iv_extract.py)
+iv_params = extract_iv_params(curve_index).rename(columns={'isc': 'current', 'voc': 'voltage', 'pmp': 'power'})
+
+# Figure templates, filled in/patched by the callbacks (see iv_render.py)
+power_template = power_figure_template('time', 'current', x_title='Time (Australian)', y_title='Power (W)')
+iv_curve_template = iv_curve_figure_template()
 
 # Plot IV Curves
 
@@ -58,7 +59,7 @@ app.layout = html.Div([
     html.Div(
         [html.Div(['MPPT ID: ', dcc.Dropdown(
             id='mppt-dropdown',
-            options=[{'label': i, 'value': i} for i in iv_curves['mppt_id'].unique()],
+            options=[{'label': i, 'value': i} for i in np.unique(curve_index.key_columns['mppt_id'])],
             value='A0'
             )]),
         html.Div(['Maximum Voltage (V) for IV Graph: ', dcc.Input(id='vmax-input', type='text', value='40')]),
@@ -79,44 +80,47 @@ app.layout = html.Div([
 def update_power_graph(mppt_num):
 
     df = iv_params[iv_params['mppt_id'] == mppt_num]
-    fig = px.scatter(df, x='time', y='current', hover_name='curve_num')
+    trace = power_trace_data(df, 'time', 'current', 'curve_num')
 
-    fig.update_layout(title_text='MPPT {} Power (W) Day 5'.format(mppt_num))
-    fig.update_xaxes(title_text='Time (Australian)')
-    fig.update_yaxes(title_text='Power (W)')
+    return fill_figure(power_template, trace, title='MPPT {} Power (W) Day 5'.format(mppt_num))
 
-    return fig
 
+# One input this time: the hoverData on power-time (which point is being hovered on). The max voltage/current in the
+# IV Curve graph and the mppt selection dropdown are State. Using State instead of Input means this won't be
+# automatically called when those change. (The axis limits are changed in the browser instead, see below.)
+# The hover callback itself comes from HoverDetails (see hover_engine.py): it turns the hover into the curve's key,
+# builds that curve's trace data and hands it to render_iv_curve.
+def hovered_curve(hoverData, vmax, imax, mppt_num):
+    # print(hoverData)  # Uncomment to see the format of hoverData
+    return mppt_num, hover_value(hoverData, 'hovertext', 1)  # hovertext is the Curve #
 
-# Four inputs this time: One for the hoverData on power-time (which point is being hovered on), two to set the max
-# voltage/current in the IV Curve graph, and then another one for the state of the mppt selection dropdown.
-# Using State instead of Input for the mppt-dropdown means this won't be automatically changed when that dropdown
-# is changed.
-
-# If you want the IV Curves to auto-size, take out the "range" parameter in fig.update_xaxes and fig.update_yaxes
-@app.callback(
-    Output('iv-curve', 'figure'),
-    Input('power-time', 'hoverData'),
-    Input('vmax-input', 'value'),
-    Input('imax-input', 'value'),
-    State('mppt-dropdown', 'value')
-)
-def update_iv_curve_graph(hoverData, vmax, imax, mppt_num):
 
-    # print(hoverData)  # Uncomment to see the format of hoverData
-    try:
-        curve_num = hoverData['points'][0]['hovertext']  # How we can slice into hover data
-    except TypeError:
-        curve_num = 1
-    df = iv_curves[(iv_curves['mppt_id'] == mppt_num) & (iv_curves['curve_num'] == curve_num)]
+# If you want the IV Curves to auto-size, pass autosize=True to iv_axis_layout
+def render_iv_curve(trace, initial, vmax, imax, mppt_num):
+    # Hovering only needs to swap the data. The initial call needs the whole figure.
+    if not initial:
+        return patch_figure(trace_data=trace)
+    return fill_figure(iv_curve_template, trace, axes=iv_axis_layout(vmax, imax, autosize=False))
 
-    fig = px.scatter(df, x='voltage', y='current', hover_name='curve_num', title='IV Curve')
 
-    fig.update_xaxes(title_text='Voltage (V)', range=[0, vmax])
-    fig.update_yaxes(title_text='Current (A)', range=[0, imax])
+iv_curve_hover = HoverDetails(app, 'power-time', key=hovered_curve,
+                              states=[State('vmax-input', 'value'), State('imax-input', 'value'),
+                                      State('mppt-dropdown', 'value')])
+iv_curve_hover.add(Output('iv-curve', 'figure'), lambda key: iv_curve_trace_data(curve_index.get(*key)),
+                   render=render_iv_curve)
+update_iv_curve_graph = iv_curve_hover.register('update_iv_curve_graph')
 
 
-    return fig
+# New axis limits only need the ranges changed on the figure that's already showing, so that happens in the browser
+# (set_iv_axes_fixed in assets/iv_clientside.js) without a trip to the server.
+app.clientside_callback(
+    ClientsideFunction(namespace='iv', function_name='set_iv_axes_fixed'),
+    Output('iv-curve', 'figure', allow_duplicate=True),
+    Input('vmax-input', 'value'),
+    Input('imax-input', 'value'),
+    State('iv-curve', 'figure'),
+    prevent_initial_call=True
+)
 
 if __name__ == '__main__':
     app.run_server(debug=False)
\ No newline at end of file
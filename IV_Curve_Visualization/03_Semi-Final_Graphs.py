@@ -13,7 +13,9 @@ few useful tools to visualize the data.
 How to use this: select which MPPT you want to use with the dropdown, then hover over any of the datapoints in the
 power-time graph on the left to pull up that datapoints IV curve on the right. The hoverdata has customizable data that
 should summarize the important characteristics of the IV curve. The full one-row entry for that IV curve is displayed
-in the table at the bottom.
+in the table at the bottom. Lasso/box select an area of the power graph to overlay all of its IV curves below it. The
+'All IV Curves' table sorts and filters every curve's params, and abnormal curves get circled in red (with the reason
+in the Anomaly column). The data loads in the background, so the page comes up straight away.
 
 This is accomplished through Dash, a Python library that allows you to set up Plotly to easily make data dashboards.
 The layout contains Python code that outputs HTML code referencing a stylesheet in the 'assets' folder. The callbacks
@@ -44,33 +46,93 @@ Author: John Stayner
 """
 
 # Imports
+import functools
+import os
+import threading
+from urllib.parse import quote
+import flask
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
-from datetime import datetime
-
-import plotly.express as px
-from plotly.subplots import make_subplots
-import plotly.graph_objects as go
 
 import dash
-import dash_table
 import dash_daq
-import dash_core_components as dcc
-import dash_html_components as html
-from dash.dependencies import Input, Output, State
+from dash import dash_table, dcc, html
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from dash.exceptions import PreventUpdate
+
+from callback_metrics import CallbackMetrics
+from downsample import changes_x_range, downsample_window, relayout_x_range, selection_mask
+from fig_cache import FigureCache
+from hover_engine import HoverDetails, PointTable, Prefetcher, hover_value
+from iv_anomaly import AnomalyScan
+from iv_env import EnvironmentLogs, cell_temperature, stc_normalize
+from iv_extract import extract_iv_params
+from iv_render import fill_figure, heatmap_figure_template, iv_axis_layout, iv_curve_figure_template, \
+    iv_curve_trace_data, iv_overlay_figure_template, overlay_colorbar_data, overlay_trace_data, patch_figure, \
+    power_figure_template, power_trace_data, flagged_trace_data
+from iv_raster import curve_sheet, overlay_image
+from iv_store import CurveIndex, load_iv_workbooks
+from iv_stream import LiveIngest
+from param_query import ParamQuery
+from rollup import ROLLUP_STATS, RollupPyramid
 
 ############# Data Entry/Variables ##################################
 
-# Load IV Curves
+# IV Curves to load. Only the first run parses the workbook, later ones load its cache. A folder or glob loads a whole
+# race, one day per workbook ('day_N' in the file name).
 path_iv = 'data/sundae_day_5_iv_curves_short.xlsx'  # For development (faster loading)
 # path_iv = 'data/sundae_day_5_iv_curves.xlsx'
-iv_curves = pd.read_excel(path_iv)
+# path_iv = 'data/sundae_day_*_iv_curves.xlsx'  # Every day of the race
+path_iv = os.environ.get('IV_WORKBOOKS', path_iv)  # Lets serve.py/benchmark.py point the dashboard at other data
+
+# Live data. Set path_live to a file that a logger appends IV rows to (NDJSON or CSV, same columns as the workbook) to
+# have new curves show up on the power graph as they finish. They get their own 'Live' entry in the day dropdown.
+# None turns live updates off. (See iv_stream.py)
+path_live = None  # e.g. 'data/live_iv_curves.ndjson'
+live_poll_interval = 2  # Seconds between checks for new data
+
+# Environment logs (weather station, car telemetry) to join onto the IV curves by time (see iv_env.py). Each one is
+# {'path': ..., 'tolerance': ...}, where tolerance is how far a log row can be from the start of a curve and still
+# count. Columns they don't have (or curves with no log row close enough) are left blank.
+env_logs = []
+# env_logs = [{'path': 'data/weather_day_5.csv', 'tolerance': '5min'},
+#             {'path': 'data/telemetry_day_5.csv', 'tolerance': '10s'}]
+
+# Curves with no logged irradiance get a rough estimate from Isc instead (Isc * 1000/6.9, 6.9 A being about Isc at
+# 1000 W/m^2), so that coloring the overlay by irradiance still works. The STC columns only ever use logged values.
+estimate_irradiance_from_isc = True
 
 # Graph params
 # Parameters besides power/time that you want in hover text. Must match the names you give the columns in iv_params
 power_hover_data = ['Curve #', 'Isc (A)', 'Voc (V)', 'Temperature (C)', 'Irradiance (W/m^2)']
 
+# Max number of points to draw on the power graph at once. Roughly the graph's width in pixels; any more than that
+# can't be seen anyway. When zoomed in, the visible window gets re-downsampled to this many points.
+power_graph_max_points = 1000
+power_graph_downsample = 'lttb'  # 'lttb' keeps the overall shape, 'minmax' keeps every spike
+
+# Trace data for hovered IV curves is kept in an LRU cache, capped at this many curves / this much JSON
+iv_trace_cache_entries = 512
+iv_trace_cache_bytes = 64 * 2**20
+
+# After each hover, the IV curves (and table rows) of this many curves either side of the hovered one (in time, on the
+# same MPPT) get built in the background on prefetch_workers threads, so scrubbing along the power graph mostly hits
+# the cache. 0 turns it off. (See Prefetcher in hover_engine.py)
+prefetch_neighbors = 3
+prefetch_workers = 2
+
+# Overlay graph: lasso/box select points on the power graph to draw all of their IV curves on top of each other.
+# Selections of more curves than this get drawn as one (unhoverable) image, or thinned out evenly in time to this many
+# with overlay_as_image = False.
+overlay_max_curves = 500
+overlay_as_image = True
+overlay_image_size = (500, 1000)  # (height, width) in pixels
+
+# All-MPPT heatmap: one row per MPPT, one column per time bucket. Values you can pick from (names as in iv_params), and
+# the most buckets to draw across the graph; zooming in switches to narrower buckets. (See rollup.py)
+heatmap_values = ['Power (W)', 'Isc (A)', 'Voc (V)']
+heatmap_max_buckets = 400
+
 # IV Graph Default V/I max
 v_max = 40  # Volts
 i_max = 7  # Amps
@@ -79,55 +141,320 @@ external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
 default_table_col_width = 10  # % Width of the screen for a default column.
 table_float_precision = 2  # Digits after decimal that you want to display
+param_browser_page_size = 25  # Rows per page of the 'All IV Curves' table
+
+# Callback timings are always recorded and served at /metrics (Prometheus format). This also shows them in a table at
+# the bottom of the dashboard. (See callback_metrics.py)
+show_callback_metrics = False
+
+
+# Weather/telemetry log columns and their names in iv_params. These always get a column (even if blank); any other
+# log columns come along under their own names.
+env_names = {
+    'irradiance': 'Irradiance (W/m^2)',
+    'temperature': 'Temperature (C)',
+    'cell_temperature': 'Cell Temperature (C)',
+    'speed': 'Speed (km/h)',
+    'sun_angle': 'Angle to Sun (Degrees)',
+    'cloud_cover': 'Cloud Cover'
+}
+
+
+# Round the number columns of a table for display. DataFrame.round warns about (and skips) time columns.
+def round_numeric(df, decimals=table_float_precision):
+    return df.round({name: decimals for name in df.select_dtypes('number').columns})
+
+
+# Fit params for every IV Curve at once, join the environment logs, normalize to STC and give the columns display
+# names. A function so that live curves (below) get the exact same treatment.
+# Note that this is where we set the names that are used in power_hover_data
+def format_iv_params(raw_params):
+    params = raw_params \
+        .drop(columns=['n_points']) \
+        .rename(columns={
+            'day': 'Day',
+            'mppt_id': 'MPPT ID',
+            'curve_num': 'Curve #',
+            'time': 'Time (Australian)',
+            'isc': 'Isc (A)',
+            'voc': 'Voc (V)',
+            'pmp': 'Power (W)',
+            'vmp': 'Vmp (V)',
+            'imp': 'Imp (A)',
+            'ff': 'Fill Factor',
+            'rs': 'Rs (Ohm)',
+            'rsh': 'Rsh (Ohm)'
+        })
+    params = round_numeric(params)  # Round all numeric values to the desired precision
+
+    # Conditions each curve was measured in, from the nearest log rows in time, all curves at once
+    conditions = env.join(raw_params['time'].to_numpy())
+    conditions = conditions.reindex(columns=list(dict.fromkeys(list(env_names) + list(conditions.columns))))
+    conditions.index = params.index
+
+    # Pmax/Isc/Voc at 1000 W/m^2 and 25 C. Use the logged cell temperature if there is one, else estimate it.
+    irradiance = conditions['irradiance'].to_numpy(dtype=np.float64)
+    cell_temp = conditions['cell_temperature'].fillna(
+        pd.Series(cell_temperature(conditions['temperature'], irradiance), index=conditions.index))
+    stc = stc_normalize(raw_params['pmp'], raw_params['isc'], raw_params['voc'], irradiance, cell_temp)
+    params['Power STC (W)'] = stc['pmp_stc']
+    params['Isc STC (A)'] = stc['isc_stc']
+    params['Voc STC (V)'] = stc['voc_stc']
+
+    if estimate_irradiance_from_isc:
+        conditions['irradiance'] = conditions['irradiance'].fillna(params['Isc (A)'] * (1000/6.9))
+    params = params.join(conditions.rename(columns=env_names))
+    # params['unnecessarily long parameter name to check if overflow works'] = True  # If you want to see it work
+    return round_numeric(params)
+
+
+# Abnormal curves get looked for in the background (see iv_anomaly.py). The results get display names the same way and
+# join onto iv_params when they're ready (use_anomalies, below).
+anomaly_names = {
+    'n_steps': 'Bypass Steps',
+    'ff_drop': 'FF Drop',
+    'time_z': 'Power Z (vs Time)',
+    'peer_z': 'Power Z (vs MPPTs)',
+    'isc_ratio': 'Isc vs MPPTs',
+    'anomaly': 'Anomaly'
+}
+
+# Live curves all go under this day
+live_day = 'Live'
+
+
+def format_live_params(raw_params):
+    """format_iv_params for live curves, with the day column (first, same as the workbook's) set to live_day."""
+    return format_iv_params(raw_params.assign(day=live_day)[['day'] + list(raw_params.columns)])
+
+
+# Caches for the graphs: IV curve trace data keyed on (day, MPPT, curve #), and the full view of each power graph
+iv_trace_cache = FigureCache(max_entries=iv_trace_cache_entries, max_bytes=iv_trace_cache_bytes)
+params_row_cache = FigureCache(max_entries=iv_trace_cache_entries, max_bytes=None)  # One small row each
+power_figure_cache = FigureCache(max_entries=64)
+
+# Figure templates (empty WebGL traces plus all the styling). Callbacks fill in or patch the data. (See iv_render.py)
+power_template = power_figure_template('Time (Australian)', 'Power (W)', power_hover_data, flagged=True)
+iv_curve_template = iv_curve_figure_template()
+iv_overlay_template = iv_overlay_figure_template()
+heatmap_template = heatmap_figure_template()
+
+
+# Everything from here down to the layout depends on the data, which loads in a background thread (load_data) so the
+# server answers straight away. Until it's done these are all None and the callbacks hold off (require_data).
+iv_store = curve_index = env = raw_params = iv_params = None
+anomaly_scan = anomaly_params = live_ingest = None
+params_index = params_query = params_by_mppt = rollups = None
+days = []
+data_loaded = threading.Event()  # Set once everything above is filled in
+data_error = None  # What went wrong, if loading failed
+
+
+def load_data():
+    """Load and index the IV data and fit iv_params, filling in the globals above. Runs in the data_loader thread."""
+    global iv_store, curve_index, env, raw_params, iv_params, anomaly_scan, live_ingest, params_index, params_query, \
+        params_by_mppt, rollups, days
+
+    # Plain column arrays (memory-mapped for a single workbook), not a dataframe
+    iv_store = load_iv_workbooks(path_iv)
+
+    # Index the IV curves by (day, MPPT, curve #) once up front, so the hover callbacks below can pull out one curve
+    # with a dict lookup instead of scanning every row. (See CurveIndex in iv_store.py)
+    curve_index = CurveIndex(iv_store, keys=('day', 'mppt_id', 'curve_num'))
+
+    env = EnvironmentLogs.load(env_logs)  # Parsed once, and cached next to each log like the workbooks
+
+    raw_params = extract_iv_params(curve_index)
+    iv_params = format_iv_params(raw_params)
+
+    # Start tailing the live file in a background thread. New curves get fitted as they finish.
+    live_ingest = LiveIngest(path_live, poll_interval=live_poll_interval).start() if path_live else None
+
+    # Calculations based on inputs
+
+    # iv_params rows hashed by (day, MPPT, curve #), for the table callback (see PointTable in hover_engine.py)
+    params_index = PointTable(iv_params, keys=('Day', 'MPPT ID', 'Curve #'))
+
+    # Every column of iv_params presorted once, so the 'All IV Curves' table can page/sort/filter on the server and
+    # only send the rows on screen (see param_query.py). Only the workbook days; live curves are still coming in.
+    params_query = ParamQuery(iv_params)
+
+    # Power vs time series for each day and MPPT, sorted by time so the zoom window can be found with a binary search
+    params_by_mppt = {key: df.sort_values('Time (Australian)') for key, df in iv_params.groupby(['Day', 'MPPT ID'])}
 
+    # Time-bucketed mean/min/max of the heatmap values for every MPPT, per day, so the heatmap never regroups iv_params
+    rollups = {day: RollupPyramid(df, 'Time (Australian)', 'MPPT ID', heatmap_values)
+               for day, df in iv_params.groupby('Day')}
 
-# Get Isc, Voc, and Pmax from each IV Curve (Last thing we need to do before making this work)
-# Note that this is hwhere we set the names that are used in power_hover_data
-iv_params = iv_curves \
-    .groupby(['mppt_id', 'curve_num']) \
-    .aggregate({'time': np.min, 'current': np.max, 'voltage': np.max, 'power': np.max}) \
-    .reset_index() \
-    .rename(columns={
-        'current': 'Isc (A)',
-        'voltage': 'Voc (V)',
-        'power': 'Power (W)',
-        'time': 'Time (Australian)',
-        'mppt_id': 'MPPT ID',
-        'curve_num': 'Curve #'
-    }) \
-    .round(table_float_precision)  # Round all numeric values to the desired precision
+    # Days for the day dropdown (plus the live data, if it's on)
+    days = np.unique(curve_index.key_columns['day']).tolist()
+    if live_ingest is not None:
+        days.append(live_day)
 
-# To show another possible usecase, I'm adding environmental data for the IV curve to show how it can be used
-iv_params['Irradiance (W/m^2)'] = iv_params['Isc (A)'] * (1000/6.9)  # Rough approximation of irradiance
-iv_params['Cloud Cover'] = False
-iv_params['Temperature (C)'] = 55  # For simplicity
-iv_params['Speed (km/h)'] = 59  # I think this was close to our average speed (RIP)
-iv_params['Angle to Sun (Degrees)'] = 30  # Again, for simplicity.
-# iv_params['unnecessarily long parameter name to check if overflow works'] = True  # If you want to see it work
-iv_params = iv_params.round(table_float_precision)  # Only needed since I'm setting things artificially here
+    # The anomaly scan has a thread of its own, so the dashboard doesn't wait on it either
+    anomaly_scan = AnomalyScan(curve_index, raw_params).start()
+    anomaly_scan.add_done_callback(use_anomalies)
 
-# Calculations based on inputs
 
-# Table columns and width
-table_cols = iv_params.columns.values
+def run_load_data():
+    """Body of the data_loader thread: load_data, then mark the data as ready (or record why it isn't)."""
+    global data_error
+    try:
+        load_data()
+    except Exception as error:
+        data_error = '{}: {}'.format(type(error).__name__, error)
+        raise  # Still want the traceback in the log
+    data_loaded.set()
+
+
+def wait_until_loaded(timeout=None, anomalies=True):
+    """
+    Block until the data is loaded (and, with anomalies=True, the anomaly scan is done too). Returns whether it loaded.
+    serve.py calls this before forking workers, so they start with everything already in memory.
+    """
+    data_loader.join(timeout)
+    if data_loaded.is_set() and anomalies:
+        anomaly_scan.wait(timeout)
+    return data_loaded.is_set()
+
+
+def prepare_fork():
+    """
+    serve.py calls this in the gunicorn master before it forks a worker. Threads don't survive a fork, so the live
+    tailer's thread is stopped here rather than copied into the worker halfway through a poll.
+    """
+    if live_ingest is not None:
+        live_ingest.stop()
+
+
+def after_fork():
+    """serve.py calls this in each worker right after the fork: start tailing the live file again, in this process."""
+    if live_ingest is not None:
+        live_ingest.start()
+
+
+def require_data():
+    """For the top of callbacks that read the data: skip the update while it's still loading."""
+    if not data_loaded.is_set():
+        raise PreventUpdate
+
+
+def use_anomalies(anomalies):
+    """
+    Called from the scan's thread when it finishes: join the anomaly columns onto the params the tables read from.
+    Everything gets swapped in whole, so a callback running at the same time sees either the old or the new version.
+    """
+    global anomaly_params, params_index, params_query
+    formatted = round_numeric(anomalies.rename(columns=anomaly_names))
+    flagged_params = iv_params.join(formatted)
+    params_index = PointTable(flagged_params, keys=('Day', 'MPPT ID', 'Curve #'))
+    params_query = ParamQuery(flagged_params)
+    anomaly_params = formatted
+
+
+def power_series(day, mppt_num):
+    """
+    Params for one MPPT on one day in time order. For the live day, also returns the live-cursor for it (None for the
+    other days): the start time of the last live curve included, which is where extend_power_graph picks up from.
+    """
+    if day != live_day or live_ingest is None:
+        return params_by_mppt.get((day, mppt_num), iv_params.iloc[:0]), None
+    live_rows, since = live_ingest.params_since(mppt_num)
+    return format_live_params(live_rows) if len(live_rows) else iv_params.iloc[:0], {'mppt': mppt_num, 'since': since}
+
+
+def flagged_rows(day, series, x_range=None, max_points=None):
+    """
+    Rows of series (params in time order, e.g. from power_series) in the visible x_range that the anomaly scan flagged,
+    with an 'Anomaly' column saying why. Empty until the scan is done, and for the live day (which it doesn't cover).
+    """
+    anomalies = anomaly_params
+    if anomalies is None or day == live_day or not len(series):
+        return series.iloc[:0].assign(Anomaly='')
+    labels = anomalies['Anomaly'].reindex(series.index)  # series keeps iv_params' index, so this lines them up
+    keep = (labels != '').to_numpy()
+    if x_range is not None:
+        times = series['Time (Australian)']
+        keep = keep & ((times >= pd.Timestamp(x_range[0])) & (times <= pd.Timestamp(x_range[1]))).to_numpy()
+    rows = series[keep].assign(Anomaly=labels[keep])
+    return rows if max_points is None else rows.iloc[:max_points]
+
+
+def get_curve(day, mppt_num, curve_num):
+    """Points of one IV curve, from the workbooks or the live data."""
+    if day == live_day and live_ingest is not None:
+        return live_ingest.get_curve(mppt_num, curve_num)
+    return curve_index.get(day, mppt_num, curve_num)
+
+
+def get_curves(day, mppt_num, curve_nums):
+    """Voltage/current of many IV curves at once, concatenated, and how many points each has (like take_curves)."""
+    if day == live_day and live_ingest is not None:
+        curves = [live_ingest.get_curve(mppt_num, curve_num) for curve_num in curve_nums]
+        lengths = np.array([len(curve['voltage']) for curve in curves], dtype=np.int64)
+        return {name: np.concatenate([curve[name] for curve in curves] or [np.zeros(0)])
+                for name in ('voltage', 'current')}, lengths
+    return curve_index.take_curves([(day, mppt_num, curve_num) for curve_num in curve_nums])
+
+
+def get_rollup(day):
+    """The RollupPyramid of one day. The live one keeps changing, so it's rebuilt from the live params each time."""
+    if day == live_day and live_ingest is not None:
+        live_rows = live_ingest.all_params()
+        return RollupPyramid(format_live_params(live_rows) if len(live_rows) else iv_params.iloc[:0],
+                             'Time (Australian)', 'MPPT ID', heatmap_values)
+    return rollups.get(day) or RollupPyramid(iv_params.iloc[:0], 'Time (Australian)', 'MPPT ID', heatmap_values)
+
+
+def get_params_row(day, mppt_num, curve_num):
+    """The iv_params row of one IV curve, from the workbooks or the live data."""
+    if day == live_day and live_ingest is not None:
+        live_rows = live_ingest.params_for(mppt_num)
+        if len(live_rows):
+            return format_live_params(live_rows[live_rows['curve_num'] == int(float(curve_num))])
+        return iv_params.iloc[:0]
+    return params_index.frame([(day, mppt_num, curve_num)])
+
+
+def table_columns():
+    """Table columns (including the anomaly ones, which stay blank until the scan is done) and the width they need."""
+    table_cols = list(iv_params.columns) + list(anomaly_names.values())
+    table_width = '{:.0f}%'.format(np.min([len(table_cols) * default_table_col_width, 100]))
+    return [{'name': i, 'id': i} for i in table_cols], table_width
+
+
+def day_label(day):
+    return 'Day {}'.format(day) if isinstance(day, int) else day
 
-table_width = '{:.0f}%'.format(np.min([len(table_cols) * default_table_col_width, 100]))
+
+# Start loading. Everything load_data uses is defined by now.
+data_loader = threading.Thread(target=run_load_data, name='iv-data-loader', daemon=True)
+data_loader.start()
 
 
 ################# Dash Layout  ###############################
 
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)  # Make the main app
+callback_metrics = CallbackMetrics().instrument(app)  # Times every callback below
 
 app.layout = html.Div([
     html.H1('IV Curve Visualizer'),
+
+    # Shows while the data is still loading. load-interval checks on it until it's done (see finish_loading).
+    html.Div('Loading IV data...', id='load-status'),
+    dcc.Interval(id='load-interval', interval=500),
     html.Hr(),
 
-    # MPPT Dropdown
+    # Day and MPPT Dropdowns. Their options get filled in once the data is loaded.
     html.Div(
-        [html.Div(['MPPT ID: ', dcc.Dropdown(
+        [html.Div(['Day: ', dcc.Dropdown(
+            id='day-dropdown',
+            options=[],
+            clearable=False
+            )]),
+        html.Div(['MPPT ID: ', dcc.Dropdown(
             id='mppt-dropdown',
-            options=[{'label': i, 'value': i} for i in iv_curves['mppt_id'].unique()],
-            value='A0'
+            options=[]
             )]),
         html.Div(['Maximum Voltage (V) for IV Graph: ', dcc.Input(id='vmax-input', type='text', value=str(v_max))]),
         html.Div(['Maximum Current (A) for IV Graph: ', dcc.Input(id='imax-input', type='text', value=str(i_max))]),
@@ -153,12 +480,43 @@ app.layout = html.Div([
         html.Div([dcc.Graph(id='iv-curve')], style={'width': '45%', 'display': 'inline-block'}, className='column')
     ], className='row'),
 
-    # Data Table
+    # IV Curve Overlay. All the curves selected on the power graph (Lasso Select / Box Select in its toolbar).
+    html.Div([
+        html.Div(['Color Overlay By: ', dcc.RadioItems(
+            id='overlay-color',
+            options=[{'label': 'Time of Day', 'value': 'time'}, {'label': 'Irradiance', 'value': 'irradiance'}],
+            value='time',
+            inline=True
+            )]),
+        dcc.Graph(id='iv-overlay'),
+        html.A('Thumbnails of every IV curve of this MPPT (PNG)', id='thumbnail-link', target='_blank')
+    ], style={'width': '90%'}),
+
+    # Every MPPT at once
+    html.H3('All MPPTs'),
+    html.Div([
+        html.Div(['Value: ', dcc.RadioItems(
+            id='heatmap-value', options=[{'label': v, 'value': v} for v in heatmap_values], value=heatmap_values[0],
+            inline=True)]),
+        html.Div(['Statistic per Time Bucket: ', dcc.RadioItems(
+            id='heatmap-stat', options=[{'label': s.title(), 'value': s} for s in ROLLUP_STATS], value='mean',
+            inline=True)]),
+        dcc.Graph(id='mppt-heatmap')
+    ], style={'width': '90%'}),
+
+    # Live updates: checks for newly finished curves every live_poll_interval seconds (only if path_live is set, and
+    # only once the data is loaded: finish_loading turns it on). live-cursor remembers which MPPT the power graph is
+    # showing and the time of the last of its live curves it already has. Being in the browser, that works however
+    # many server processes the ticks get spread over.
+    dcc.Interval(id='live-interval', interval=live_poll_interval * 1000, disabled=True),
+    dcc.Store(id='live-cursor'),
+
+    # Data Table. Like the dropdowns, its columns come from the data.
     html.H3('IV Curve Params'),
     html.Div([
         dash_table.DataTable(
             id='iv-param-data',
-            columns=[{'name': i, 'id': i} for i in iv_params.columns.values],
+            columns=[],
             style_cell={  # This styles all cells (it's superseded by style_header for the header cells)
                 'width': '180px',  # Cell width
                 'fontSize': 14,  # Font size
@@ -168,83 +526,413 @@ app.layout = html.Div([
             style_table={'overflowX': 'auto'},  # Allows table itself to overflow off the side of the page if necessary
             style_header={'fontWeight': 'bold', 'fontSize': 18}  # Font stuff for header
         )
-    ], style={'width': table_width})  # Set table width given input characteristics
-
-])
+    ], id='iv-param-data-box'),  # Width gets set given input characteristics
 
+    # Every curve's params. Paging, sorting and filtering all happen in update_param_browser, not in the browser.
+    html.H3('All IV Curves'),
+    html.Div([
+        dash_table.DataTable(
+            id='iv-param-browser',
+            columns=[],
+            page_current=0,
+            page_size=param_browser_page_size,
+            page_action='custom',
+            sort_action='custom',
+            sort_mode='multi',
+            sort_by=[],
+            filter_action='custom',
+            filter_query='',
+            style_cell={'width': '180px', 'fontSize': 14, 'height': 'auto', 'font-family': 'helvetica',
+                        'whitespace': 'normal'},  # Same as the table above
+            style_table={'overflowX': 'auto'},
+            style_header={'fontWeight': 'bold', 'fontSize': 18}
+        )
+    ], id='iv-param-browser-box')
 
+])
 
-##################### App Callbacks ########################################
+if show_callback_metrics:
+    app.layout.children.append(callback_metrics.debug_panel(app))
 
-# Define the callback. Every time the 'value' child of 'mppt-dropdown' changes, it will call this function with
-# the new value of mppt-dropdown as the sole input.
-@app.callback(Output('power-time', 'figure'), Input('mppt-dropdown', 'value'))
-def update_power_graph(mppt_num):
 
-    df = iv_params[iv_params['MPPT ID'] == mppt_num]
-    fig = px.scatter(df, x='Time (Australian)', y='Power (W)', hover_name='Curve #', hover_data=power_hover_data)
 
-    fig.update_layout(title_text='MPPT {} Power (W) Day 5'.format(mppt_num))
-    fig.update_xaxes(title_text='Time (Australian)')
-    fig.update_yaxes(title_text='Power (W)')
+##################### App Callbacks ########################################
 
-    return fig
+def triggered_ids():
+    """Which inputs ('component-id.property') set off the current callback. Empty on the initial call."""
+    return {t['prop_id'] for t in dash.callback_context.triggered if t['prop_id'] != '.'}
 
 
-# Four inputs this time: One for the hoverData on power-time (which point is being hovered on), two to set the max
-# voltage/current in the IV Curve graph, and then another one for the state of the mppt selection dropdown.
-# Using State instead of Input for the mppt-dropdown means this won't be automatically changed when that dropdown
-# is changed.
+# Fills in everything in the layout that comes from the data (dropdown options, table columns) once load_data is done,
+# which sets off the graphs and tables. After that it keeps checking on the anomaly scan, to report if it failed.
 @app.callback(
-    Output('iv-curve', 'figure'),
-    Input('power-time', 'hoverData'),
-    Input('vmax-input', 'value'),
-    Input('imax-input', 'value'),
-    Input('autosize-iv-graph', 'on'),
-    State('mppt-dropdown', 'value')
+    Output('day-dropdown', 'options'),
+    Output('day-dropdown', 'value'),
+    Output('mppt-dropdown', 'options'),
+    Output('mppt-dropdown', 'value'),
+    Output('iv-param-data', 'columns'),
+    Output('iv-param-data-box', 'style'),
+    Output('iv-param-browser', 'columns'),
+    Output('iv-param-browser-box', 'style'),
+    Output('iv-param-browser', 'page_current'),
+    Output('load-status', 'children'),
+    Output('load-interval', 'disabled'),
+    Output('live-interval', 'disabled'),
+    Input('load-interval', 'n_intervals'),
+    State('day-dropdown', 'options')
 )
-def update_iv_curve_graph(hoverData, vmax, imax, autosize, mppt_num):
-
-    # print(hoverData)  # Uncomment to see the format of hoverData.
-    try:
-        # This gets you the 'hover_name' of the datapoint, which is set to Curve #. Not sure why it's called hovertext
-        curve_num = hoverData['points'][0]['hovertext']
-    except TypeError:
-        curve_num = 1
+def finish_loading(n_intervals, day_options):
+
+    if data_error is not None:
+        return (dash.no_update,) * 9 + ('Loading the IV data failed ({})'.format(data_error), True, True)
+    if not data_loaded.is_set():
+        raise PreventUpdate
+
+    scan_done = anomaly_scan.done()
+    if not scan_done:
+        status = 'Looking for abnormal IV curves...'
+    elif anomaly_scan.error is not None:
+        status = 'The anomaly scan failed ({}: {}), so no curves are flagged. See the server log.'.format(
+            type(anomaly_scan.error).__name__, anomaly_scan.error)
+    else:
+        status = ''
+
+    # Already filled in on an earlier tick, and just waiting on the anomaly scan since
+    if day_options:
+        if not scan_done:
+            raise PreventUpdate
+        return (dash.no_update,) * 9 + (status, True, dash.no_update)
+
+    mppts = np.unique(curve_index.key_columns['mppt_id']).tolist()
+    columns, table_width = table_columns()
+    return ([{'label': day_label(d), 'value': d} for d in days], days[0],
+            [{'label': i, 'value': i} for i in mppts], 'A0' if 'A0' in mppts else mppts[0],
+            columns, {'width': table_width}, columns, {'width': table_width}, 0,
+            status, scan_done, live_ingest is None)
+
+
+# Define the callback. Every time the 'value' child of 'mppt-dropdown' (or 'day-dropdown') changes, it will call this
+# function with the new value of mppt-dropdown as the input. It also re-runs when you zoom/pan the graph (relayoutData),
+# so that the downsampling can be redone for just the visible time window, which gives more detail the further you zoom
+# in.
+# The second output tells extend_power_graph (below) which live curves this figure already includes.
+@app.callback(
+    Output('power-time', 'figure'),
+    Output('live-cursor', 'data'),
+    Input('day-dropdown', 'value'),
+    Input('mppt-dropdown', 'value'),
+    Input('power-time', 'relayoutData')
+)
+def update_power_graph(day, mppt_num, relayoutData):
+
+    require_data()
+    triggered = triggered_ids()
+    zoomed = triggered == {'power-time.relayoutData'}
+
+    # Ignore relayout events that don't touch the time axis (y-only zoom, changing the drag mode, etc.)
+    if zoomed and not changes_x_range(relayoutData):
+        raise PreventUpdate
+
+    # A zoom from the previous day doesn't mean anything for the new one (it'd most likely show nothing at all)
+    x_range = None if 'day-dropdown.value' in triggered else relayout_x_range(relayoutData)
+
+    # The full (un-zoomed) view of each MPPT on a workbook day never changes (other than getting its flagged curves
+    # once the anomaly scan is done), so build it once and reuse it
+    cache_key = (day, mppt_num, anomaly_params is not None)
+    if not zoomed and x_range is None and day != live_day and cache_key in power_figure_cache:
+        return power_figure_cache.get(cache_key), None
+
+    # The phases split the callback's time in /metrics into slicing the data vs building the figure
+    with callback_metrics.phase('data'):
+        series, cursor = power_series(day, mppt_num)
+        df, n_visible = downsample_window(series, 'Time (Australian)', 'Power (W)', x_range,
+                                          max_points=power_graph_max_points, method=power_graph_downsample)
+        # Flagged curves aren't downsampled away, they all get circled (up to the same max number of points)
+        flagged = flagged_rows(day, series, x_range, max_points=power_graph_max_points)
+
+    with callback_metrics.phase('render'):
+        trace = [power_trace_data(df, 'Time (Australian)', 'Power (W)', 'Curve #', power_hover_data),
+                 flagged_trace_data(flagged, 'Time (Australian)', 'Power (W)', 'Curve #', 'Anomaly')]
+
+        title = 'MPPT {} Power (W) {}'.format(mppt_num, day_label(day))
+        if len(df) < n_visible:
+            title += ' ({} of {} curves shown, zoom in for more)'.format(len(df), n_visible)
+
+        # Zooming only needs the new points sent to the figure that's already in the browser
+        if zoomed:
+            return patch_figure(trace_data=trace, title=title), cursor
+
+        axes = {'xaxis': {'range': list(x_range)}} if x_range is not None else None
+        fig = fill_figure(power_template, trace, title=title, axes=axes)
+        fig['layout']['uirevision'] = str(day)  # Keeps the zoom when the MPPT changes, resets it for a new day
+        if x_range is None and day != live_day:
+            power_figure_cache.put(cache_key, fig)
+        return fig, cursor
+
+
+# Live updates. Every tick of live-interval, append the curves that have finished since the power graph was last
+# updated to the end of its trace (extendData), instead of re-sending the whole series.
+@app.callback(
+    Output('power-time', 'extendData'),
+    Output('live-cursor', 'data', allow_duplicate=True),
+    Input('live-interval', 'n_intervals'),
+    State('live-cursor', 'data'),
+    State('day-dropdown', 'value'),
+    State('mppt-dropdown', 'value'),
+    prevent_initial_call=True
+)
+def extend_power_graph(n_intervals, cursor, day, mppt_num):
 
-    # Slice out the data, reset the index (to make it start at 0) and then use the index to give us the order in which
-    # the data is taken.
-    df = iv_curves[(iv_curves['mppt_id'] == mppt_num) & (iv_curves['curve_num'] == curve_num)].reset_index()
-    df['point_order'] = ['Point {}'.format(x) for x in df.index.values]
+    # Wait for update_power_graph to draw this MPPT first, otherwise we don't know what the figure already has. Only
+    # the live day gets a cursor, so this also skips the workbook days.
+    if live_ingest is None or day != live_day or not cursor or cursor['mppt'] != mppt_num:
+        raise PreventUpdate
+    live_ingest.start()  # Only does anything in a forked worker whose tailer hasn't started yet (see after_fork)
 
-    fig = px.scatter(df, x='voltage', y='current', hover_name='point_order', title='IV Curve')
+    new_rows, since = live_ingest.params_since(mppt_num, cursor['since'])
+    if not len(new_rows):
+        raise PreventUpdate
 
-    fig.update_xaxes(title_text='Voltage (V)')
-    fig.update_yaxes(title_text='Current (A)')
+    trace = power_trace_data(format_live_params(new_rows), 'Time (Australian)', 'Power (W)', 'Curve #',
+                             power_hover_data)
+    extend = {key: [values] for key, values in trace.items()}  # One list of new values per trace being extended
+    return (extend, [0]), {'mppt': mppt_num, 'since': since}
 
-    if not autosize:
-        fig.update_xaxes(range=[0, vmax])
-        fig.update_yaxes(range=[0, imax])
 
+# Inputs: the hoverData on power-time and the day/mppt dropdowns. The max voltage/current and the autosize switch are
+# State, since the clientside callback below handles changes to them. hovered_curve turns the hover into the curve's
+# (day, MPPT, curve #), and its trace data is cached in iv_trace_cache.
+def hovered_curve(hoverData, *values):
+    day, mppt_num = values[:2]  # The day/mppt dropdowns are the first two inputs of both hover callbacks
+    # print(hoverData)  # Uncomment to see the format of hoverData.
+    # This gets you the 'hover_name' of the datapoint, which is set to Curve #. Not sure why it's called hovertext
+    return (day, mppt_num, hover_value(hoverData, 'hovertext', 1)) if data_loaded.is_set() else None
+
+
+def render_iv_curve(trace, initial, day, mppt_num, vmax, imax, autosize):
+    # Still loading: an empty graph for now
+    if trace is None:
+        return fill_figure(iv_curve_template, {}, axes=iv_axis_layout(vmax, imax, autosize))
+    # Hovering swaps the x/y arrays of the figure that's already showing, which leaves the axes however the clientside
+    # callback set them. The initial call and the dropdowns send the whole figure, since the graph may not have one yet.
+    if triggered_ids() == {'power-time.hoverData'}:
+        return patch_figure(trace_data=trace)
+    return fill_figure(iv_curve_template, trace, axes=iv_axis_layout(vmax, imax, autosize))
+
+
+def neighbor_curves(key):
+    """
+    Keys of the prefetch_neighbors curves before and after key's (day, MPPT, curve #, ...) in time, nearest first. Any
+    extra parts of the key get copied onto the neighbors' keys.
+    """
+    day, mppt_num, curve_num = key[:3]
+    series, _ = power_series(day, mppt_num)
+    curve_nums = series['Curve #'].to_numpy()
+    at = np.flatnonzero(curve_nums == int(float(curve_num)))
+    if not len(at):
+        return []
+    offsets = [sign * step for step in range(1, prefetch_neighbors + 1) for sign in (1, -1)]
+    positions = [at[0] + offset for offset in offsets if 0 <= at[0] + offset < len(curve_nums)]
+    return [(day, mppt_num, int(curve_nums[position])) + tuple(key[3:]) for position in positions]
+
+
+hover_prefetch = Prefetcher(neighbor_curves, max_workers=prefetch_workers) if prefetch_neighbors else None
+
+iv_curve_hover = HoverDetails(
+    app, 'power-time', key=hovered_curve,
+    inputs=[Input('day-dropdown', 'value'), Input('mppt-dropdown', 'value')],
+    states=[State('vmax-input', 'value'), State('imax-input', 'value'), State('autosize-iv-graph', 'on')],
+    cache=iv_trace_cache, metrics=callback_metrics, prefetch=hover_prefetch)
+iv_curve_hover.add(Output('iv-curve', 'figure'), lambda key: iv_curve_trace_data(get_curve(*key)),
+                   render=render_iv_curve)
+update_iv_curve_graph = iv_curve_hover.register('update_iv_curve_graph')
+
+
+# Overlay of every IV curve selected on the power graph (selectedData), colored by time of day or irradiance, as one
+# WebGL trace. Past overlay_max_curves they get drawn into a PNG on the server instead.
+@app.callback(
+    Output('iv-overlay', 'figure'),
+    Input('power-time', 'selectedData'),
+    Input('overlay-color', 'value'),
+    State('day-dropdown', 'value'),
+    State('mppt-dropdown', 'value')
+)
+def update_iv_overlay(selectedData, color_by, day, mppt_num):
+
+    prompt = 'Lasso or box select points on the power graph to compare their IV curves here'
+    if not selectedData:
+        return fill_figure(iv_overlay_template, {}, title=prompt)
+    require_data()
+
+    # The power graph may only be showing some of the curves (see downsample.py), so a box or lasso selection takes
+    # every curve inside its outline from the full series, rather than just the points it caught. Anything else
+    # selected falls back to those points, which carry the same hovertext (Curve #) as hovered ones.
+    with callback_metrics.phase('data'):
+        series, _ = power_series(day, mppt_num)
+        inside = selection_mask(series['Time (Australian)'], series['Power (W)'], selectedData)
+        if inside is None:
+            try:
+                curve_nums = {int(float(point['hovertext'])) for point in selectedData['points']}
+            except (TypeError, KeyError, ValueError):
+                curve_nums = set()
+            inside = series['Curve #'].isin(curve_nums).to_numpy()
+        rows = series[inside]  # In time order
+        n_selected = len(rows)
+        if not n_selected:
+            return fill_figure(iv_overlay_template, {}, title=prompt)
+        as_image = overlay_as_image and n_selected > overlay_max_curves
+        if n_selected > overlay_max_curves and not as_image:
+            rows = rows.iloc[np.linspace(0, n_selected - 1, overlay_max_curves).round().astype(int)]
+        curves, lengths = get_curves(day, mppt_num, rows['Curve #'].tolist())
+
+        if color_by == 'irradiance':
+            colors, color_title = rows['Irradiance (W/m^2)'].to_numpy(), 'Irradiance (W/m^2)'
+        else:
+            times = rows['Time (Australian)']
+            colors, color_title = ((times - times.dt.normalize()) / pd.Timedelta(hours=1)).to_numpy(), 'Hour of Day'
+
+    with callback_metrics.phase('render'):
+        title = 'MPPT {}: {} IV Curves'.format(mppt_num, len(rows))
+        if as_image:
+            layout_image, axes = overlay_image(curves['voltage'], curves['current'], lengths, colors,
+                                               overlay_image_size)
+            fig = fill_figure(iv_overlay_template, overlay_colorbar_data(colors, color_title),
+                              title=title + ' (drawn as an image, select fewer to hover them)', axes=axes)
+            fig['layout']['images'] = [layout_image]  # A list, so it can't go through fill_figure's axes merge
+            return fig
+        trace = overlay_trace_data(curves['voltage'], curves['current'], lengths, rows['Curve #'].to_numpy(), colors,
+                                   color_title)
+        if len(rows) < n_selected:
+            title += ' (evenly spaced out of the {} selected)'.format(n_selected)
+        return fill_figure(iv_overlay_template, trace, title=title)
+
+
+# Thumbnails of every curve of one MPPT on one day, 20 per row in time order with flagged curves framed in red (see
+# iv_raster.py). One PNG for thousands of curves, for a quick look at a whole day or to paste into a report. Days from
+# the workbooks never change, so each sheet is drawn once (and again once the anomaly scan is done, for the frames).
+@functools.lru_cache(maxsize=64)
+def thumbnail_sheet(day, mppt_num, flagged_ready):
+    series, _ = power_series(day, mppt_num)
+    flagged = flagged_rows(day, series)
+    curves, lengths = get_curves(day, mppt_num, series['Curve #'].tolist())
+    return curve_sheet(curves['voltage'], curves['current'], lengths, series.index.isin(flagged.index), v_max, i_max)
+
+
+@app.server.route(app.config.requests_pathname_prefix + 'iv-thumbnails/<day>/<mppt_num>.png')
+def iv_thumbnails(day, mppt_num):
+    if not data_loaded.is_set():
+        flask.abort(503)
+    # The URL only has strings, so find the day and MPPT they name
+    day = next((d for d in days if str(d) == day), None)
+    mppt_num = next((m for m in np.unique(curve_index.key_columns['mppt_id']) if str(m) == mppt_num), None)
+    if day is None or mppt_num is None:
+        flask.abort(404)
+    if day == live_day:
+        png = thumbnail_sheet.__wrapped__(day, mppt_num, False)  # Still growing, so don't cache it
+    else:
+        png = thumbnail_sheet(day, mppt_num, anomaly_params is not None)
+    return flask.Response(png, mimetype='image/png')
 
-    return fig
 
-# Data Table. This table displays all the data associated with the selected IV Curve by displaying all columns of
-# the iv_params dataframe associated with this IV Curve.
-@app.callback(Output('iv-param-data', 'data'), Input('power-time', 'hoverData'), Input('mppt-dropdown', 'value'))
-def update_table(hoverData, mppt_num):
+@app.callback(
+    Output('thumbnail-link', 'href'),
+    Input('day-dropdown', 'value'),
+    Input('mppt-dropdown', 'value')
+)
+def update_thumbnail_link(day, mppt_num):
+    if day is None or mppt_num is None:
+        raise PreventUpdate
+    return '{}iv-thumbnails/{}/{}.png'.format(app.config.requests_pathname_prefix, quote(str(day), safe=''),
+                                               quote(str(mppt_num), safe=''))
 
-    # Use previous code to get curve_num
-    try:
-        curve_num = hoverData['points'][0]['hovertext']  # How we can slice into hover data
-    except TypeError:
-        curve_num = 1
 
-    # Note that we're pulling from the params dataframe now so that we only get one row
-    table_data = iv_params[(iv_params['MPPT ID'] == mppt_num) & (iv_params['Curve #'] == curve_num)]
+# Heatmap of every MPPT. The values come from the precomputed rollups (see rollup.py): on zoom, the finest bucket width
+# that fits the visible window in heatmap_max_buckets columns gets picked and only that window is sent, as a Patch.
+@app.callback(
+    Output('mppt-heatmap', 'figure'),
+    Input('day-dropdown', 'value'),
+    Input('heatmap-value', 'value'),
+    Input('heatmap-stat', 'value'),
+    Input('mppt-heatmap', 'relayoutData')
+)
+def update_mppt_heatmap(day, value, stat, relayoutData):
+
+    require_data()
+    triggered = triggered_ids()
+    zoomed = triggered == {'mppt-heatmap.relayoutData'}
+    if zoomed and not changes_x_range(relayoutData):
+        raise PreventUpdate
+
+    # A zoom from the previous day doesn't mean anything for the new one
+    x_range = None if 'day-dropdown.value' in triggered else relayout_x_range(relayoutData)
+
+    with callback_metrics.phase('data'):
+        pyramid = get_rollup(day)
+        level = pyramid.level_for(x_range, max_buckets=heatmap_max_buckets)
+        times, mppts, z = pyramid.window(level, value, stat, x_range)
+
+    with callback_metrics.phase('render'):
+        trace = {'x': times, 'y': mppts, 'z': z.round(3), 'colorbar': {'title': {'text': value}}}
+        title = '{} {} of Every MPPT, {} ({} min buckets)'.format(
+            stat.title(), value, day_label(day), level.width // 60)
+        if zoomed:
+            return patch_figure(trace_data=trace, title=title)
+
+        axes = {'xaxis': {'range': list(x_range)}} if x_range is not None else None
+        fig = fill_figure(heatmap_template, trace, title=title, axes=axes)
+        fig['layout']['uirevision'] = str(day)  # Keeps the zoom when the value/stat changes, resets it for a new day
+        return fig
+
+
+# Axis limits and autosize for the IV graph. These are pure presentation (no new data needed), so they run as a
+# clientside (JavaScript) callback in the browser: see set_iv_axes in assets/iv_clientside.js. allow_duplicate lets
+# this share the figure output with update_iv_curve_graph.
+app.clientside_callback(
+    ClientsideFunction(namespace='iv', function_name='set_iv_axes'),
+    Output('iv-curve', 'figure', allow_duplicate=True),
+    Input('vmax-input', 'value'),
+    Input('imax-input', 'value'),
+    Input('autosize-iv-graph', 'on'),
+    State('iv-curve', 'figure'),
+    prevent_initial_call=True
+)
 
-    # Make sure we give right format (see https://dash.plotly.com/datatable)
-    return table_data.to_dict('records')
+# Data Table. This table displays all the data associated with the selected IV Curve by displaying all columns of
+# the iv_params dataframe associated with this IV Curve. Same hover key and dropdown inputs as the IV graph.
+# The rows are cached (and prefetched) like the IV curves. Whether the anomaly scan is done is part of the key, since
+# that adds the Anomaly column to the rows.
+def hovered_params_row(hoverData, day, mppt_num):
+    require_data()
+    return hovered_curve(hoverData, day, mppt_num) + (anomaly_params is not None,)
+
+
+params_row_hover = HoverDetails(
+    app, 'power-time', key=hovered_params_row,
+    inputs=[Input('day-dropdown', 'value'), Input('mppt-dropdown', 'value')], cache=params_row_cache,
+    metrics=callback_metrics, prefetch=hover_prefetch)
+# Note that we're pulling from the params dataframe now so that we only get one row. Make sure we give right format
+# (see https://dash.plotly.com/datatable)
+params_row_hover.add(Output('iv-param-data', 'data'), lambda key: get_params_row(*key[:3]).to_dict('records'))
+update_table = params_row_hover.register('update_table')
+
+
+# All IV Curves table. The DataTable sends its page, sort and filter here (the 'custom' actions) and gets back just the
+# rows of that page, so it stays quick however many curves there are.
+@app.callback(
+    Output('iv-param-browser', 'data'),
+    Output('iv-param-browser', 'page_count'),
+    Input('iv-param-browser', 'page_current'),
+    Input('iv-param-browser', 'page_size'),
+    Input('iv-param-browser', 'sort_by'),
+    Input('iv-param-browser', 'filter_query')
+)
+def update_param_browser(page_current, page_size, sort_by, filter_query):
+    require_data()
+    query = params_query  # The same one for both steps, even if use_anomalies swaps in a new one in between
+    with callback_metrics.phase('data'):
+        rows = query.rows(filter_query, sort_by)  # Row numbers of every match, in order
+    with callback_metrics.phase('render'):
+        return query.page_records(rows, page_current, page_size)
 
 
 if __name__ == '__main__':
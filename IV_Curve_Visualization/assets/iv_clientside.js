@@ -0,0 +1,45 @@
+/*
+ Clientside (in the browser) callbacks for the IV dashboards.
+
+ Changing the IV graph's max voltage/current or the autosize switch doesn't need any new data, just new axis ranges on
+ the figure that's already showing. Doing it here skips the round trip to the server entirely, so the server only has to
+ deal with the callbacks that actually need data.
+
+ Dash loads every .js file in the assets folder automatically. See https://dash.plotly.com/clientside-callbacks
+ */
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    iv: {
+        // Returns a copy of the IV curve figure with new axis ranges. Mirrors iv_axis_layout in iv_render.py.
+        set_iv_axes: function(vmax, imax, autosize, figure) {
+            if (!figure) {
+                return window.dash_clientside.no_update;
+            }
+
+            let xaxis, yaxis;
+            if (autosize) {
+                xaxis = {autorange: true, range: null};
+                yaxis = {autorange: true, range: null};
+            } else {
+                const v = parseFloat(vmax);
+                const i = parseFloat(imax);
+                if (isNaN(v) || isNaN(i)) {
+                    return window.dash_clientside.no_update;  // Probably still typing, so leave the graph alone
+                }
+                xaxis = {autorange: false, range: [0, v]};
+                yaxis = {autorange: false, range: [0, i]};
+            }
+
+            const layout = Object.assign({}, figure.layout, {
+                xaxis: Object.assign({}, figure.layout.xaxis, xaxis),
+                yaxis: Object.assign({}, figure.layout.yaxis, yaxis)
+            });
+            return Object.assign({}, figure, {layout: layout});
+        },
+
+        // Same thing for dashboards without an autosize switch (02_Dash_Graphs.py)
+        set_iv_axes_fixed: function(vmax, imax, figure) {
+            return window.dash_clientside.iv.set_iv_axes(vmax, imax, false, figure);
+        }
+    }
+});
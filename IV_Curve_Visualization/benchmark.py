@@ -0,0 +1,382 @@
+"""
+Benchmarks for the hot paths of the IV dashboards: loading the workbooks, fitting iv_params and the Dash callbacks.
+
+Everything runs on a synthetic dataset with the same columns as the real workbooks ('time', 'voltage', 'current',
+'power', 'mppt_id', 'curve_num'), so runs are reproducible (fixed seed) and can be scaled up past the size of the data
+we actually have: MPPTs x curves per MPPT x points per curve.
+
+Each benchmark is timed over several repeats and reported as p50/p95/p99 latency in milliseconds, plus the peak memory
+it allocated (measured with tracemalloc in a separate run, since tracing slows everything down). The report is JSON,
+so two runs (e.g. before and after a change) can be compared with --compare.
+
+The callbacks are called directly, as plain functions, on the dashboard loaded as a module with IV_WORKBOOKS pointed at
+the synthetic workbook. Dash only sets up callback_context when a request comes in, so the benchmark fills it in itself
+(see set_triggered). That reaches into dash._callback_context, which isn't public API and might move in a later Dash.
+
+How to use this:
+    python benchmark.py                                  # Default scale, report goes to benchmark_results.json
+    python benchmark.py --mppts 20 --curves 1000 --points 60 --repeat 50 --output big.json
+    python benchmark.py --compare benchmark_results.json   # Run again and print the change vs an earlier report
+
+References:
+    * https://docs.python.org/3/library/tracemalloc.html
+    * https://docs.python.org/3/library/time.html#time.perf_counter
+    * https://dash.plotly.com/advanced-callbacks (callback_context)
+
+"""
+
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from iv_anomaly import detect_anomalies
+from iv_env import EnvironmentLogs
+from iv_extract import extract_iv_params
+from iv_store import CurveIndex, load_iv_curves
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPORT_VERSION = 1
+PERCENTILES = (50, 95, 99)
+
+
+############# Synthetic data ##################################
+
+def make_synthetic_iv(n_mppts=8, n_curves=200, n_points=40, seed=0, start='2017-10-12 06:00', curve_period=60.0):
+    """
+    Dataframe of synthetic IV sweeps in the workbook format. Each MPPT gets n_curves sweeps, curve_period seconds
+    apart, of n_points points each (swept from Voc down to 0 V). The curves follow the ideal diode equation, with Isc
+    following the sun over the day plus some noise and passing clouds, so the fits have something realistic to chew on.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = n_mppts * n_curves * n_points
+
+    mppt = np.repeat(np.arange(n_mppts), n_curves * n_points)
+    curve = np.tile(np.repeat(np.arange(1, n_curves + 1), n_points), n_mppts)
+    point = np.tile(np.arange(n_points), n_mppts * n_curves)
+
+    # Sun up over the day (half a sine), scaled per MPPT, with random cloud dips
+    day_fraction = (curve - 1) / max(n_curves - 1, 1)
+    sun = 0.05 + 0.95 * np.sin(np.pi * day_fraction)
+    clouds = np.where(rng.random(n_mppts * n_curves) < 0.1, rng.uniform(0.2, 0.8, n_mppts * n_curves), 1.0)
+    isc = 6.5 * sun * rng.uniform(0.9, 1.0, n_mppts)[mppt] * np.repeat(clouds, n_points)
+    voc = 24.0 + 3.0 * np.log1p(isc) / np.log1p(6.5)
+
+    voltage = voc * (1 - point / (n_points - 1))
+    current = isc * (1 - np.exp((voltage - voc) / 0.9)) + rng.normal(0, 0.005, n_rows)
+    current = np.clip(current, 0, None)
+
+    seconds = (curve - 1) * curve_period + point * 0.05
+    return pd.DataFrame({
+        'time': pd.Timestamp(start) + pd.to_timedelta(seconds, unit='s'),
+        'voltage': voltage,
+        'current': current,
+        'curve_num': curve,
+        'mppt_id': np.array(['{}{}'.format('ABCD'[i % 4], i // 4) for i in range(n_mppts)])[mppt],
+        'power': voltage * current,
+    })
+
+
+def write_synthetic_workbook(folder, **scale):
+    """Write make_synthetic_iv(**scale) to an .xlsx named like the real ones (so it's day 1). Returns its path."""
+    path = os.path.join(folder, 'synthetic_day_1_iv_curves.xlsx')
+    make_synthetic_iv(**scale).to_excel(path, index=False)
+    return path
+
+
+############# Timing ##################################
+
+def summarize(samples):
+    """p50/p95/p99, mean, min and max of a list of durations in seconds, all in milliseconds."""
+    ms = np.asarray(samples) * 1000
+    summary = {'p{}_ms'.format(p): float(np.percentile(ms, p)) for p in PERCENTILES}
+    summary.update({'mean_ms': float(ms.mean()), 'min_ms': float(ms.min()), 'max_ms': float(ms.max()), 'n': len(ms)})
+    return summary
+
+
+def peak_memory(fn):
+    """Peak memory (MB) allocated while running fn once, as seen by tracemalloc (NumPy arrays included)."""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def bench(fn, repeat, setup=None, warmup=1):
+    """
+    Time fn() `repeat` times and measure its peak memory once. setup() runs before each call but isn't timed (e.g. to
+    clear a cache). fn can also be a list of calls, in which case each call is one sample (e.g. hovering different
+    curves).
+    """
+    calls = fn if isinstance(fn, list) else [fn] * repeat
+    for call in calls[:warmup]:
+        if setup:
+            setup()
+        call()
+
+    samples = []
+    for call in calls:
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - t0)
+
+    if setup:
+        setup()
+    result = summarize(samples)
+    result['peak_mem_mb'] = peak_memory(calls[0])
+    return result
+
+
+############# Dashboard ##################################
+
+def load_dashboard(workbook, filename='03_Semi-Final_Graphs.py'):
+    """
+    Import a dashboard script as a module with its data pointed at `workbook`, and wait for its data to load.
+    Returns (module, seconds until it could take requests, seconds until the data was loaded).
+    """
+    os.environ['IV_WORKBOOKS'] = workbook
+    os.chdir(HERE)
+    spec = importlib.util.spec_from_file_location('iv_dashboard', os.path.join(HERE, filename))
+    module = importlib.util.module_from_spec(spec)
+    t0 = time.perf_counter()
+    spec.loader.exec_module(module)
+    startup = time.perf_counter() - t0
+    if hasattr(module, 'wait_until_loaded') and not module.wait_until_loaded(anomalies=False):
+        raise RuntimeError('{} failed to load its data: {}'.format(filename, module.data_error))
+    return module, startup, time.perf_counter() - t0
+
+
+def set_triggered(*prop_ids):
+    """
+    Fill in dash.callback_context as if the inputs prop_ids ('component-id.property') had just changed, so callbacks
+    can be called as plain functions. No prop_ids is the initial call.
+    """
+    from dash._callback_context import context_value
+    from dash._utils import AttributeDict
+    context_value.set(AttributeDict(triggered_inputs=[{'prop_id': prop_id, 'value': None} for prop_id in prop_ids]))
+
+
+def hover(curve_num):
+    return {'points': [{'hovertext': int(curve_num)}]}
+
+
+def callback_benchmarks(dash_module, repeat, rng):
+    """Time each callback of the semi-final dashboard the way the browser would trigger it."""
+    d = dash_module
+    day = d.days[0]
+    mppt = np.unique(d.curve_index.key_columns['mppt_id'])[0]
+    series, _ = d.power_series(day, mppt)
+    curve_nums = series['Curve #'].to_numpy()
+    times = series['Time (Australian)'].to_numpy()
+    results = {}
+    d.anomaly_scan.wait()  # So every run times the power graph with its flagged curves, not a race with the scan
+
+    # Power graph: picking an MPPT from the dropdown, with and without the full-view figure cache
+    set_triggered()
+    results['update_power_graph.full'] = bench(
+        lambda: d.update_power_graph(day, mppt, None), repeat, setup=d.power_figure_cache.clear)
+    results['update_power_graph.full_cached'] = bench(lambda: d.update_power_graph(day, mppt, None), repeat)
+
+    # Power graph: zooming to a random window (sends a Patch with the re-downsampled points)
+    def zoom_call(lo, hi):
+        relayout = {'xaxis.range[0]': str(pd.Timestamp(lo)), 'xaxis.range[1]': str(pd.Timestamp(hi))}
+        return lambda: (set_triggered('power-time.relayoutData'), d.update_power_graph(day, mppt, relayout))
+    windows = np.sort(rng.integers(0, len(times), size=(repeat, 2)), axis=1)
+    results['update_power_graph.zoom'] = bench([zoom_call(times[lo], times[hi]) for lo, hi in windows], repeat)
+
+    # IV graph: hovering over random curves, first with a cold trace cache and then over curves already seen. Hover
+    # prefetching is off for these (it's timed by the scrub below), so they time building the curves themselves.
+    hovered = rng.choice(curve_nums, size=repeat)
+    hover_details = [d.iv_curve_hover, d.params_row_hover]
+    for details in hover_details:
+        details.prefetch = None
+
+    def iv_call(curve_num):
+        return lambda: (set_triggered('power-time.hoverData'),
+                        d.update_iv_curve_graph(hover(curve_num), day, mppt, d.v_max, d.i_max, False))
+    results['update_iv_curve_graph.hover'] = bench([iv_call(c) for c in hovered], repeat, setup=d.iv_trace_cache.clear)
+    results['update_iv_curve_graph.hover_cached'] = bench([iv_call(c) for c in hovered], repeat)
+    set_triggered()
+    results['update_iv_curve_graph.initial'] = bench(
+        lambda: d.update_iv_curve_graph(None, day, mppt, d.v_max, d.i_max, False), repeat)
+
+    # Overlay: lasso selecting a random run of consecutive curves (as many as the overlay draws at once)
+    def overlay_call(first):
+        selected = {'points': [{'hovertext': int(c)} for c in curve_nums[first:first + d.overlay_max_curves]]}
+        return lambda: (set_triggered('power-time.selectedData'), d.update_iv_overlay(selected, 'time', day, mppt))
+    firsts = rng.integers(0, max(len(curve_nums) - d.overlay_max_curves, 0) + 1, size=repeat)
+    results['update_iv_overlay.select'] = bench([overlay_call(first) for first in firsts], repeat)
+
+    # Table: hovering over random curves
+    set_triggered('power-time.hoverData')
+    results['update_table.hover'] = bench([lambda c=c: d.update_table(hover(c), day, mppt) for c in hovered], repeat,
+                                          setup=d.params_row_cache.clear)
+
+    # Scrubbing: hovering one curve after the next along the power graph (IV graph and table), with a few ms between
+    # hovers like a mouse moving across it, so the prefetcher gets to warm the curves ahead
+    for details in hover_details:
+        details.prefetch = d.hover_prefetch
+    d.iv_trace_cache.clear()
+    d.params_row_cache.clear()
+    first = int(rng.integers(0, max(len(curve_nums) - repeat - 1, 0) + 1))
+
+    def scrub_call(curve_num):
+        return lambda: (d.update_iv_curve_graph(hover(curve_num), day, mppt, d.v_max, d.i_max, False),
+                        d.update_table(hover(curve_num), day, mppt))
+    results['hover.scrub'] = bench([scrub_call(c) for c in curve_nums[first:first + repeat + 1]], repeat,
+                                   setup=lambda: time.sleep(0.005))
+
+    # All IV Curves table: random pages sorted by power, then filtered on Isc and sorted by MPPT then time
+    page_count = d.params_query.page(None, None, 0, d.param_browser_page_size)[1]
+    pages = rng.integers(0, page_count, size=repeat)
+    by_power = [{'column_id': 'Power (W)', 'direction': 'desc'}]
+    results['update_param_browser.sort'] = bench(
+        [lambda p=p: d.update_param_browser(p, d.param_browser_page_size, by_power, '') for p in pages], repeat)
+    by_mppt_time = [{'column_id': 'MPPT ID', 'direction': 'asc'},
+                    {'column_id': 'Time (Australian)', 'direction': 'asc'}]
+    results['update_param_browser.filter_sort'] = bench(
+        lambda: d.update_param_browser(0, d.param_browser_page_size, by_mppt_time, '{Isc (A)} > 2'), repeat)
+    return results
+
+
+############# Report ##################################
+
+def run(n_mppts, n_curves, n_points, repeat, seed=0, keep_data=None):
+    """Generate the dataset, run every benchmark and return the report dict."""
+    rng = np.random.default_rng(seed)
+    scale = {'n_mppts': n_mppts, 'n_curves': n_curves, 'n_points': n_points, 'seed': seed}
+    folder = keep_data or tempfile.mkdtemp(prefix='iv_benchmark_')
+    os.makedirs(folder, exist_ok=True)
+    results = {}
+    footprint = {}
+    try:
+        t0 = time.perf_counter()
+        workbook = write_synthetic_workbook(folder, **scale)
+        print('Wrote {:,} rows to {} in {:.1f}s'.format(
+            n_mppts * n_curves * n_points, workbook, time.perf_counter() - t0))
+
+        # Ingest. read_excel is slow, so it only gets a few repeats.
+        excel_repeat = max(1, min(repeat, 3))
+        results['ingest.read_excel'] = bench(lambda: pd.read_excel(workbook), excel_repeat, warmup=0)
+        results['ingest.cache_build'] = bench(
+            lambda: load_iv_curves(workbook), excel_repeat, warmup=0,
+            setup=lambda: shutil.rmtree(os.path.join(folder, '.iv_cache'), ignore_errors=True))
+        load_iv_curves(workbook)  # Leave the cache in place for the rest
+        results['ingest.cache_load'] = bench(lambda: load_iv_curves(workbook), repeat)
+
+        # Resident size of the data: the dataframe read_excel gives vs the compacted store (see iv_store.py)
+        store = load_iv_curves(workbook)
+        footprint['read_excel_frame_mb'] = pd.read_excel(workbook).memory_usage(deep=True).sum() / 2**20
+        footprint['store_mb'] = store.nbytes / 2**20
+
+        # iv_params
+        results['iv_params.curve_index'] = bench(lambda: CurveIndex(store, keys=('mppt_id', 'curve_num')), repeat)
+        curve_index = CurveIndex(store, keys=('mppt_id', 'curve_num'))
+        results['iv_params.extract'] = bench(lambda: extract_iv_params(curve_index), repeat)
+        params = extract_iv_params(curve_index)
+        results['iv_params.anomalies'] = bench(lambda: detect_anomalies(curve_index, params), repeat)
+
+        # Environment join: a 1 Hz log covering every curve, as-of joined onto all of them at once
+        times = params['time'].to_numpy()
+        log_times = np.arange(times.min(), times.max() + np.timedelta64(1, 's'), np.timedelta64(1, 's'))
+        env = EnvironmentLogs([({'time': log_times, 'irradiance': rng.uniform(0, 1000, len(log_times))}, '2s')])
+        results['iv_params.env_join'] = bench(lambda: env.join(times), repeat)
+
+        # Callbacks
+        dash_module, startup, data_load = load_dashboard(workbook)
+        results['dashboard.startup'] = summarize([startup])  # Until the server can bind (the data loads after)
+        results['dashboard.data_load'] = summarize([data_load])
+        results.update(callback_benchmarks(dash_module, repeat, rng))
+    finally:
+        if keep_data is None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    return {
+        'report_version': REPORT_VERSION,
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'scale': dict(scale, n_rows=n_mppts * n_curves * n_points, repeat=repeat),
+        'environment': environment(),
+        'footprint': footprint,
+        'results': results,
+    }
+
+
+def environment():
+    """Versions and machine info, so a comparison between two reports can tell if they're from different setups."""
+    import dash
+    import plotly
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'dash': dash.__version__,
+        'plotly': plotly.__version__,
+    }
+
+
+def print_report(report, baseline=None):
+    """Table of the results. With a baseline report, also shows how much each p50/p95 changed."""
+    header = '{:<36} {:>10} {:>10} {:>10} {:>10}'.format('benchmark', 'p50 ms', 'p95 ms', 'p99 ms', 'peak MB')
+    if baseline:
+        header += ' {:>10} {:>10}'.format('p50 chg', 'p95 chg')
+    print(header)
+    print('-' * len(header))
+    for name, r in report['results'].items():
+        line = '{:<36} {:>10.2f} {:>10.2f} {:>10.2f} {:>10}'.format(
+            name, r['p50_ms'], r['p95_ms'], r['p99_ms'],
+            '{:.1f}'.format(r['peak_mem_mb']) if 'peak_mem_mb' in r else '')
+        old = (baseline or {}).get('results', {}).get(name)
+        if old:
+            line += ' {:>+9.0%} {:>+9.0%}'.format(r['p50_ms'] / old['p50_ms'] - 1, r['p95_ms'] / old['p95_ms'] - 1)
+        print(line)
+    footprint = report.get('footprint')
+    if footprint:
+        print('\nData in memory: {:.1f} MB as the read_excel dataframe, {:.1f} MB in the store ({:.1f}x less)'.format(
+            footprint['read_excel_frame_mb'], footprint['store_mb'],
+            footprint['read_excel_frame_mb'] / footprint['store_mb']))
+    if baseline and baseline.get('scale') != report['scale']:
+        print('\nNote: the baseline was run at a different scale: {}'.format(baseline.get('scale')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark IV ingest, iv_params extraction and the Dash callbacks')
+    parser.add_argument('--mppts', type=int, default=8, help='MPPTs in the synthetic data (default: %(default)s)')
+    parser.add_argument('--curves', type=int, default=200, help='IV curves per MPPT (default: %(default)s)')
+    parser.add_argument('--points', type=int, default=40, help='Points per IV curve (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=30, help='Samples per benchmark (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the data and the hovers')
+    parser.add_argument('--output', default='benchmark_results.json', help='Report file (default: %(default)s)')
+    parser.add_argument('--compare', help='Earlier report to compare this run against')
+    parser.add_argument('--keep-data', help='Write the synthetic workbook (and its cache) to this folder and keep it')
+    args = parser.parse_args()
+
+    # Read the baseline first, since --output might be the same file
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    output = os.path.abspath(args.output)  # run() switches to this folder to load the dashboard
+    report = run(args.mppts, args.curves, args.points, args.repeat, seed=args.seed,
+                 keep_data=os.path.abspath(args.keep_data) if args.keep_data else None)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print()
+    print_report(report, baseline)
+    print('\nReport written to {}'.format(output))
@@ -0,0 +1,338 @@
+"""
+Per-callback latency metrics for Dash apps.
+
+Wraps every @app.callback of an app so each call records its wall time, how long it spent in named phases (e.g.
+slicing the data vs building the figure, see phase()), the size of the JSON response sent back to the browser and
+whether it finished, raised PreventUpdate or errored. Timings go into histograms that are:
+    * cumulative, exposed at /metrics in the Prometheus text format so they can be scraped and graphed over time, and
+    * rolling (the last `window` calls of each callback), for the p50/p95/p99 in the optional debug panel.
+
+Works with any Dash app, not just the IV dashboards. Under gunicorn every worker process records its own calls. Give
+them all the same shared_dir (serve.py does, through the DASH_METRICS_DIR environment variable) and each one writes its
+totals there after every request, so /metrics adds up all the workers, whichever one answers the scrape. The rolling
+percentiles in the debug panel are only the worker that answers, though.
+
+How to use this:
+    app = dash.Dash(__name__)
+    callback_metrics = CallbackMetrics().instrument(app)  # Before any @app.callback
+
+    @app.callback(Output('graph', 'figure'), Input('dropdown', 'value'))
+    def update_graph(value):
+        with callback_metrics.phase('data'):
+            df = slice_data(value)
+        with callback_metrics.phase('render'):
+            return build_figure(df)
+
+    app.layout = html.Div([..., callback_metrics.debug_panel(app)])  # Optional live table of the metrics
+
+References:
+    * https://prometheus.io/docs/instrumenting/exposition_formats/
+    * https://prometheus.io/docs/practices/histograms/
+    * https://flask.palletsprojects.com/en/stable/api/#flask.Flask.after_request
+
+"""
+
+import bisect
+import contextlib
+import functools
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+
+import flask
+import numpy as np
+from dash.exceptions import PreventUpdate
+
+# Histogram bucket upper bounds (Prometheus 'le' labels). +Inf is added on the end.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Seconds
+SIZE_BUCKETS = (2**10, 2**12, 2**14, 2**16, 2**18, 2**20, 2**22, 2**24)  # Bytes (1 KB to 16 MB)
+
+# Update requests for the server-side callbacks all go to this route
+CALLBACK_ROUTE = '_dash-update-component'
+
+# Folder where each process writes its totals for the others, if it isn't given to CallbackMetrics (see serve.py)
+SHARED_DIR_VARIABLE = 'DASH_METRICS_DIR'
+
+# Histogram tables of a CallbackMetrics and their buckets
+HISTOGRAMS = {'latency': LATENCY_BUCKETS, 'phases': LATENCY_BUCKETS, 'sizes': SIZE_BUCKETS}
+
+
+class RollingHistogram:
+    """
+    Cumulative Prometheus-style histogram (bucket counts, sum, count) plus the last `window` raw samples, which the
+    rolling percentiles come from.
+    """
+
+    def __init__(self, buckets, window=1000):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # One per bucket plus +Inf, not cumulative (that's done on export)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def percentiles(self, qs=(50, 95, 99)):
+        """Percentiles of the rolling window (NaN if it's empty)."""
+        if not self.recent:
+            return [float('nan')] * len(qs)
+        return [float(q) for q in np.percentile(np.fromiter(self.recent, float), qs)]
+
+    def totals(self):
+        """The cumulative part: [bucket counts, sum, count]. Adding these up across processes gives their histogram."""
+        return [list(self.counts), self.sum, self.count]
+
+
+def prometheus_lines(name, labels, buckets, totals):
+    """Text format lines for one histogram's totals: _bucket (cumulative, one per le), _sum and _count."""
+    counts, total, count = totals
+    label_text = ','.join('{}="{}"'.format(key, value) for key, value in labels.items())
+    lines = []
+    cumulative = 0
+    for bound, bucket_count in zip(tuple(buckets) + ('+Inf',), counts):
+        cumulative += bucket_count
+        lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label_text, bound, cumulative))
+    lines.append('{}_sum{{{}}} {}'.format(name, label_text, repr(total)))
+    lines.append('{}_count{{{}}} {}'.format(name, label_text, count))
+    return lines
+
+
+class CallbackMetrics:
+    """Latency, phase and response size histograms for every callback of the Dash apps it instruments."""
+
+    def __init__(self, window=1000, shared_dir=None):
+        self.window = window
+        self.shared_dir = shared_dir or os.environ.get(SHARED_DIR_VARIABLE)  # Where every process's totals go
+        self.latency = {}  # callback name -> RollingHistogram of wall time (s)
+        self.phases = {}  # (callback name, phase) -> RollingHistogram of time spent in that phase (s)
+        self.sizes = {}  # callback name -> RollingHistogram of response size (bytes)
+        self.outcomes = {}  # (callback name, 'ok'/'prevented'/'error') -> count
+        self._lock = threading.Lock()
+        self._local = threading.local()  # Phase timings of the callback running in this thread
+        self._pid = os.getpid()  # Process the numbers are from (see _check_fork)
+        self._changed = False  # Recorded something since the totals were last written to shared_dir
+
+    # Instrumenting
+
+    def instrument(self, app):
+        """
+        Make every callback registered on app from here on get timed, and add the /metrics route to its server.
+        Returns self so it can be chained.
+        """
+        register = app.callback
+
+        @functools.wraps(register)
+        def callback(*args, **kwargs):
+            decorator = register(*args, **kwargs)
+            return lambda func: decorator(self.timed(func))
+
+        app.callback = callback
+        app.server.after_request(self._record_response_size)
+        app.server.add_url_rule(app.config.requests_pathname_prefix + 'metrics', 'callback_metrics', self._serve)
+        return self
+
+    def timed(self, func):
+        """Wrap a callback function so each call is recorded under its name."""
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            outer = getattr(self._local, 'phases', None)  # In case a callback calls another one directly
+            self._local.phases = {}
+            outcome = 'error'
+            t0 = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+                outcome = 'ok'
+                return result
+            except PreventUpdate:
+                outcome = 'prevented'
+                raise
+            finally:
+                self._record(name, time.perf_counter() - t0, self._local.phases, outcome)
+                self._local.phases = outer
+                if flask.has_request_context():
+                    flask.g.dash_callback = name  # So the response size gets attributed to this callback
+
+        return wrapper
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a block of a callback as phase `name`. Does nothing outside an instrumented callback."""
+        phases = getattr(self._local, 'phases', None)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            if phases is not None:
+                phases[name] = phases.get(name, 0.0) + time.perf_counter() - t0
+
+    # Recording
+
+    def _histogram(self, table, key, buckets):
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = RollingHistogram(buckets, self.window)
+        return histogram
+
+    def _check_fork(self):
+        # A forked worker starts from a copy of the parent's numbers, which the parent reports itself. Start over.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self.latency, self.phases, self.sizes, self.outcomes = {}, {}, {}, {}
+
+    def _record(self, name, seconds, phases, outcome):
+        self._check_fork()
+        with self._lock:
+            self._changed = True
+            self._histogram(self.latency, name, LATENCY_BUCKETS).observe(seconds)
+            for phase, phase_seconds in phases.items():
+                self._histogram(self.phases, (name, phase), LATENCY_BUCKETS).observe(phase_seconds)
+            self.outcomes[name, outcome] = self.outcomes.get((name, outcome), 0) + 1
+
+    def _record_response_size(self, response):
+        self._check_fork()
+        name = flask.g.get('dash_callback')
+        if name is not None and flask.request.path.endswith(CALLBACK_ROUTE):
+            with self._lock:
+                self._changed = True
+                self._histogram(self.sizes, name, SIZE_BUCKETS).observe(response.calculate_content_length() or 0)
+        if self.shared_dir and self._changed:
+            self._write_totals()
+        return response
+
+    # Sharing between processes
+
+    def _shared_path(self, pid):
+        return os.path.join(self.shared_dir, 'metrics_{}.json'.format(pid))
+
+    def _totals(self):
+        """This process's cumulative numbers, as JSON-able lists of [key, totals] (and [key, count] for outcomes)."""
+        with self._lock:
+            totals = {table: [[list(key) if isinstance(key, tuple) else [key], histogram.totals()]
+                              for key, histogram in getattr(self, table).items()] for table in HISTOGRAMS}
+            totals['outcomes'] = [[list(key), count] for key, count in self.outcomes.items()]
+        return totals
+
+    def _write_totals(self):
+        # Written whole to a temporary file and then renamed over the old one, so a reader never sees half of it
+        self._changed = False
+        fd, tmp_path = tempfile.mkstemp(dir=self.shared_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._totals(), f)
+        os.replace(tmp_path, self._shared_path(os.getpid()))
+
+    def _all_totals(self):
+        """
+        Totals of every process writing to shared_dir (including ones that have since exited, since their calls still
+        happened) plus this one, added up. Returns {table: {key: totals}}, with outcomes as {key: count}.
+        """
+        self._check_fork()
+        processes = [self._totals()]
+        own_path = self._shared_path(os.getpid()) if self.shared_dir else None
+        for path in sorted(glob.glob(os.path.join(self.shared_dir, 'metrics_*.json'))) if self.shared_dir else []:
+            if path != own_path:
+                try:
+                    with open(path) as f:
+                        processes.append(json.load(f))
+                except (OSError, ValueError):
+                    continue  # Gone, or not a totals file
+
+        merged = {table: {} for table in list(HISTOGRAMS) + ['outcomes']}
+        for totals in processes:
+            for table in HISTOGRAMS:
+                for key, (counts, total, count) in totals.get(table, []):
+                    key = tuple(key) if len(key) > 1 else key[0]
+                    current = merged[table].setdefault(key, [[0] * len(counts), 0.0, 0])
+                    current[0] = [a + b for a, b in zip(current[0], counts)]
+                    current[1] += total
+                    current[2] += count
+            for key, count in totals.get('outcomes', []):
+                merged['outcomes'][tuple(key)] = merged['outcomes'].get(tuple(key), 0) + count
+        return merged
+
+    # Reporting
+
+    def prometheus_text(self):
+        """All metrics (of every process sharing shared_dir) in the Prometheus text exposition format."""
+        merged = self._all_totals()
+        lines = ['# HELP dash_callback_duration_seconds Wall time of each Dash callback call.',
+                 '# TYPE dash_callback_duration_seconds histogram']
+        for name, totals in sorted(merged['latency'].items()):
+            lines += prometheus_lines('dash_callback_duration_seconds', {'callback': name}, LATENCY_BUCKETS, totals)
+
+        lines += ['# HELP dash_callback_phase_duration_seconds Time spent in each phase of a Dash callback.',
+                  '# TYPE dash_callback_phase_duration_seconds histogram']
+        for (name, phase), totals in sorted(merged['phases'].items()):
+            lines += prometheus_lines('dash_callback_phase_duration_seconds', {'callback': name, 'phase': phase},
+                                      LATENCY_BUCKETS, totals)
+
+        lines += ['# HELP dash_callback_response_bytes Size of the JSON response of each Dash callback.',
+                  '# TYPE dash_callback_response_bytes histogram']
+        for name, totals in sorted(merged['sizes'].items()):
+            lines += prometheus_lines('dash_callback_response_bytes', {'callback': name}, SIZE_BUCKETS, totals)
+
+        lines += ['# HELP dash_callback_calls_total Dash callback calls by outcome (ok, prevented or error).',
+                  '# TYPE dash_callback_calls_total counter']
+        for (name, outcome), count in sorted(merged['outcomes'].items()):
+            lines.append('dash_callback_calls_total{{callback="{}",outcome="{}"}} {}'.format(name, outcome, count))
+        return '\n'.join(lines) + '\n'
+
+    def _serve(self):
+        return flask.Response(self.prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+    def summary(self):
+        """One row per callback with its call count and rolling percentiles, for the debug panel."""
+        rows = []
+        with self._lock:
+            for name, histogram in sorted(self.latency.items()):
+                p50, p95, p99 = histogram.percentiles()
+                row = {
+                    'Callback': name,
+                    'Calls': histogram.count,
+                    'Errors': self.outcomes.get((name, 'error'), 0),
+                    'p50 (ms)': round(p50 * 1000, 2),
+                    'p95 (ms)': round(p95 * 1000, 2),
+                    'p99 (ms)': round(p99 * 1000, 2),
+                }
+                for (phase_callback, phase), phase_histogram in sorted(self.phases.items()):
+                    if phase_callback == name:
+                        row['{} p50 (ms)'.format(phase)] = round(phase_histogram.percentiles((50,))[0] * 1000, 2)
+                if name in self.sizes:
+                    row['Response p50 (KB)'] = round(self.sizes[name].percentiles((50,))[0] / 1024, 1)
+                rows.append(row)
+        return rows
+
+    def debug_panel(self, app, interval=2.0):
+        """
+        Layout for a small table of self.summary() that refreshes every `interval` seconds. Its own callback isn't
+        instrumented, so it doesn't show up in the numbers.
+        """
+        from dash import dash_table, dcc, html
+        from dash.dependencies import Input, Output
+
+        panel = html.Div([
+            html.H3('Callback Performance'),
+            dcc.Interval(id='callback-metrics-interval', interval=interval * 1000),
+            dash_table.DataTable(id='callback-metrics-table', style_cell={'font-family': 'helvetica', 'fontSize': 14}),
+            html.Div(['Prometheus metrics: ', html.A('/metrics', href=app.config.requests_pathname_prefix + 'metrics')])
+        ])
+
+        register = getattr(app.callback, '__wrapped__', app.callback)  # The un-instrumented app.callback
+        register(Output('callback-metrics-table', 'data'), Output('callback-metrics-table', 'columns'),
+                 Input('callback-metrics-interval', 'n_intervals'))(self._refresh_panel)
+        return panel
+
+    def _refresh_panel(self, n_intervals):
+        rows = self.summary()
+        columns = list(dict.fromkeys(key for row in rows for key in row))  # Every column any row has, in order
+        return rows, [{'name': column, 'id': column} for column in columns]
@@ -0,0 +1,157 @@
+"""
+Server-side downsampling for the power vs time graph.
+
+Sending every IV curve of a multi-day dataset to the browser makes the figure JSON huge and the graph sluggish, and the
+screen can't show more points than it has pixels anyway. These helpers pick which rows to send: Largest-Triangle-
+Three-Buckets (LTTB) keeps the visual shape of the series, min/max keeps the extremes of every pixel-wide bucket.
+
+Both return row indices rather than new x/y values, so the caller slices its own dataframe with them and every point
+that gets drawn is still a real IV curve (hovering a point pulls up exactly that curve). selection_mask goes the other
+way: for a box or lasso selection on the downsampled graph, it finds every row of the full series inside it.
+
+References:
+    * https://skemman.is/bitstream/1946/15343/3/SS_MSthesis.pdf (Steinarsson, "Downsampling Time Series for Visual
+      Representation", where LTTB comes from)
+    * https://dash.plotly.com/interactive-graphing (relayoutData, selectedData)
+
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def _as_float(values):
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype('datetime64[ns]').astype(np.int64).astype(np.float64)
+    return values.astype(np.float64)
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Indices of the n_out points that Largest-Triangle-Three-Buckets keeps out of the series (x, y). x must be sorted.
+    The first and last points are always kept. If the series already has n_out points or fewer, everything is kept.
+    """
+    x, y = _as_float(x), _as_float(y)
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # Bucket edges for the n_out - 2 middle buckets (the first and last point get a bucket of their own)
+    edges = (np.floor(np.arange(n_out - 1) * (n - 2) / (n_out - 2)) + 1).astype(np.int64)
+    edges[-1] = n - 1
+
+    # Average of each bucket, which is the third corner of the triangle for the bucket before it
+    sums_x = np.add.reduceat(x[:n - 1], edges[:-1])
+    sums_y = np.add.reduceat(y[:n - 1], edges[:-1])
+    counts = np.diff(edges)
+    avg_x = np.append(sums_x / counts, x[-1])[1:]
+    avg_y = np.append(sums_y / counts, y[-1])[1:]
+
+    # Each bucket's choice depends on the point picked in the bucket before it, so this loop is inherently sequential.
+    # It's only n_out iterations though (one per output point, not per input point).
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for bucket in range(n_out - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        area = np.abs((x[a] - avg_x[bucket]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y[bucket] - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[bucket + 1] = a
+    return selected
+
+
+def minmax_indices(x, y, n_buckets):
+    """
+    Indices of the min and max y value in each of n_buckets equal-width x buckets (so up to 2 * n_buckets points).
+    x must be sorted. Cheaper than LTTB and never hides a spike, but looks noisier.
+    """
+    x, y = _as_float(x), _as_float(y)
+    n = len(x)
+    if n <= 2 * n_buckets or n_buckets < 1:
+        return np.arange(n)
+
+    bucket = np.minimum(((x - x[0]) / max(x[-1] - x[0], 1e-300) * n_buckets).astype(np.int64), n_buckets - 1)
+    # Sort by (bucket, y). The first/last row of each bucket in that order is its min/max.
+    order = np.lexsort((y, bucket))
+    starts = np.flatnonzero(np.diff(bucket[order], prepend=-1))
+    stops = np.append(starts[1:], n) - 1
+    return np.unique(np.concatenate([order[starts], order[stops]]))
+
+
+def relayout_x_range(relayout_data, axis='xaxis'):
+    """
+    Pull the zoomed x range out of a graph's relayoutData. Returns (x0, x1), or None if the graph is showing the full
+    range (first render, double-click to reset, or autoscale).
+    """
+    if not relayout_data or relayout_data.get(axis + '.autorange'):
+        return None
+    if axis + '.range[0]' in relayout_data:
+        return relayout_data[axis + '.range[0]'], relayout_data[axis + '.range[1]']
+    if axis + '.range' in relayout_data:
+        return tuple(relayout_data[axis + '.range'])
+    return None
+
+
+def changes_x_range(relayout_data, axis='xaxis'):
+    """True if this relayoutData event zoomed, panned or reset the x axis (as opposed to e.g. a y-only zoom)."""
+    return bool(relayout_data) and any(key.startswith(axis + '.') for key in relayout_data)
+
+
+def selection_mask(x, y, selected_data):
+    """
+    Which of the points (x, y) are inside the box or lasso outline of a graph's selectedData. On a downsampled graph,
+    that's every row of the full series that the selection covers, not just the points that happened to be drawn.
+    Returns None if selected_data has no outline (nothing selected, or points picked one by one).
+    """
+    if not selected_data or not ('range' in selected_data or 'lassoPoints' in selected_data):
+        return None
+    x, y = np.asarray(x), _as_float(y)
+    outline = selected_data['range'] if 'range' in selected_data else selected_data['lassoPoints']
+    outline_x = outline['x']
+    if np.issubdtype(x.dtype, np.datetime64):
+        outline_x = pd.to_datetime(outline_x).to_numpy()
+    outline_x, outline_y = _as_float(outline_x), _as_float(outline['y'])
+    x = _as_float(x)
+
+    # Both kinds of outline have a bounding box, which is all there is to a box selection
+    inside = (x >= outline_x.min()) & (x <= outline_x.max()) & (y >= outline_y.min()) & (y <= outline_y.max())
+    if 'range' in selected_data:
+        return inside
+
+    # Lasso: even-odd rule, counting how many edges of the outline a ray from each point (in the box) to the right
+    # crosses. The loop is over the edges, each one checked against every point at once.
+    candidates = np.flatnonzero(inside)
+    px, py = x[candidates] - outline_x[0], y[candidates]  # Relative to the outline, so datetimes keep their precision
+    vx, vy = outline_x - outline_x[0], outline_y
+    crossings = np.zeros(len(candidates), dtype=bool)
+    for i in range(len(vx)):
+        x0, y0, x1, y1 = vx[i - 1], vy[i - 1], vx[i], vy[i]
+        if y0 == y1:
+            continue  # A horizontal edge can't be crossed by a horizontal ray
+        spans = (y0 > py) != (y1 > py)
+        crossings ^= spans & (px < x0 + (py - y0) * (x1 - x0) / (y1 - y0))
+    inside[candidates] = crossings
+    return inside
+
+
+def downsample_window(df, x_col, y_col, x_range=None, max_points=1000, method='lttb'):
+    """
+    Slice df (sorted by x_col) to the visible x_range and downsample it to about max_points rows.
+    Returns (the downsampled rows of df in order, the number of rows in the visible window before downsampling).
+    """
+    x = df[x_col].to_numpy()
+    if x_range is not None:
+        lo, hi = x_range
+        if np.issubdtype(x.dtype, np.datetime64):
+            lo, hi = pd.Timestamp(lo).to_datetime64(), pd.Timestamp(hi).to_datetime64()
+        start, stop = np.searchsorted(x, lo, side='left'), np.searchsorted(x, hi, side='right')
+        df = df.iloc[start:stop]
+        x = x[start:stop]
+
+    y = df[y_col].to_numpy()
+    if method == 'minmax':
+        indices = minmax_indices(x, y, max_points // 2)
+    else:
+        indices = lttb_indices(x, y, max_points)
+    return df.iloc[indices], len(x)
@@ -0,0 +1,114 @@
+"""
+Bounded LRU cache for what the callbacks build: figures, the trace data of figures, table rows.
+
+Hovering back and forth asks for the same IV curves over and over, and building them costs far more than looking them
+up. Entries are capped by count and by an estimate of their JSON size, with hit/miss/eviction counts for checking it
+actually helps.
+
+References:
+    * https://docs.python.org/3/library/collections.html#collections.OrderedDict (move_to_end/popitem for LRU)
+    * https://dash.plotly.com/performance (memoization)
+
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Rough JSON size of one number. Floats come out with up to 17 digits (float32 data especially: 0.11297070980072021),
+# integers and everything else (timestamps, bools) are mostly short.
+JSON_FLOAT_BYTES = 20
+JSON_NUMBER_BYTES = 8
+
+
+def estimate_nbytes(value):
+    """
+    Rough JSON size of value without serializing it (array numbers, string lengths, containers summed). Within a factor
+    of ~2, which is all a cap on cache memory needs.
+    """
+    if isinstance(value, np.ndarray):
+        return value.size * (JSON_FLOAT_BYTES if value.dtype.kind in 'fc' else JSON_NUMBER_BYTES)
+    if isinstance(value, (str, bytes)):
+        return len(value) + 2
+    if isinstance(value, dict):
+        return sum(len(str(key)) + 3 + estimate_nbytes(item) for key, item in value.items()) + 2
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_nbytes(item) for item in value) + len(value) + 2
+    if isinstance(value, float):
+        return JSON_FLOAT_BYTES
+    return JSON_NUMBER_BYTES
+
+
+class FigureCache:
+    """
+    Thread-safe LRU cache capped at max_entries values and max_bytes of estimated JSON size (None skips sizing, for
+    small values like table rows).
+    """
+
+    def __init__(self, max_entries=512, max_bytes=64 * 2**20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, estimated size in bytes). Most recently used at the end.
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, fig_dict):
+        if hasattr(fig_dict, 'to_dict'):
+            fig_dict = fig_dict.to_dict()  # Plotly figure objects get stored as plain dicts
+        nbytes = estimate_nbytes(fig_dict) if self.max_bytes is not None else 0
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if self.max_bytes is not None and nbytes > self.max_bytes:
+                return fig_dict  # Too big to ever fit, so don't wipe out the whole cache trying
+            self._entries[key] = (fig_dict, nbytes)
+            self.nbytes += nbytes
+            while len(self._entries) > self.max_entries or \
+                    (self.max_bytes is not None and self.nbytes > self.max_bytes):
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_bytes
+                self.evictions += 1
+        return fig_dict
+
+    def get_or_build(self, key, build):
+        """Return the cached value for key, or call build() to make it, cache it and return it."""
+        fig_dict = self.get(key)
+        if fig_dict is None:
+            fig_dict = self.put(key, build())
+        return fig_dict
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.nbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
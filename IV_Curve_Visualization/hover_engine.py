@@ -0,0 +1,292 @@
+"""
+Master/detail hover for Dash: a scatter plot whose hoverData picks the point that a set of detail outputs show (a
+figure of that point, its table row, a text pane of its stats).
+
+PointTable looks up hovered points by key without slicing the dataframe, HoverDetails serves all the detail outputs
+from one cached callback, and Prefetcher builds the points around the hovered one in the background.
+
+References:
+    * https://dash.plotly.com/interactive-graphing (hoverData)
+    * https://dash.plotly.com/performance (memoization)
+    * https://pandas.pydata.org/docs/reference/api/pandas.Index.get_indexer.html
+
+"""
+
+import contextlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import dash
+import numpy as np
+import pandas as pd
+from dash.dependencies import Input
+
+
+def hover_value(hoverData, field='hovertext', default=None):
+    """One field ('pointIndex', 'hovertext', 'customdata', ...) of the hovered point, or default if there isn't one."""
+    try:
+        return hoverData['points'][0][field]
+    except (TypeError, KeyError, IndexError):
+        return default
+
+
+def hover_field(field='pointIndex', default=None):
+    """Key function for HoverDetails that uses one field of the hovered point as its key."""
+    return lambda hoverData, *values: hover_value(hoverData, field, default)
+
+
+class PointTable:
+    """
+    The columns of a dataframe with one row per point, and each point's key hashed to its row. keys is the key
+    columns, or None to look points up by their position (row number) instead.
+    """
+
+    def __init__(self, df, keys=None):
+        self.df = df.reset_index(drop=True)
+        self.columns = {name: self.df[name].to_numpy() for name in self.df.columns}
+        self.keys = tuple(keys) if keys is not None else None
+        if self.keys:
+            index = pd.MultiIndex.from_arrays([self.columns[key] for key in self.keys])
+            first = ~index.duplicated()  # A key that's in there twice finds its first row
+            self._index = index[first]
+            self._rows = np.flatnonzero(first)
+            self._integer_keys = [np.issubdtype(self.columns[key].dtype, np.integer) for key in self.keys]
+
+    def __len__(self):
+        return len(self.df)
+
+    def __contains__(self, key):
+        return self.locate_one(key) >= 0
+
+    def locate(self, keys):
+        """
+        Row number of each of keys (a list of key tuples, of single keys if there's one key column, or of positions),
+        -1 where there's no such point.
+        """
+        keys = list(keys)
+        if len(keys) == 1:
+            return np.array([self.locate_one(keys[0])], dtype=np.int64)  # A hover: skip building arrays
+        if not self.keys:
+            return self.locate_columns([keys])
+        keys = [key if isinstance(key, tuple) else (key,) for key in keys]
+        columns = pd.DataFrame.from_records(keys, columns=range(len(self.keys)), coerce_float=False) if keys \
+            else pd.DataFrame(columns=range(len(self.keys)))
+        return self.locate_columns([columns[i] for i in range(len(self.keys))])
+
+    def locate_columns(self, columns):
+        """locate, with the keys given column-wise: one array per key column (just the positions, without keys)."""
+        if not self.keys:
+            positions = _to_numbers(columns[0])
+            ok = np.isfinite(positions) & (positions >= 0) & (positions < len(self.df)) & (positions % 1 == 0)
+            return np.where(ok, positions, -1).astype(np.int64)
+
+        valid = np.ones(len(columns[0]), dtype=bool)
+        arrays = []
+        for values, is_integer in zip(columns, self._integer_keys):
+            if is_integer:
+                # Hover data comes back from the browser as JSON, so integer keys may show up as floats or strings
+                numbers = _to_numbers(values)
+                valid &= np.isfinite(numbers)
+                values = np.where(np.isfinite(numbers), numbers, 0).astype(np.int64)
+            arrays.append(np.asarray(values))
+        found = self._index.get_indexer(pd.MultiIndex.from_arrays(arrays))
+        return np.where(valid & (found >= 0), self._rows[found], -1).astype(np.int64)
+
+    def locate_one(self, key):
+        """Row number of one point (-1 if there's no such point). What a hover needs, with a single hash lookup."""
+        key = key if isinstance(key, tuple) or not self.keys else (key,)
+        try:
+            if not self.keys:
+                row = float(key)
+                return int(row) if 0 <= row < len(self.df) and row % 1 == 0 else -1
+            key = tuple(int(float(part)) if is_integer else part for part, is_integer in zip(key, self._integer_keys))
+            return int(self._rows[self._index.get_loc(key)]) if len(key) == len(self.keys) else -1
+        except (KeyError, TypeError, ValueError):
+            return -1
+
+    def take(self, keys, columns=None):
+        """
+        Many points at once: dict of column -> values of every point in keys that exists (in the order of keys), and
+        a boolean array of which keys did.
+        """
+        rows = self.locate(keys)
+        found = rows >= 0
+        return {name: self.columns[name][rows[found]] for name in (columns or self.columns)}, found
+
+    def record(self, key):
+        """Dict of column -> value of one point, or None if there's no such point."""
+        row = self.locate_one(key)
+        if row < 0:
+            return None
+        return {name: values[row] for name, values in self.columns.items()}
+
+    def frame(self, keys):
+        """The rows of the points in keys that exist, as a dataframe (e.g. for a DataTable)."""
+        rows = self.locate(keys)
+        return self.df.iloc[rows[rows >= 0]]
+
+
+def _to_numbers(values):
+    values = np.asarray(values)
+    if values.dtype.kind in 'iuf':
+        return values.astype(np.float64)
+    return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=np.float64)
+
+
+class HoverDetails:
+    """
+    Outputs showing the point hovered on one graph, all updated by one callback. key(hoverData, *values) gives the
+    hovered key (or None); with `points` each build gets that point's record, otherwise the key.
+    """
+
+    def __init__(self, app, graph_id, key=None, points=None, inputs=(), states=(), cache=None, metrics=None,
+                 prefetch=None):
+        self.app = app
+        self.graph_id = graph_id
+        self.key = key or hover_field()
+        self.points = points
+        self.inputs = list(inputs)
+        self.states = list(states)
+        self.cache = cache
+        self.metrics = metrics  # A CallbackMetrics, to split the callback's time into 'data' and 'render'
+        self.prefetch = prefetch
+        self.details = []  # (Output, build, render, cached)
+
+    def add(self, output, build, render=None, cached=True):
+        """
+        Show build(point) in output, through render(built, initial, *values) if given. Returns self, so adds can be
+        chained.
+        """
+        self.details.append((output, build, render, cached))
+        return self
+
+    def _phase(self, name):
+        return self.metrics.phase(name) if self.metrics is not None else contextlib.nullcontext()
+
+    def _cache_key(self, output, key):
+        return output.component_id, output.component_property, key
+
+    def _build(self, output, build, cached, key, point):
+        if self.cache is None or not cached:
+            return build(point)
+        return self.cache.get_or_build(self._cache_key(output, key), lambda: build(point))
+
+    def _lookup(self, key):
+        # The point for key (the key itself without points), or None if there's no such point
+        if key is None or self.points is None:
+            return key
+        points = self.points() if callable(self.points) else self.points
+        return points.record(key)
+
+    def warm(self, key):
+        """Build and cache every cached output of the point key, if it isn't cached yet. What Prefetcher runs."""
+        if self.cache is None:
+            return 0
+        missing = [(output, build) for output, build, _, cached in self.details
+                   if cached and self._cache_key(output, key) not in self.cache]
+        point = self._lookup(key) if missing else None
+        if point is None:
+            return 0
+        for output, build in missing:
+            self.cache.put(self._cache_key(output, key), build(point))
+        return len(missing)
+
+    def update(self, hoverData, *values):
+        """Every output's value for this hover (just the one value if there's only one output)."""
+        initial = not dash.callback_context.triggered
+
+        with self._phase('data'):
+            key = self.key(hoverData, *values)
+            point = self._lookup(key)
+            key = key if point is not None else None
+            built = [self._build(output, build, cached, key, point) if key is not None else None
+                     for output, build, _, cached in self.details]
+            if key is not None and self.prefetch is not None:
+                self.prefetch.submit(self, key)
+
+        with self._phase('render'):
+            results = []
+            for (_, _, render, _), value in zip(self.details, built):
+                if render is not None:
+                    results.append(render(value, initial, *values))
+                else:
+                    results.append(value if key is not None else dash.no_update)
+        return results[0] if len(results) == 1 else results
+
+    def register(self, name=None):
+        """
+        Register the callback on the app. Returns it, so it can also be called directly (e.g. by benchmark.py).
+        name is what it goes by in the callback metrics.
+        """
+        def callback(hoverData, *values):
+            return self.update(hoverData, *values)
+
+        callback.__name__ = name or 'update_{}_hover'.format(self.graph_id.replace('-', '_'))
+        outputs = [output for output, _, _, _ in self.details]
+        return self.app.callback(*outputs, Input(self.graph_id, 'hoverData'), *self.inputs, *self.states)(callback)
+
+
+class Prefetcher:
+    """
+    Builds the cached outputs of neighbors(key) (nearest first) on a small thread pool after each hover. Only the latest
+    max_pending hovers are kept waiting, and a point is never queued twice.
+    """
+
+    def __init__(self, neighbors, max_workers=2, max_pending=8):
+        self.neighbors = neighbors
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = None  # Started on the first hover, so a server that forks after loading doesn't fork threads
+        self._pending = OrderedDict()  # (id(details), key) -> Future, oldest first
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.dropped = 0
+        self.built = 0
+        self.errors = 0
+
+    def submit(self, details, key):
+        """Queue warming the neighbors of key in details. Returns straight away."""
+        job = (id(details), key)
+        with self._lock:
+            if job in self._pending:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='hover-prefetch')
+            stale = [self._pending.popitem(last=False)[1] for _ in range(len(self._pending) - self.max_pending + 1)]
+            self.submitted += 1
+            self._pending[job] = future = self._executor.submit(self._warm, details, key)
+        # Outside the lock, since cancelling runs the done callback (_forget) right away
+        dropped = sum(stale_future.cancel() for stale_future in stale)
+        future.add_done_callback(lambda _: self._forget(job, future))
+        if dropped:
+            with self._lock:
+                self.dropped += dropped
+
+    def _forget(self, job, future):
+        with self._lock:
+            if self._pending.get(job) is future:
+                del self._pending[job]
+
+    def _warm(self, details, key):
+        built = errors = 0
+        try:
+            for neighbor in self.neighbors(key):
+                built += details.warm(neighbor)
+        except Exception:  # A point that can't be built now just gets built (or fails properly) when it's hovered
+            errors = 1
+        with self._lock:
+            self.built += built
+            self.errors += errors
+
+    def wait(self):
+        """Block until everything queued so far has been warmed (e.g. for benchmarks)."""
+        with self._lock:
+            futures = list(self._pending.values())
+        for future in futures:
+            if not future.cancelled():
+                future.exception()
+
+    def stats(self):
+        return {'submitted': self.submitted, 'dropped': self.dropped, 'built': self.built, 'errors': self.errors,
+                'pending': len(self._pending)}
@@ -0,0 +1,258 @@
+"""
+Automatic flagging of abnormal IV curves, run in the background after the data is loaded.
+
+Instead of hovering over curve after curve looking for odd ones, every curve gets checked for:
+    * Bypass diode steps: a partially shaded panel has its bypass diodes switch on part way along the sweep, which puts
+      a step (steep drop, then flat again) in the middle of the curve. A healthy curve only gets steeper with voltage.
+    * Shading: Isc well below the other MPPTs' at the same time, while the rest of the car sees full sun.
+    * Fill factor drops: FF well below the same MPPT's curves just before and after it.
+    * Outliers: Pmax far from the same MPPT's neighbours in time, or from the other MPPTs at the same time (robust
+      z-scores, median/MAD, so a few bad curves don't hide each other).
+
+Steps need the raw points, so that part runs over the curve store in chunks of curves (padded arrays, like
+iv_extract.py) on a thread pool. Each curve is binned onto a grid of V/Voc and its current normalized by Isc, which
+smooths out the sampling noise and the uneven point spacing of the real sweeps. Current going back up partway through
+cancels a step, since that's the light changing mid-sweep rather than a diode. The rest only needs the fitted params.
+
+AnomalyScan runs all of it in a background thread and hands back one row of results per row of params, so the
+dashboard starts straight away and picks the flags up when they're ready.
+
+How to use this:
+    anomaly_scan = AnomalyScan(curve_index, extract_iv_params(curve_index)).start()
+    anomaly_scan.add_done_callback(lambda anomalies: ...)  # anomalies: dataframe of ANOMALY_COLUMNS, same index
+    anomaly_scan.result  # None until it's done
+    anomaly_scan.error  # The exception, if the scan (or a done callback) failed. It's logged as well.
+
+References:
+    * https://www.pveducation.org/pvcdrom/modules-and-arrays/bypass-diodes
+    * https://www.pveducation.org/pvcdrom/solar-cell-operation/fill-factor
+    * https://en.wikipedia.org/wiki/Median_absolute_deviation
+
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from iv_extract import pad_curves
+
+logger = logging.getLogger(__name__)
+
+# Steps: each curve's current (as a fraction of Isc) gets averaged into this many bins of V/Voc. A step is a bin that
+# drops by more than STEP_DROP, followed by one that drops by less than FLAT_DROP while still carrying more than
+# STEP_FLOOR of Isc (i.e. before the real knee near Voc).
+STEP_BINS = 20
+STEP_DROP = 0.15
+FLAT_DROP = 0.03
+STEP_FLOOR = 0.2
+
+# Neighbours: curves of the same MPPT in a centered window of this many, and other MPPTs within the same time bucket
+NEIGHBOR_CURVES = 9
+PEER_WINDOW = '1min'
+
+# Thresholds for flagging
+OUTLIER_Z = 4.0  # Robust z-score of Pmax
+FF_DROP = 0.08  # Below the neighbours' median fill factor by this much
+SHADING_RATIO = 0.7  # Isc below this fraction of the other MPPTs' median
+
+CHUNK_CURVES = 5000  # Curves per chunk of the step scan
+
+ANOMALY_COLUMNS = ['n_steps', 'ff_drop', 'time_z', 'peer_z', 'isc_ratio', 'anomaly']
+
+
+def binned_profile(voltage, current, lengths, isc, voc, n_bins=STEP_BINS):
+    """
+    (curves x n_bins) mean current / Isc in each bin of V / Voc, for the padded (curves x points) arrays from
+    pad_curves. NaN for bins without any points, and for curves without a usable Isc/Voc. (Filling the gaps in would
+    make up flat stretches that were never measured, and sparse sweeps have a lot of gaps.)
+    """
+    n_curves, width = voltage.shape
+    valid = np.arange(width)[None, :] < lengths[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bins = np.clip(np.floor(voltage / voc[:, None] * n_bins), 0, n_bins - 1)
+        ok = valid & np.isfinite(bins) & np.isfinite(current)
+        normalized = current / isc[:, None]
+
+    # Per (curve, bin) sums and counts with one bincount over flat cell numbers
+    cells = (np.arange(n_curves)[:, None] * n_bins + np.where(ok, bins, 0).astype(np.int64))[ok]
+    sums = np.bincount(cells, weights=normalized[ok], minlength=n_curves * n_bins).reshape(n_curves, n_bins)
+    counts = np.bincount(cells, minlength=n_curves * n_bins).reshape(n_curves, n_bins)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        profile = sums / counts
+    usable = np.isfinite(isc) & np.isfinite(voc) & (isc > 0) & (voc > 0)
+    return np.where(usable[:, None], profile, np.nan)
+
+
+def count_steps(profile, step_drop=STEP_DROP, flat_drop=FLAT_DROP, step_floor=STEP_FLOOR):
+    """Number of steps (a steep drop followed by a flat stretch, see the top of the file) in each binned profile."""
+    # Compare each bin that has points with the next one that does (empty bins moved to the end of each row), as the
+    # drop per bin of V/Voc, so a rise hidden behind a gap in the sweep still counts
+    order = np.argsort(np.isnan(profile), axis=1, kind='stable')
+    values = np.take_along_axis(profile, order, axis=1)
+    total = values[:, :-1] - values[:, 1:]  # NaN past the last filled bin, so none of the below
+    with np.errstate(invalid='ignore'):
+        drop = total / (order[:, 1:] - order[:, :-1])
+
+    steep = drop > step_drop
+    rise = total < -flat_drop  # Current going back up: noise or changing light, not a step, so it resets the search
+    flat = (np.abs(drop) < flat_drop) & ~rise & (values[:, 1:] > step_floor)
+
+    # State of each bin pair (+1 steep, -1 flat, 2 rise, 0 none of those), carried forward over the 0s. A step is every
+    # flat pair whose last non-neutral pair before it was steep.
+    state = steep.astype(np.int8) - flat.astype(np.int8) + 2 * rise.astype(np.int8)
+    positions = np.arange(state.shape[1])[None, :]
+    last = np.maximum.accumulate(np.where(state != 0, positions, -1), axis=1)
+    previous = np.concatenate([np.full((len(state), 1), -1), last[:, :-1]], axis=1)
+    previous_state = np.where(previous >= 0, np.take_along_axis(state, np.maximum(previous, 0), axis=1), 0)
+    return ((state == -1) & (previous_state == 1)).sum(axis=1)
+
+
+def scan_steps(curve_index, isc, voc, start, stop):
+    """Step counts of curves start:stop of a CurveIndex (see iv_store.py), in index order."""
+    store = curve_index.store
+    starts, stops = curve_index.starts[start:stop], curve_index.stops[start:stop]
+    voltage, current, lengths = pad_curves(starts, stops, np.asarray(store['voltage'], dtype=np.float64),
+                                           np.asarray(store['current'], dtype=np.float64))
+    return count_steps(binned_profile(voltage, current, lengths, isc[start:stop], voc[start:stop]))
+
+
+def _robust_z(values, center, spread):
+    # MAD scaled to match a standard deviation, floored so near-identical neighbours don't make everything an outlier
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (values - center) / np.maximum(1.4826 * spread, 0.01 * np.abs(center) + 1e-9)
+
+
+def neighbor_scores(params, time_col='time', group_cols=('day', 'mppt_id'), window=NEIGHBOR_CURVES,
+                    peer_window=PEER_WINDOW):
+    """
+    Comparisons of each curve's params against its neighbours, as a dataframe with params' index:
+        * ff_drop: median fill factor of the same MPPT's `window` nearest curves in time, minus this curve's
+        * time_z: robust z-score of Pmax against those same curves
+        * peer_z: robust z-score of Pmax against every MPPT's curves in the same peer_window time bucket
+        * isc_ratio: Isc over the median Isc of that time bucket
+    group_cols are the columns that make up one MPPT's series. The peers are grouped by all but the last of them.
+    """
+    group_cols = list(group_cols)
+    df = params[[time_col, 'ff', 'pmp', 'isc'] + group_cols].sort_values(group_cols + [time_col], kind='stable')
+    scores = pd.DataFrame(index=df.index)
+
+    # Same MPPT, neighbours in time (centered rolling medians, which pandas does in C)
+    def rolling_median(series):
+        return series.groupby([df[col] for col in group_cols], sort=False) \
+            .transform(lambda s: s.rolling(window, center=True, min_periods=1).median())
+
+    scores['ff_drop'] = rolling_median(df['ff']) - df['ff']
+    pmp_median = rolling_median(df['pmp'])
+    scores['time_z'] = _robust_z(df['pmp'], pmp_median, rolling_median((df['pmp'] - pmp_median).abs()))
+
+    # Other MPPTs at the same time
+    peers = [df[col] for col in group_cols[:-1]] + [df[time_col].dt.floor(peer_window)]
+    n_peers = df['pmp'].groupby(peers).transform('count')
+    peer_median = df['pmp'].groupby(peers).transform('median')
+    peer_mad = (df['pmp'] - peer_median).abs().groupby(peers).transform('median')
+    enough = n_peers >= 3  # A median of one or two curves doesn't say much
+    scores['peer_z'] = _robust_z(df['pmp'], peer_median, peer_mad).where(enough)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores['isc_ratio'] = (df['isc'] / df['isc'].groupby(peers).transform('median')).where(enough)
+    return scores.reindex(params.index)
+
+
+def label_anomalies(anomalies, outlier_z=OUTLIER_Z, ff_drop=FF_DROP, shading_ratio=SHADING_RATIO):
+    """Comma-separated names of everything flagged on each row ('' if nothing was)."""
+    flags = {
+        'bypass step': anomalies['n_steps'].to_numpy() > 0,
+        'shading': anomalies['isc_ratio'].to_numpy() < shading_ratio,
+        'fill factor drop': anomalies['ff_drop'].to_numpy() > ff_drop,
+        'outlier (time)': np.abs(anomalies['time_z'].to_numpy()) > outlier_z,
+        'outlier (MPPTs)': np.abs(anomalies['peer_z'].to_numpy()) > outlier_z,
+    }
+    labels = np.full(len(anomalies), '', dtype=object)
+    for name, flagged in flags.items():
+        labels[flagged] = labels[flagged] + np.where(labels[flagged] == '', '', ', ') + name
+    return labels
+
+
+def detect_anomalies(curve_index, params, executor=None, chunk_curves=CHUNK_CURVES):
+    """
+    Everything above for every curve. params is extract_iv_params(curve_index) (one row per curve, in index order).
+    Returns a dataframe of ANOMALY_COLUMNS with params' index. The step scan chunks get mapped over `executor` if
+    given, otherwise they run one after another.
+    """
+    if len(params) != len(curve_index):
+        raise ValueError('params has {} rows but the index has {} curves'.format(len(params), len(curve_index)))
+    isc, voc = params['isc'].to_numpy(dtype=np.float64), params['voc'].to_numpy(dtype=np.float64)
+    chunks = [(start, min(start + chunk_curves, len(params))) for start in range(0, len(params), chunk_curves)]
+    run = executor.map if executor is not None else map
+    steps = list(run(lambda chunk: scan_steps(curve_index, isc, voc, *chunk), chunks))
+
+    anomalies = neighbor_scores(params, group_cols=list(curve_index.keys[:-1]))
+    anomalies.insert(0, 'n_steps', np.concatenate(steps) if steps else np.zeros(0, dtype=np.int64))
+    anomalies['anomaly'] = label_anomalies(anomalies)
+    return anomalies[ANOMALY_COLUMNS]
+
+
+class AnomalyScan:
+    """detect_anomalies in a background thread, with its step scan spread over a thread pool."""
+
+    def __init__(self, curve_index, params, max_workers=None, chunk_curves=CHUNK_CURVES):
+        self.curve_index = curve_index
+        self.params = params
+        self.max_workers = max_workers
+        self.chunk_curves = chunk_curves
+        self.result = None  # Dataframe of ANOMALY_COLUMNS once it's done
+        self.error = None
+        self._finished = False  # Result is in (the done callbacks may still be running)
+        self._done = threading.Event()  # Done callbacks have run too
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._run, name='iv-anomaly-scan', daemon=True).start()
+        return self
+
+    def _run(self):
+        try:
+            # NumPy lets go of the GIL for the big array operations, so the chunks overlap on a thread pool without
+            # copying the curve store into other processes
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                result = detect_anomalies(self.curve_index, self.params, executor, self.chunk_curves)
+        except Exception as error:  # Keep the dashboard up without the flags, but say so
+            logger.exception('Anomaly scan failed, no curves will be flagged')
+            self.error = error
+            result = None
+        with self._lock:
+            self.result = result
+            self._finished = True
+            callbacks, self._callbacks = self._callbacks, []
+        try:
+            if result is not None:
+                for callback in callbacks:
+                    callback(result)
+        except Exception as error:
+            logger.exception('Using the anomaly scan results failed')
+            self.error = error
+        finally:
+            # Only now, so that whatever waits on the scan (e.g. serve.py, before forking) also sees what the callbacks
+            # did with the result
+            self._done.set()
+
+    def add_done_callback(self, callback):
+        """Call callback(result) when the scan finishes (straight away if it already has). Not called on errors."""
+        with self._lock:
+            if not self._finished:
+                self._callbacks.append(callback)
+                return
+        if self.result is not None:
+            callback(self.result)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the scan and its done callbacks finish. Returns the result (None if it failed or timed out)."""
+        self._done.wait(timeout)
+        return self.result
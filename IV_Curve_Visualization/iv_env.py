@@ -0,0 +1,157 @@
+"""
+Environmental data for the IV curves: joins weather and car telemetry logs onto iv_params by time, and normalizes
+Pmax/Isc/Voc to standard test conditions (STC) with the joined irradiance and temperature.
+
+Each IV curve gets the log row nearest to its start time, as long as that's within the log's tolerance (a weather
+station that logs every 5 minutes can have a tolerance of a few minutes, telemetry at 1 Hz only a few seconds). Curves
+with nothing close enough get NaN rather than a stale value. Like pd.merge_asof(direction='nearest', tolerance=...),
+but done straight on the sorted time arrays with np.searchsorted, so every curve of every day is joined in one pass.
+
+Logs are CSV, NDJSON (.ndjson/.jsonl) or Excel files with a 'time' column plus any of:
+    irradiance (W/m^2), temperature (ambient, C), cell_temperature (C), speed (km/h), sun_angle (degrees), cloud_cover
+Other columns come along too. When several logs have the same column, the first one listed wins wherever it has a
+value. Each log is parsed once and cached as columns next to it, the same way as the IV workbooks (see iv_store.py).
+
+STC is 1000 W/m^2 and 25 C cell temperature. Isc and Pmax scale with irradiance, and all three get a linear
+temperature correction:
+    Isc_stc = Isc * (1000 / G) / (1 + alpha * (T - 25))
+    Voc_stc = Voc / (1 + beta * (T - 25))
+    Pmax_stc = Pmax * (1000 / G) / (1 + gamma * (T - 25))
+Voc is left uncorrected for irradiance, which only changes it logarithmically. If a log only has the ambient
+temperature, the cell temperature is estimated from the NOCT model, T_cell = T_ambient + (NOCT - 20) / 800 * G. Curves
+under MIN_IRRADIANCE get NaN, since dividing by a tiny G just blows up the noise.
+
+How to use this:
+    env = EnvironmentLogs.load([{'path': 'data/weather_day_5.csv', 'tolerance': '5min'},
+                                {'path': 'data/telemetry_day_5.csv', 'tolerance': '10s'}])
+    conditions = env.join(iv_params['time'])  # One row per curve, NaN where no log was close enough
+    stc = stc_normalize(iv_params['pmp'], iv_params['isc'], iv_params['voc'], conditions['irradiance'],
+                        cell_temperature(conditions['temperature'], conditions['irradiance']))
+
+References:
+    * https://pandas.pydata.org/docs/reference/api/pandas.merge_asof.html
+    * https://www.pveducation.org/pvcdrom/modules-and-arrays/nominal-operating-cell-temperature
+    * https://www.pveducation.org/pvcdrom/solar-cell-operation/effect-of-temperature
+    * IEC 60891 (procedures for temperature and irradiance corrections to measured I-V characteristics)
+
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from iv_store import load_iv_curves
+
+STC_IRRADIANCE = 1000.0  # W/m^2
+STC_TEMPERATURE = 25.0  # C
+
+# Temperature coefficients (fraction per C) of monocrystalline silicon cells. Replace with the datasheet values.
+ISC_TEMP_COEFF = 0.0005
+VOC_TEMP_COEFF = -0.0027
+PMAX_TEMP_COEFF = -0.0035
+
+NOCT = 45.0  # Nominal operating cell temperature (C), for estimating cell temperature from the ambient one
+MIN_IRRADIANCE = 100.0  # W/m^2. Below this the STC values are NaN.
+
+DEFAULT_TOLERANCE = '1min'
+
+
+def read_log_file(path):
+    """Parse one log into a dataframe (CSV, NDJSON or Excel, by extension) with 'time' as datetimes."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.ndjson', '.jsonl'):
+        df = pd.read_json(path, lines=True)
+    elif extension in ('.xlsx', '.xls'):
+        df = pd.read_excel(path)
+    else:
+        df = pd.read_csv(path)
+    df['time'] = pd.to_datetime(df['time'])
+    return df
+
+
+def asof_indices(times, log_times, tolerance):
+    """
+    For each of `times`, the index of the nearest of `log_times` (sorted), or -1 if the nearest one is further away
+    than `tolerance`. Ties go to the earlier log row.
+    """
+    times = np.asarray(times, dtype='datetime64[ns]')
+    log_times = np.asarray(log_times, dtype='datetime64[ns]')
+    if not len(log_times):
+        return np.full(len(times), -1, dtype=np.int64)
+
+    # The log rows on either side of each time, then whichever of the two is closer
+    after = np.clip(np.searchsorted(log_times, times, side='left'), 0, len(log_times) - 1)
+    before = np.maximum(after - 1, 0)
+    gap_before = np.abs(times - log_times[before])
+    gap_after = np.abs(log_times[after] - times)
+    nearest = np.where(gap_before <= gap_after, before, after)
+    gap = np.minimum(gap_before, gap_after)
+
+    ok = (gap <= pd.Timedelta(tolerance).to_timedelta64()) & ~np.isnat(times)
+    return np.where(ok, nearest, -1).astype(np.int64)
+
+
+class EnvironmentLogs:
+    """Time-sorted environment logs, each with the tolerance it gets joined with."""
+
+    def __init__(self, logs):
+        self.logs = []  # (dict of column name -> array sorted by time, tolerance)
+        for columns, tolerance in logs:
+            order = np.argsort(np.asarray(columns['time'], dtype='datetime64[ns]'), kind='stable')
+            self.logs.append(({name: np.asarray(values)[order] for name, values in columns.items()}, tolerance))
+
+    @classmethod
+    def load(cls, specs, use_cache=True):
+        """
+        Load logs from a list of {'path': ..., 'tolerance': ...} dicts (tolerance is anything pd.Timedelta takes,
+        default DEFAULT_TOLERANCE), through the columnar cache.
+        """
+        logs = []
+        for spec in specs:
+            store = load_iv_curves(spec['path'], use_cache=use_cache, reader=read_log_file)
+            logs.append(({name: store[name] for name in store.columns}, spec.get('tolerance', DEFAULT_TOLERANCE)))
+        return cls(logs)
+
+    @property
+    def columns(self):
+        """Every column any log has (besides time), in the order the logs list them."""
+        return list(dict.fromkeys(name for columns, _ in self.logs for name in columns if name != 'time'))
+
+    def join(self, times):
+        """
+        One row per time (same order, plain RangeIndex) with every log column: the value from the nearest row of
+        the first log that has one within its tolerance, NaN otherwise.
+        """
+        times = np.asarray(times, dtype='datetime64[ns]')
+        joined = {}
+        for columns, tolerance in self.logs:
+            rows = asof_indices(times, columns['time'], tolerance)
+            matched = rows >= 0
+            for name, values in columns.items():
+                if name == 'time':
+                    continue
+                picked = pd.Series(values[np.maximum(rows, 0)] if len(values) else np.full(len(times), np.nan))
+                picked = picked.where(matched)
+                joined[name] = picked if name not in joined else joined[name].combine_first(picked)
+        return pd.DataFrame(joined, index=pd.RangeIndex(len(times)))
+
+
+def cell_temperature(ambient, irradiance, noct=NOCT):
+    """Cell temperature (C) estimated from the ambient temperature and irradiance with the NOCT model."""
+    return np.asarray(ambient, dtype=np.float64) + (noct - 20.0) / 800.0 * np.asarray(irradiance, dtype=np.float64)
+
+
+def stc_normalize(pmp, isc, voc, irradiance, cell_temp, isc_coeff=ISC_TEMP_COEFF, voc_coeff=VOC_TEMP_COEFF,
+                  pmax_coeff=PMAX_TEMP_COEFF, min_irradiance=MIN_IRRADIANCE):
+    """Pmax, Isc and Voc corrected to STC (see the top of the file), as a dict of arrays: pmp_stc, isc_stc, voc_stc."""
+    pmp, isc, voc = (np.asarray(x, dtype=np.float64) for x in (pmp, isc, voc))
+    irradiance = np.asarray(irradiance, dtype=np.float64)
+    dt = np.asarray(cell_temp, dtype=np.float64) - STC_TEMPERATURE
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scale = np.where(irradiance >= min_irradiance, STC_IRRADIANCE / irradiance, np.nan)  # NaN G stays NaN
+        return {
+            'pmp_stc': pmp * scale / (1 + pmax_coeff * dt),
+            'isc_stc': isc * scale / (1 + isc_coeff * dt),
+            'voc_stc': np.where(np.isfinite(scale), voc / (1 + voc_coeff * dt), np.nan),
+        }
@@ -0,0 +1,175 @@
+"""
+Vectorized IV parameter extraction: Isc, Voc, the max power point, fill factor and Rs/Rsh of every curve at once.
+
+All curves get packed into one padded (curves x points) array. Isc and Rsh come from a line fit near V = 0, Voc and Rs
+from a line fit near I = 0, and the MPP from a parabola through the best sample and its neighbours when they're close
+together (otherwise the best sample). Isc/Voc/FF are NaN for sweeps that don't reach that end of the curve.
+
+References:
+    * https://www.pveducation.org/pvcdrom/solar-cell-operation/fill-factor
+    * https://www.pveducation.org/pvcdrom/solar-cell-operation/series-resistance
+    * https://www.pveducation.org/pvcdrom/solar-cell-operation/shunt-resistance
+
+"""
+
+import numpy as np
+import pandas as pd
+
+# Number of points at each end of a curve used for the Isc/Voc line fits
+END_FIT_POINTS = 5
+
+# Points within this fraction of the max voltage from V = 0 count as the short-circuit end of the curve, and points
+# within this fraction of the max current from I = 0 as the open-circuit end
+END_REGION_FRACTION = 0.2
+
+# The MPP parabola is only used if its outer points are within this many average sample spacings of the best sample,
+# and its vertex is at most this fraction above the best sample's power
+MPP_FIT_SPACINGS = 3
+MPP_FIT_TOLERANCE = 0.05
+
+PARAM_COLUMNS = ['time', 'isc', 'voc', 'vmp', 'imp', 'pmp', 'ff', 'rs', 'rsh', 'n_points']
+
+
+def pad_curves(starts, stops, *columns):
+    """
+    Scatter flat, curve-contiguous columns into padded 2-D arrays (one row per curve, NaN padded). Returns the padded
+    arrays followed by the number of points in each curve.
+    """
+    lengths = (stops - starts).astype(np.int64)
+    n_curves, width = len(lengths), int(lengths.max()) if len(lengths) else 0
+    rows = np.repeat(np.arange(n_curves), lengths)
+    cols = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    flat = np.repeat(starts, lengths) + cols  # Position of each point in the flat column arrays
+
+    padded = []
+    for values in columns:
+        out = np.full((n_curves, width), np.nan)
+        out[rows, cols] = values[flat]
+        padded.append(out)
+    return (*padded, lengths)
+
+
+def _masked_line_fit(x, y, mask, max_slope=np.inf):
+    """
+    Least-squares line y = a + b*x for every row of x/y using only the points in mask, with the slope capped at
+    max_slope (the line is kept through the centroid of the points). Returns (a, b, mean_x, mean_y).
+    Rows where x doesn't vary get slope 0.
+    """
+    n = mask.sum(axis=1)
+    x = np.where(mask, x, 0.0)
+    y = np.where(mask, y, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_x = x.sum(axis=1) / n
+        mean_y = y.sum(axis=1) / n
+        dx = np.where(mask, x - mean_x[:, None], 0.0)
+        dy = np.where(mask, y - mean_y[:, None], 0.0)
+        sxx = (dx * dx).sum(axis=1)
+        slope = np.where(sxx > 0, (dx * dy).sum(axis=1) / np.where(sxx > 0, sxx, 1.0), 0.0)
+        slope = np.minimum(slope, max_slope)
+    return mean_y - slope * mean_x, slope, mean_x, mean_y
+
+
+def extract_params(voltage, current, lengths, end_fit_points=END_FIT_POINTS, end_region_fraction=END_REGION_FRACTION):
+    """
+    Fit IV parameters for every row of the padded (curves x points) voltage/current arrays. `lengths` is the number of
+    valid points in each row. Returns a dict of 1-D arrays: isc, voc, vmp, imp, pmp, ff, rs, rsh.
+    """
+    n_curves, width = voltage.shape
+    rows = np.arange(n_curves)
+    cols = np.arange(width)[None, :]
+    valid = cols < lengths[:, None]
+
+    # Sort each curve by voltage. NaN padding sorts to the end, so the valid points stay in the first `lengths` columns.
+    order = np.argsort(np.where(valid, voltage, np.inf), axis=1, kind='stable')
+    v = np.take_along_axis(voltage, order, axis=1)
+    i = np.take_along_axis(current, order, axis=1)
+    p = v * i
+
+    # Measured extremes, to find each end of the curve
+    v_min = np.nanmin(np.where(valid, v, np.nan), axis=1)
+    v_max = np.nanmax(np.where(valid, v, np.nan), axis=1)
+    i_max = np.nanmax(np.where(valid, i, np.nan), axis=1)
+    v_max_on = np.max(np.where(valid & (i > 0), v, -np.inf), axis=1, initial=-np.inf)  # Still producing current
+    v_max_on[np.isinf(v_max_on)] = np.nan
+
+    # Points near V = 0 and near I = 0 (at the high voltage end). The fits use the end_fit_points points closest to
+    # each end, and at least two as long as the second one is still fairly close (within twice the region), since the
+    # curve is so steep near Voc that there's often only one point in the region there.
+    tail = lengths[:, None] - 1 - cols  # How far each point is from the last one
+    near_isc = valid & (v <= end_region_fraction * v_max[:, None])
+    near_voc = valid & (i <= end_region_fraction * i_max[:, None]) & (v >= (1 - end_region_fraction) * v_max[:, None])
+    reaches_isc, reaches_voc = near_isc.any(axis=1), near_voc.any(axis=1)
+    n_low = np.clip(near_isc.sum(axis=1), 2, end_fit_points)[:, None]
+    n_high = np.clip(near_voc.sum(axis=1), 2, end_fit_points)[:, None]
+    low = valid & (cols < n_low) & (v <= 2 * end_region_fraction * v_max[:, None]) & reaches_isc[:, None]
+    high = valid & (tail < n_high) & (i <= 2 * end_region_fraction * i_max[:, None]) \
+        & (v >= (1 - 2 * end_region_fraction) * v_max[:, None]) & reaches_voc[:, None]
+    n_low, n_high = low.sum(axis=1), high.sum(axis=1)
+
+    # Isc end: I = a + b*V, so Isc = a and Rsh = -1/b. Slope can't physically be positive; treat that as flat.
+    isc_fit, di_dv, _, _ = _masked_line_fit(v, i, low, max_slope=0.0)
+
+    # Voc end: V = c + d*I, so Voc = c and Rs = -d. Again the slope has to be negative.
+    voc_fit, dv_di, _, _ = _masked_line_fit(i, v, high, max_slope=0.0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Neither can be less than what was measured along the way (the loggers' first point is often low)
+        isc = np.where(reaches_isc, np.maximum(isc_fit, i_max), np.nan)
+        voc = np.where(reaches_voc, np.fmax(voc_fit, v_max_on), np.nan)
+        rsh = np.where(n_low > 1, np.where(di_dv < 0, -1.0 / di_dv, np.inf), np.nan)
+        rs = np.where(n_high > 1, np.abs(dv_di), np.nan)
+
+    # MPP: parabola through the max power sample and its neighbours (clamped to stay inside the curve)
+    p_valid = np.where(valid, p, -np.inf)
+    last = np.clip(lengths - 1, 0, max(width - 1, 0))
+    j = np.minimum(np.clip(np.argmax(p_valid, axis=1), 1, np.maximum(last - 1, 1)), last)
+    j0, j2 = np.maximum(j - 1, 0), np.minimum(j + 1, last)
+    x0, x1, x2 = v[rows, j0], v[rows, j], v[rows, j2]
+    y0, y1, y2 = p[rows, j0], p[rows, j], p[rows, j2]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Vertex of the parabola through three points (Lagrange form)
+        denom = (x0 - x1) * (x0 - x2) * (x1 - x2)
+        a = (x2 * (y1 - y0) + x1 * (y0 - y2) + x0 * (y2 - y1)) / denom
+        b = (x2 * x2 * (y0 - y1) + x1 * x1 * (y2 - y0) + x0 * x0 * (y1 - y2)) / denom
+        c = (x1 * x2 * (x1 - x2) * y0 + x2 * x0 * (x2 - x0) * y1 + x0 * x1 * (x0 - x1) * y2) / denom
+        vertex_v = -b / (2 * a)
+        vertex_p = c - b * b / (4 * a)
+
+        # Only trust the vertex if the parabola opens downward, its points are close together (a far away neighbour
+        # lets it shoot way past anything measured) and the vertex sits between them, a little above the best sample.
+        # It can't beat Isc or Isc * Voc either. Otherwise fall back on the best measured sample.
+        best = np.argmax(p_valid, axis=1)
+        sample_v, sample_p = v[rows, best], p[rows, best]
+        near = MPP_FIT_SPACINGS * (v_max - v_min) / np.maximum(lengths - 1, 1)
+        vertex_i = vertex_p / vertex_v
+        use_fit = ((a < 0) & (x1 - x0 <= near) & (x2 - x1 <= near)
+                   & (vertex_v >= np.minimum(x0, x2)) & (vertex_v <= np.maximum(x0, x2))
+                   & (vertex_p >= sample_p) & (vertex_p <= sample_p * (1 + MPP_FIT_TOLERANCE))
+                   & ~(vertex_i > isc) & ~(vertex_p > isc * voc))  # NaN Isc/Voc don't rule the fit out
+        vmp = np.where(use_fit, vertex_v, sample_v)
+        pmp = np.where(use_fit, vertex_p, sample_p)
+        imp = np.where(vmp != 0, pmp / vmp, i[rows, best])
+        ff = pmp / (isc * voc)
+
+    return {'isc': isc, 'voc': voc, 'vmp': vmp, 'imp': imp, 'pmp': pmp, 'ff': ff, 'rs': rs, 'rsh': rsh}
+
+
+def extract_iv_params(curve_index):
+    """
+    extract_params over every curve of a CurveIndex: one row per curve with its key columns, start time and params.
+    """
+    store = curve_index.store
+    starts, stops = curve_index.starts, curve_index.stops
+    voltage, current, lengths = pad_curves(starts, stops, np.asarray(store['voltage'], dtype=np.float64),
+                                           np.asarray(store['current'], dtype=np.float64))
+    params = extract_params(voltage, current, lengths)
+
+    columns = dict(curve_index.key_columns)
+    # Curves are contiguous, so the first time of each one is a reduceat over the start offsets. That works on the
+    # stored integer time offsets too, so only one time per curve gets decoded.
+    times = np.asarray(store.raw('time'))
+    columns['time'] = store.decode('time', np.minimum.reduceat(times, starts) if len(starts) else times[:0])
+    columns.update(params)
+    columns['n_points'] = lengths
+    return pd.DataFrame(columns)
@@ -0,0 +1,317 @@
+"""
+IV curves drawn straight into PNGs with NumPy, for when a Plotly figure would be too heavy: thumbnail sheets of every
+curve (one tile per curve) for batch exports, and the overlay graph for selections of more curves than it can draw as a
+WebGL trace.
+
+Every line segment gets turned into the pixels it passes through, all at once, and the PNG is written with zlib, so
+only the export's summary sheet needs matplotlib. `python iv_raster.py <workbooks> --out exports` writes a sheet per
+MPPT, tiles.csv and a summary sheet for each day.
+
+References:
+    * https://www.w3.org/TR/png/ (the chunk layout png_bytes writes)
+    * https://matplotlib.org/stable/gallery/user_interfaces/canvasagg.html (Figure without pyplot, for servers)
+    * https://plotly.com/python/images/ (layout images, for the overlay)
+
+"""
+
+import argparse
+import base64
+import multiprocessing
+import os
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+TILE_SIZE = (48, 64)  # (height, width) of one curve's thumbnail in pixels
+SHEET_COLUMNS = 20  # Thumbnails per row of a sheet
+
+BACKGROUND = (255, 255, 255)
+LINE = (31, 119, 180)  # Plotly's default blue
+FLAGGED = (214, 39, 40)  # Frame around flagged curves (Plotly's red)
+GRID = (210, 210, 210)  # Gaps between tiles
+
+# Thumbnail sheets are palette images with just these colors (tile_sheet)
+SHEET_PALETTE = [BACKGROUND, LINE, FLAGGED, GRID]
+BACKGROUND_INDEX, LINE_INDEX, FLAGGED_INDEX, GRID_INDEX = range(4)
+
+# Plotly's Viridis, so rasterized overlays match the colorbar of the WebGL ones
+VIRIDIS = ['#440154', '#482878', '#3e4989', '#31688e', '#26828e', '#1f9e89', '#35b779', '#6ece58', '#b5de2b',
+           '#fde725']
+
+
+def colormap(values, vmin=None, vmax=None, colors=VIRIDIS):
+    """RGB (uint8, one row per value) of values on a colorscale, linearly interpolated. NaN gets the bottom color."""
+    values = np.asarray(values, dtype=np.float64)
+    vmin = np.nanmin(values) if vmin is None else vmin
+    vmax = np.nanmax(values) if vmax is None else vmax
+    stops = np.array([[int(c[i:i + 2], 16) for i in (1, 3, 5)] for c in colors], dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        position = np.nan_to_num((values - vmin) / (vmax - vmin) if vmax > vmin else values * 0) * (len(stops) - 1)
+    position = np.clip(position, 0, len(stops) - 1)
+    return np.stack([np.interp(position, np.arange(len(stops)), stops[:, c]) for c in range(3)], axis=1) \
+        .round().astype(np.uint8)
+
+
+def segment_pixels(voltage, current, lengths, width, height, v_max, i_max):
+    """
+    (curve number, row, column) of every pixel the concatenated curves pass through, on a width x height grid spanning
+    0..v_max and 0..i_max (values outside it get drawn on the edge).
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    x = np.clip(np.asarray(voltage, dtype=np.float64) / v_max, 0, 1) * (width - 1)
+    y = (1 - np.clip(np.asarray(current, dtype=np.float64) / i_max, 0, 1)) * (height - 1)  # Row 0 is the top
+    curve_of_point = np.repeat(np.arange(len(lengths)), lengths)
+
+    # A segment from each point to the next one, except from the last point of a curve to the first of the next
+    is_start = np.ones(len(x), dtype=bool)
+    is_start[(np.cumsum(lengths) - 1)[lengths > 0]] = False
+    starts = np.flatnonzero(is_start)
+    x0, y0, dx, dy = x[starts], y[starts], x[starts + 1] - x[starts], y[starts + 1] - y[starts]
+    ok = np.isfinite(x0) & np.isfinite(y0) & np.isfinite(dx) & np.isfinite(dy)  # NaN points leave a gap
+    starts, x0, y0, dx, dy = starts[ok], x0[ok], y0[ok], dx[ok], dy[ok]
+
+    # Sample each segment at one point per pixel along its longer side
+    steps = np.ceil(np.maximum(np.abs(dx), np.abs(dy))).astype(np.int64) + 1
+    segment = np.repeat(np.arange(len(starts)), steps)
+    t = (np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)) / np.repeat(np.maximum(steps - 1, 1),
+                                                                                         steps)
+    rows = np.rint(y0[segment] + t * dy[segment]).astype(np.int64)
+    cols = np.rint(x0[segment] + t * dx[segment]).astype(np.int64)
+    curves = curve_of_point[starts][segment]
+
+    # Curves of a single point don't have any segments, but still get their pixel
+    single = np.flatnonzero(lengths == 1)
+    if len(single):
+        first = (np.cumsum(lengths) - lengths)[single]
+        keep = np.isfinite(x[first]) & np.isfinite(y[first])
+        curves = np.concatenate([curves, single[keep]])
+        rows = np.concatenate([rows, np.rint(y[first][keep]).astype(np.int64)])
+        cols = np.concatenate([cols, np.rint(x[first][keep]).astype(np.int64)])
+    return curves, rows, cols
+
+
+def rasterize_tiles(voltage, current, lengths, v_max, i_max, tile=TILE_SIZE):
+    """Each curve drawn into its own tile: boolean array (curve, row, column), True where the line is."""
+    height, width = tile
+    tiles = np.zeros((len(lengths), height, width), dtype=bool)
+    curves, rows, cols = segment_pixels(voltage, current, lengths, width, height, v_max, i_max)
+    tiles[curves, rows, cols] = True
+    return tiles
+
+
+def rasterize_overlay(voltage, current, lengths, colors, v_max, i_max, size=(500, 800)):
+    """
+    All the curves drawn on top of each other in one RGBA image (transparent background), each in its color (RGB
+    rows, e.g. from colormap). Later curves are drawn over earlier ones.
+    """
+    height, width = size
+    curves, rows, cols = segment_pixels(voltage, current, lengths, width, height, v_max, i_max)
+    if len(curves) and (np.diff(curves) < 0).any():  # Only single-point curves come out of order
+        order = np.argsort(curves, kind='stable')  # So the last write to each pixel is the latest curve
+        curves, rows, cols = curves[order], rows[order], cols[order]
+
+    # Each pixel's RGBA as one uint32, so every pixel gets set with a single 1-D assignment
+    rgba = np.empty((len(colors), 4), dtype=np.uint8)
+    rgba[:, :3] = colors
+    rgba[:, 3] = 255
+    image = np.zeros(height * width, dtype=np.uint32)
+    image[rows * width + cols] = rgba.view(np.uint32)[:, 0][curves]
+    return image.view(np.uint8).reshape(height, width, 4)
+
+
+def tile_sheet(tiles, columns=SHEET_COLUMNS, flagged=None, gap=1):
+    """
+    The tiles in rows of `columns`, `gap` pixels apart, as indices into SHEET_PALETTE. Flagged tiles get a red frame.
+    """
+    n_tiles, height, width = tiles.shape
+    n_rows = max(-(-n_tiles // columns), 1)
+    cells = np.full((n_rows * columns, height + gap, width + gap), GRID_INDEX, dtype=np.uint8)
+    cells[:n_tiles, :height, :width] = tiles  # LINE_INDEX where the line is, BACKGROUND_INDEX elsewhere
+    if flagged is not None:
+        framed = np.flatnonzero(np.asarray(flagged, dtype=bool))
+        for edge in (np.s_[0, :width], np.s_[height - 1, :width], np.s_[:height, 0], np.s_[:height, width - 1]):
+            cells[(framed,) + edge] = FLAGGED_INDEX
+
+    # (row, column, y, x) -> one image, plus the gap along the top and left edges
+    sheet = cells.reshape(n_rows, columns, height + gap, width + gap).transpose(0, 2, 1, 3) \
+        .reshape(n_rows * (height + gap), columns * (width + gap))
+    out = np.full((sheet.shape[0] + gap, sheet.shape[1] + gap), GRID_INDEX, dtype=np.uint8)
+    out[gap:, gap:] = sheet
+    return out
+
+
+def png_bytes(image, palette=None, level=6):
+    """
+    PNG file contents of a uint8 image: RGB or RGBA (rows, columns, channels), or indices into palette (a list of RGB
+    tuples) with just (rows, columns).
+    """
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    if image.ndim == 2:
+        image = image[..., None]
+    height, width, channels = image.shape
+    # Each row starts with its filter type (0: none). zlib still finds the long runs of background.
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), image.reshape(height, width * channels)], axis=1)
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    color_type = 3 if palette is not None else {3: 2, 4: 6}[channels]  # Palette, RGB or RGBA, 8 bits each
+    header = chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0))
+    if palette is not None:
+        header += chunk(b'PLTE', bytes(np.asarray(palette, dtype=np.uint8).ravel()))
+    return (b'\x89PNG\r\n\x1a\n' + header + chunk(b'IDAT', zlib.compress(raw.tobytes(), level))
+            + chunk(b'IEND', b''))
+
+
+def png_data_uri(image):
+    """The image as a data: URI, e.g. for the source of a Plotly layout image."""
+    return 'data:image/png;base64,' + base64.b64encode(png_bytes(image)).decode('ascii')
+
+
+def overlay_image(voltage, current, lengths, color_values, size=(500, 800)):
+    """
+    The curves as one Plotly layout image colored by color_values, plus the axis settings that line it up with the data.
+    """
+    voltage, current = np.asarray(voltage, dtype=np.float64), np.asarray(current, dtype=np.float64)
+    v_max = float(np.nanmax(voltage)) * 1.02 if np.isfinite(voltage).any() else 1.0
+    i_max = float(np.nanmax(current)) * 1.05 if np.isfinite(current).any() else 1.0
+    finite = np.asarray(color_values, dtype=np.float64)
+    finite = finite[np.isfinite(finite)]
+    colors = colormap(color_values, *((finite.min(), finite.max()) if len(finite) else (0, 1)))
+    image = rasterize_overlay(voltage, current, lengths, colors, v_max, i_max, size)
+    layout_image = {'source': png_data_uri(image), 'xref': 'x', 'yref': 'y', 'x': 0, 'y': i_max, 'sizex': v_max,
+                    'sizey': i_max, 'xanchor': 'left', 'yanchor': 'top', 'sizing': 'stretch', 'layer': 'above'}
+    axes = {'xaxis': {'autorange': False, 'range': [0, v_max]}, 'yaxis': {'autorange': False, 'range': [0, i_max]}}
+    return layout_image, axes
+
+
+############# Bulk export ##################################
+
+def curve_sheet(voltage, current, lengths, flagged, v_max, i_max, tile=TILE_SIZE, columns=SHEET_COLUMNS):
+    """PNG of one thumbnail sheet. Runs in the export's worker processes, so it only takes arrays."""
+    tiles = rasterize_tiles(voltage, current, lengths, v_max, i_max, tile)
+    return png_bytes(tile_sheet(tiles, columns, flagged), SHEET_PALETTE)
+
+
+def _render_job(job):
+    return job['name'], curve_sheet(**job['args'])
+
+
+def sheet_jobs(curve_index, params, anomalies=None, v_max=None, i_max=None, tile=TILE_SIZE, columns=SHEET_COLUMNS):
+    """
+    One curve_sheet job per (day, MPPT), with its curves in time order. Returns (jobs, table of which tile each curve
+    is).
+    """
+    labels = anomalies['anomaly'].reindex(params.index).fillna('') if anomalies is not None \
+        else pd.Series('', index=params.index)
+    # Same scale for every tile, so they can be compared by eye
+    v_max = v_max or float(np.nanmax(params['voc'])) * 1.05
+    i_max = i_max or float(np.nanmax(params['isc'])) * 1.05
+
+    group_cols = [col for col in ('day', 'mppt_id') if col in params.columns]
+    jobs, tables = [], []
+    for group, rows in params.sort_values(group_cols + ['time']).groupby(group_cols, sort=True):
+        group = group if isinstance(group, tuple) else (group,)
+        keys = list(zip(*(rows[key].tolist() for key in curve_index.keys)))
+        curves, lengths = curve_index.take_curves(keys)
+        flagged = (labels.loc[rows.index] != '').to_numpy()
+        jobs.append({'name': group, 'args': dict(voltage=curves['voltage'], current=curves['current'],
+                                                 lengths=lengths, flagged=flagged, v_max=v_max, i_max=i_max,
+                                                 tile=tile, columns=columns)})
+        position = np.arange(len(rows))
+        tables.append(rows[group_cols + ['curve_num', 'time']].assign(
+            tile_row=position // columns, tile_column=position % columns, anomaly=labels.loc[rows.index].to_numpy()))
+    return jobs, pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+
+def summary_sheet(params, anomalies=None, title='IV Curve Summary'):
+    """
+    matplotlib Figure with a table of each MPPT's curves (count, Pmax/Isc/Voc/fill factor, how many were flagged)
+    and Pmax vs time of every MPPT. Built without pyplot, so it's safe to call from the dashboard's threads.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    params = params.assign(flagged=(anomalies['anomaly'].reindex(params.index).fillna('') != '')
+                           if anomalies is not None else False)
+    stats = params.groupby('mppt_id', observed=True).agg(
+        curves=('pmp', 'size'), pmax_max=('pmp', 'max'), pmax_mean=('pmp', 'mean'), isc_max=('isc', 'max'),
+        voc_max=('voc', 'max'), ff_median=('ff', 'median'), flagged=('flagged', 'sum'))
+
+    fig = Figure(figsize=(11, 8.5))  # Letter, landscape
+    FigureCanvasAgg(fig)
+    fig.suptitle(title)
+    table_ax = fig.add_axes([0.05, 0.52, 0.9, 0.38])
+    table_ax.axis('off')
+    header = ['MPPT', 'Curves', 'Pmax max (W)', 'Pmax mean (W)', 'Isc max (A)', 'Voc max (V)', 'FF median',
+              'Flagged']
+    cells = [[mppt, int(s.curves), '{:.1f}'.format(s.pmax_max), '{:.1f}'.format(s.pmax_mean),
+              '{:.2f}'.format(s.isc_max), '{:.2f}'.format(s.voc_max), '{:.2f}'.format(s.ff_median), int(s.flagged)]
+             for mppt, s in stats.iterrows()]
+    table = table_ax.table(cellText=cells or [[''] * len(header)], colLabels=header, loc='upper center')
+    table.auto_set_font_size(False)
+    table.set_fontsize(8)
+
+    ax = fig.add_axes([0.07, 0.07, 0.88, 0.38])
+    for mppt, rows in params.sort_values('time').groupby('mppt_id', observed=True):
+        ax.plot(rows['time'], rows['pmp'], linewidth=0.7, label=str(mppt))
+    ax.set_xlabel('Time')
+    ax.set_ylabel('Pmax (W)')
+    if len(stats) <= 20:
+        ax.legend(fontsize=6, ncol=2, loc='upper right')
+    return fig
+
+
+def export_thumbnails(curve_index, params, out_dir, anomalies=None, max_workers=None, **sheet_args):
+    """
+    Write a thumbnail sheet of every MPPT (rendered one MPPT per worker process), tiles.csv and the summary sheet
+    (PNG and PDF) for each day into out_dir/day_<day>. Returns the paths written.
+    """
+    jobs, tiles = sheet_jobs(curve_index, params, anomalies, **sheet_args)
+    written = []
+    by_day = 'day' in params.columns
+    # Workers come from the forkserver where there is one, so they don't inherit the threads of whoever called this
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else None
+    n_workers = min(max_workers or os.cpu_count() or 1, max(len(jobs), 1))
+    with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context(method)) as executor:
+        for name, png in executor.map(_render_job, jobs):
+            day, mppt = name if by_day else (None, name[0])
+            folder = os.path.join(out_dir, 'day_{}'.format(day) if by_day else '')
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, 'mppt_{}.png'.format(mppt))
+            with open(path, 'wb') as f:
+                f.write(png)
+            written.append(path)
+
+    for day, rows in (params.groupby('day') if by_day else [(None, params)]):
+        folder = os.path.join(out_dir, 'day_{}'.format(day) if by_day else '')
+        os.makedirs(folder, exist_ok=True)
+        day_tiles = tiles[tiles['day'] == day] if by_day else tiles
+        day_tiles.to_csv(os.path.join(folder, 'tiles.csv'), index=False)
+        fig = summary_sheet(rows, anomalies, title='IV Curve Summary' + (', Day {}'.format(day) if by_day else ''))
+        for extension in ('png', 'pdf'):
+            fig.savefig(os.path.join(folder, 'summary.' + extension), dpi=150)
+        written += [os.path.join(folder, name) for name in ('tiles.csv', 'summary.png', 'summary.pdf')]
+    return written
+
+
+if __name__ == '__main__':
+    from iv_anomaly import detect_anomalies
+    from iv_extract import extract_iv_params
+    from iv_store import CurveIndex, load_iv_workbooks
+
+    parser = argparse.ArgumentParser(description='Export every IV curve as PNG thumbnail sheets plus a summary sheet')
+    parser.add_argument('workbooks', help='IV workbook, or a folder/glob of them (one per day)')
+    parser.add_argument('--out', default='exports', help='Folder to write to (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: number of cores)')
+    parser.add_argument('--no-anomalies', action='store_true', help="Don't scan for abnormal curves to frame in red")
+    args = parser.parse_args()
+
+    curve_index = CurveIndex(load_iv_workbooks(args.workbooks), keys=('day', 'mppt_id', 'curve_num'))
+    params = extract_iv_params(curve_index)
+    anomalies = None if args.no_anomalies else detect_anomalies(curve_index, params)
+    for path in export_thumbnails(curve_index, params, args.out, anomalies, max_workers=args.workers):
+        print(path)
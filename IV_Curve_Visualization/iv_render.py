@@ -0,0 +1,194 @@
+"""
+Figure building for the IV dashboards without plotly.express.
+
+The figures are built once as WebGL (Scattergl) templates with empty traces, then each callback either fills a copy of
+a template with new arrays or sends a Patch of just the arrays. The overlay of many curves is one trace, with a NaN
+point between curves.
+
+References:
+    * https://plotly.com/python/webgl-vs-svg/
+    * https://dash.plotly.com/partial-properties (Patch, needs Dash >= 2.9)
+    * https://plotly.com/python/hover-text-and-formatting/ (hovertemplate)
+
+"""
+
+import copy
+
+import numpy as np
+import plotly.graph_objects as go
+from dash import Patch
+
+
+def power_figure_template(x_col, y_col, hover_cols=(), uirevision='power-time', x_title=None, y_title=None,
+                          flagged=False):
+    """
+    Empty power vs time figure, with the curve # as each point's hovertext and hover_cols in customdata. flagged=True
+    adds a trace of red circles for flagged curves (flagged_trace_data).
+    """
+    hover_lines = ['{}=%{{x}}'.format(x_col), '{}=%{{y}}'.format(y_col)]
+    hover_lines += ['{}=%{{customdata[{}]}}'.format(col, i) for i, col in enumerate(hover_cols)]
+    fig = go.Figure(go.Scattergl(
+        mode='markers',
+        hovertemplate='<b>%{hovertext}</b><br><br>' + '<br>'.join(hover_lines) + '<extra></extra>'))
+    if flagged:
+        fig.data[0].name = 'Curves'
+        fig.add_trace(go.Scattergl(
+            mode='markers',
+            name='Flagged',
+            marker={'symbol': 'circle-open', 'size': 12, 'color': 'red', 'line': {'width': 2}},
+            hovertemplate='<b>%{hovertext}</b><br><br>%{customdata}<extra>Flagged</extra>'))
+    fig.update_layout(uirevision=uirevision, hovermode='closest')  # uirevision keeps the zoom when the figure updates
+    fig.update_xaxes(title_text=x_title or x_col)
+    fig.update_yaxes(title_text=y_title or y_col)
+    return fig.to_dict()
+
+
+def iv_curve_figure_template(title='IV Curve'):
+    """Empty IV curve figure with 'Point N' hover labels that come from the point number rather than strings."""
+    fig = go.Figure(go.Scattergl(
+        mode='markers',
+        hovertemplate='<b>Point %{pointNumber}</b><br><br>voltage=%{x}<br>current=%{y}<extra></extra>'))
+    fig.update_layout(title_text=title, hovermode='closest')
+    fig.update_xaxes(title_text='Voltage (V)')
+    fig.update_yaxes(title_text='Current (A)')
+    return fig.to_dict()
+
+
+def _overlay_hovertemplate(color_title):
+    return ('<b>Curve %{{customdata}}</b><br><br>voltage=%{{x}}<br>current=%{{y}}<br>{}=%{{marker.color}}'
+            '<extra></extra>').format(color_title)
+
+
+def iv_overlay_figure_template(title='IV Curves'):
+    """Empty figure for many IV curves in one trace, their markers colored by a value per curve (overlay_trace_data)"""
+    fig = go.Figure(go.Scattergl(
+        mode='markers',
+        marker={'size': 4, 'colorscale': 'Viridis', 'showscale': True, 'colorbar': {'title': {'text': ''}}},
+        hovertemplate=_overlay_hovertemplate('color')))
+    fig.update_layout(title_text=title, hovermode='closest')
+    fig.update_xaxes(title_text='Voltage (V)')
+    fig.update_yaxes(title_text='Current (A)')
+    return fig.to_dict()
+
+
+def heatmap_figure_template(x_title='Time (Australian)', y_title='MPPT ID'):
+    """Empty heatmap (e.g. one row per MPPT, one column per time bucket, see rollup.py). Gaps (NaN) stay blank."""
+    fig = go.Figure(go.Heatmap(colorscale='Viridis', hoverongaps=False, colorbar={'title': {'text': ''}}))
+    fig.update_layout(hovermode='closest')
+    fig.update_xaxes(title_text=x_title)
+    fig.update_yaxes(title_text=y_title, type='category')
+    return fig.to_dict()
+
+
+def power_trace_data(df, x_col, y_col, name_col, hover_cols=()):
+    """Arrays for the power trace, pulled straight out of df (one row per IV curve)."""
+    return {
+        'x': df[x_col].to_numpy(),
+        'y': df[y_col].to_numpy(),
+        'hovertext': df[name_col].to_numpy(),
+        'customdata': df[list(hover_cols)].to_numpy(),
+    }
+
+
+def flagged_trace_data(df, x_col, y_col, name_col, label_col):
+    """Arrays for the flagged trace of the power figure: one point per flagged curve, labelled with what was flagged."""
+    return {
+        'x': df[x_col].to_numpy(),
+        'y': df[y_col].to_numpy(),
+        'hovertext': df[name_col].to_numpy(),
+        'customdata': df[label_col].to_numpy(),
+    }
+
+
+def iv_curve_trace_data(curve):
+    """Arrays for the IV curve trace. `curve` is a dict/dataframe with 'voltage' and 'current' (e.g. CurveIndex.get)."""
+    return {'x': np.asarray(curve['voltage']), 'y': np.asarray(curve['current'])}
+
+
+def overlay_trace_data(voltage, current, lengths, curve_nums, color_values, color_title='', decimals=4):
+    """
+    Arrays for the overlay trace: every curve's points concatenated with a NaN point between curves, rounded to
+    `decimals` places (float32 otherwise turns into 17-digit numbers in the JSON).
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    n_curves, n_points = len(lengths), int(lengths.sum())
+
+    # Where each real point goes in the output: its own position, pushed along by one per separator before it
+    positions = np.arange(n_points) + np.repeat(np.arange(n_curves), lengths)
+    size = n_points + max(n_curves - 1, 0)
+
+    def spread(values, per_curve=False):
+        out = np.full(size, np.nan)
+        out[positions] = np.repeat(values, lengths) if per_curve else values
+        return out.round(decimals)
+
+    return {
+        'x': spread(voltage),
+        'y': spread(current),
+        'customdata': spread(np.asarray(curve_nums, dtype=np.float64), per_curve=True),
+        'hovertemplate': _overlay_hovertemplate(color_title),
+        'marker': {'color': spread(np.asarray(color_values, dtype=np.float64), per_curve=True),
+                   'colorbar': {'title': {'text': color_title}}},
+    }
+
+
+def overlay_colorbar_data(color_values, color_title=''):
+    """
+    Trace data for the overlay when its curves are drawn as an image instead (see iv_raster.py): no points, just the
+    colorbar, spanning the same values the image's colors came from.
+    """
+    color_values = np.asarray(color_values, dtype=np.float64)
+    finite = color_values[np.isfinite(color_values)]
+    cmin, cmax = (float(finite.min()), float(finite.max())) if len(finite) else (0.0, 1.0)
+    return {
+        'x': [None], 'y': [None], 'customdata': [None],
+        'marker': {'color': [cmin], 'cmin': cmin, 'cmax': cmax, 'colorbar': {'title': {'text': color_title}}},
+    }
+
+
+def iv_axis_layout(vmax, imax, autosize):
+    """Axis settings for the IV graph: fixed [0, max] ranges, or let Plotly autorange when autosizing."""
+    if autosize:
+        return {'xaxis': {'autorange': True, 'range': None}, 'yaxis': {'autorange': True, 'range': None}}
+    return {'xaxis': {'autorange': False, 'range': [0, vmax]}, 'yaxis': {'autorange': False, 'range': [0, imax]}}
+
+
+def _merge(target, updates):
+    # Nested dicts (e.g. 'marker') get merged key by key, so trace data doesn't wipe out the template's styling
+    for key, value in updates.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+
+
+def fill_figure(template, trace_data, title=None, axes=None):
+    """
+    Copy of template with trace_data filled into its first trace (or a list of trace_data for its first few traces)
+    and optionally a new title/axis settings.
+    """
+    fig = copy.deepcopy(template)
+    for trace, data in zip(fig['data'], trace_data if isinstance(trace_data, list) else [trace_data]):
+        _merge(trace, data)
+    if title is not None:
+        fig['layout'].setdefault('title', {})['text'] = title
+    for axis, settings in (axes or {}).items():
+        fig['layout'].setdefault(axis, {}).update(settings)
+    return fig
+
+
+def patch_figure(trace_data=None, title=None, axes=None):
+    """
+    Dash Patch that updates only the given trace arrays (of the first trace, or a list of them for the first few
+    traces), title and axis settings of the figure in the browser.
+    """
+    patch = Patch()
+    for n, data in enumerate(trace_data if isinstance(trace_data, list) else [trace_data or {}]):
+        for key, values in data.items():
+            patch['data'][n][key] = values
+    if title is not None:
+        patch['layout']['title']['text'] = title
+    for axis, settings in (axes or {}).items():
+        for key, value in settings.items():
+            patch['layout'][axis][key] = value
+    return patch
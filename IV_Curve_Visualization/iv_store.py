@@ -0,0 +1,410 @@
+"""
+On-disk columnar cache for the IV curve workbooks.
+
+pd.read_excel is by far the slowest part of starting the dashboards. Each workbook gets parsed once and every column is
+written out as its own .npy file (data/.iv_cache/<workbook name>/), which later starts memory-map as long as the
+workbook's mtime/size/hash hasn't changed. Columns are stored compactly (categorical text, int32 time offsets, float32
+values), about a quarter of the size of the read_excel dataframe.
+
+References:
+    * https://numpy.org/doc/stable/reference/generated/numpy.load.html (mmap_mode)
+    * https://numpy.org/doc/stable/reference/generated/numpy.lib.format.open_memmap.html
+    * https://docs.python.org/3/library/subprocess.html#subprocess.run
+
+"""
+
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Bump this whenever the on-disk layout changes so that old caches get rebuilt instead of misread
+CACHE_VERSION = 2
+CACHE_DIR_NAME = '.iv_cache'
+META_FILE = 'meta.json'
+
+# Columns every IV workbook is expected to have (see 01_EDA.ipynb for how the workbooks were made)
+IV_COLUMNS = ['time', 'voltage', 'current', 'power', 'mppt_id', 'curve_num']
+
+
+def _smallest_uint(n):
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if n <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.int64
+
+
+def compact_column(values):
+    """
+    Compact representation of one column: (stored array, encoding). encoding is None for a plain smaller dtype, or a
+    JSON-able dict saying how to decode it ('category' for text, 'epoch' for times).
+    """
+    values = np.asarray(values)
+    if values.dtype == object or values.dtype.kind in 'US':
+        # Object arrays can't be memory-mapped either. Categories come out sorted, so codes sort the same as labels.
+        categories, codes = np.unique(values.astype(str), return_inverse=True)
+        return codes.astype(_smallest_uint(len(categories))), {'kind': 'category', 'categories': categories.tolist()}
+
+    if np.issubdtype(values.dtype, np.datetime64):
+        times = values.astype('datetime64[ns]')
+        if not len(times) or np.isnat(times).any():
+            return times, None
+        epoch = times.min().astype('datetime64[D]')
+        offsets = (times - epoch).astype(np.int64)
+        unit = 'ms' if not np.any(offsets % 10**6) else 'ns'  # Only keep nanoseconds if there are any
+        if unit == 'ms':
+            offsets //= 10**6
+        dtype = np.int32 if offsets.max() <= np.iinfo(np.int32).max else np.int64
+        return offsets.astype(dtype), {'kind': 'epoch', 'epoch': str(epoch), 'unit': unit}
+
+    if values.dtype.kind == 'f':
+        return values.astype(np.float32), None
+    if values.dtype.kind in 'iu' and len(values):
+        int32 = np.iinfo(np.int32)
+        if int32.min <= values.min() and values.max() <= int32.max:
+            return values.astype(np.int32), None
+    return values, None
+
+
+class IVCurveStore:
+    """
+    Column-oriented container for raw IV curve points. Each column is a 1-D NumPy array (possibly memory-mapped), and
+    all columns have the same length. Columns listed in `encodings` are stored as category codes or time offsets (see
+    compact_column); indexing the store decodes them, raw() doesn't.
+    """
+
+    def __init__(self, columns, encodings=None):
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError('All IV columns must be the same length, got lengths {}'.format(sorted(lengths)))
+        self.columns = dict(columns)
+        self.encodings = dict(encodings or {})
+        self._categories = {name: np.asarray(encoding['categories'])
+                            for name, encoding in self.encodings.items() if encoding['kind'] == 'category'}
+
+    @classmethod
+    def from_columns(cls, columns):
+        """Store holding the compacted version of each column in the dict `columns` (see compact_column)."""
+        stored, encodings = {}, {}
+        for name, values in columns.items():
+            stored[name], encoding = compact_column(values)
+            if encoding is not None:
+                encodings[name] = encoding
+        return cls(stored, encodings)
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls.from_columns({str(name): df[name].to_numpy() for name in df.columns})
+
+    @classmethod
+    def concat(cls, stores):
+        """
+        One store with the rows of every store in turn, keeping the columns they all have. Always an in-memory copy,
+        even of memory-mapped stores (see the top of the file).
+        """
+        names = [name for name in stores[0].columns if all(name in other.columns for other in stores)]
+        # Each store has its own categories/epoch, so decode, join and compact again
+        return cls.from_columns({name: np.concatenate([store[name] for store in stores]) for name in names})
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, name):
+        return self.decode(name, self.columns[name])
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for values in self.columns.values())
+
+    def raw(self, name):
+        """The column as stored: category codes/time offsets for encoded columns."""
+        return self.columns[name]
+
+    def decode(self, name, values):
+        """Turn (a slice of) the stored column `name` back into labels/datetime64[ns]. Other columns pass through."""
+        encoding = self.encodings.get(name)
+        if encoding is None:
+            return values
+        if encoding['kind'] == 'category':
+            return self._categories[name][values]
+        offsets = np.asarray(values).astype('timedelta64[{}]'.format(encoding['unit']))
+        return np.datetime64(encoding['epoch'], 'ns') + offsets
+
+    def insert(self, name, values):
+        """New store with `values` (compacted) as its first column. The existing columns are shared, not copied."""
+        stored, encoding = compact_column(values)
+        encodings = dict(self.encodings, **({name: encoding} if encoding is not None else {}))
+        return IVCurveStore({name: stored, **self.columns}, encodings)
+
+    def take(self, order):
+        """New store with every column reordered by the integer array `order`. A copy, in memory."""
+        return IVCurveStore({name: values[order] for name, values in self.columns.items()}, self.encodings)
+
+    def to_frame(self):
+        """DataFrame of the decoded columns, with text columns as pandas categoricals."""
+        return pd.DataFrame({
+            name: pd.Categorical.from_codes(values, self._categories[name]) if name in self._categories
+            else self.decode(name, values)
+            for name, values in self.columns.items()})
+
+
+class CurveIndex:
+    """
+    Maps each key (e.g. (mppt_id, curve_num)) to the contiguous run of rows holding that curve, so one curve is a dict
+    lookup and a slice. Rows get sorted by the key columns first unless they already are, which copies the store.
+    """
+
+    def __init__(self, store, keys=('mppt_id', 'curve_num')):
+        self.keys = tuple(keys)
+        key_arrays = [np.asarray(store.raw(key)) for key in self.keys]
+        n_rows = len(key_arrays[0])
+
+        # np.lexsort sorts by the last key first, hence the reversal. It's a stable sort.
+        order = np.lexsort(key_arrays[::-1]) if n_rows else np.arange(0)
+        if not np.array_equal(order, np.arange(n_rows)):
+            store = store.take(order)
+            key_arrays = [np.asarray(store.raw(key)) for key in self.keys]
+        self.store = store
+        self.order = order  # Position in the original data of each (sorted) row
+
+        # A new curve starts wherever any of the key columns changes value
+        changed = np.zeros(max(n_rows - 1, 0), dtype=bool)
+        for values in key_arrays:
+            changed |= values[1:] != values[:-1]
+        starts = np.concatenate([[0], np.flatnonzero(changed) + 1]) if n_rows else np.arange(0)
+        stops = np.concatenate([starts[1:], [n_rows]]) if n_rows else np.arange(0)
+
+        self.starts = starts.astype(np.int64)
+        self.stops = stops.astype(np.int64)
+        # One entry per curve
+        self.key_columns = {key: store.decode(key, values[starts]) for key, values in zip(self.keys, key_arrays)}
+        self._integer_keys = [np.issubdtype(values.dtype, np.integer) for values in self.key_columns.values()]
+
+        key_values = zip(*[values.tolist() for values in self.key_columns.values()])
+        self.offsets = {key: (int(start), int(stop)) for key, start, stop in zip(key_values, starts, stops)}
+
+    @classmethod
+    def from_frame(cls, df, keys):
+        return cls(IVCurveStore({name: df[name].to_numpy() for name in df.columns}), keys)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, key):
+        return self.span(*key) != (0, 0)
+
+    def _normalize(self, key):
+        # Hover data comes back from the browser as JSON, so curve numbers may show up as floats or strings
+        return tuple(int(float(part)) if is_int else part for part, is_int in zip(key, self._integer_keys))
+
+    def span(self, *key):
+        """(start, stop) row offsets of the curve, or (0, 0) if there's no such curve."""
+        try:
+            return self.offsets.get(self._normalize(key), (0, 0))
+        except (TypeError, ValueError):
+            return 0, 0
+
+    def get(self, *key):
+        """Dict of column name -> decoded array of just the rows for `key`. Empty arrays if the key is missing."""
+        start, stop = self.span(*key)
+        return {name: self.store.decode(name, values[start:stop]) for name, values in self.store.columns.items()}
+
+    def get_frame(self, *key):
+        return pd.DataFrame(self.get(*key))
+
+    def take_curves(self, keys, columns=('voltage', 'current')):
+        """
+        Dict of column name -> the rows of every curve in `keys` concatenated in order, plus how many rows each curve
+        has (0 for missing keys). One gather per column.
+        """
+        spans = np.array([self.span(*key) for key in keys], dtype=np.int64).reshape(-1, 2)
+        lengths = spans[:, 1] - spans[:, 0]
+        # Row numbers of every curve end to end: each curve's start, plus a count that restarts at every curve
+        first = np.cumsum(lengths) - lengths
+        rows = np.repeat(spans[:, 0] - first, lengths) + np.arange(lengths.sum())
+        return {name: self.store.decode(name, self.store.raw(name)[rows]) for name in columns}, lengths
+
+
+def cache_dir_for(path):
+    """Directory the columnar cache for the workbook at `path` lives in."""
+    folder, name = os.path.split(os.path.abspath(path))
+    return os.path.join(folder, CACHE_DIR_NAME, name)
+
+
+def file_fingerprint(path, with_hash=True):
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_hash:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        fingerprint['sha1'] = sha1.hexdigest()
+    return fingerprint
+
+
+def _read_meta(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, META_FILE)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != CACHE_VERSION:
+        return None
+    return meta
+
+
+def _write_meta(cache_dir, meta):
+    # Write to a temp file and swap it in so a crash never leaves a half-written meta.json behind
+    tmp_path = os.path.join(cache_dir, META_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, os.path.join(cache_dir, META_FILE))
+
+
+def is_cache_fresh(path, meta):
+    """
+    Whether the cache described by `meta` still matches the workbook: mtime/size first, and the content hash only if
+    those changed. Returns (fresh, updated fingerprint or None).
+    """
+    if meta is None:
+        return False, None
+    source = meta['source']
+    quick = file_fingerprint(path, with_hash=False)
+    if quick['size'] == source['size'] and quick['mtime_ns'] == source['mtime_ns']:
+        return True, None
+    if quick['size'] != source['size']:
+        return False, None
+    full = file_fingerprint(path)
+    if full['sha1'] == source.get('sha1'):
+        return True, full  # Same contents, just a new mtime. Remember the new mtime so next time is the quick path.
+    return False, None
+
+
+def write_cache(store, path, cache_dir=None):
+    """Write every column of `store` out as a .npy file in the cache directory for `path`."""
+    cache_dir = cache_dir or cache_dir_for(path)
+    parent = os.path.dirname(cache_dir)
+    os.makedirs(parent, exist_ok=True)
+
+    # Build the cache in a scratch directory and rename it into place, so readers never see a partial cache
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=parent)
+    try:
+        for name, values in store.columns.items():
+            np.save(os.path.join(tmp_dir, name + '.npy'), values, allow_pickle=False)
+        _write_meta(tmp_dir, {
+            'version': CACHE_VERSION,
+            'source': file_fingerprint(path),
+            'columns': list(store.columns),
+            'dtypes': {name: values.dtype.str for name, values in store.columns.items()},
+            'encodings': store.encodings,
+            'rows': len(store),
+        })
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.replace(tmp_dir, cache_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return cache_dir
+
+
+def read_cache(cache_dir, mmap=True):
+    """Open a cache directory written by write_cache. With mmap=True the columns are paged in lazily by the OS."""
+    meta = _read_meta(cache_dir)
+    if meta is None:
+        raise FileNotFoundError('No valid IV cache in {}'.format(cache_dir))
+    mmap_mode = 'r' if mmap else None
+    columns = {name: np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+               for name in meta['columns']}
+    return IVCurveStore(columns, meta.get('encodings'))
+
+
+def load_iv_curves(path, use_cache=True, mmap=True, reader=pd.read_excel):
+    """
+    Load the workbook at `path` through the columnar cache: parse it and write the cache the first time, memory-map the
+    cache after that. Works for anything `reader` can parse into a dataframe.
+    """
+    if not use_cache:
+        return IVCurveStore.from_frame(reader(path))
+
+    cache_dir = cache_dir_for(path)
+    meta = _read_meta(cache_dir)
+    fresh, new_fingerprint = is_cache_fresh(path, meta)
+    if fresh:
+        if new_fingerprint is not None:
+            meta['source'] = new_fingerprint
+            _write_meta(cache_dir, meta)
+        return read_cache(cache_dir, mmap=mmap)
+
+    store = IVCurveStore.from_frame(reader(path))
+    write_cache(store, path, cache_dir)
+    return read_cache(cache_dir, mmap=mmap) if mmap else store
+
+
+def find_workbooks(path):
+    """Workbook paths matching `path`, which can be one workbook, a folder of them, or a glob pattern."""
+    if os.path.isdir(path):
+        paths = glob.glob(os.path.join(path, '*.xlsx'))
+    elif glob.has_magic(path):
+        paths = glob.glob(path)
+    else:
+        paths = [path]
+    # Skip the lock files Excel leaves next to open workbooks
+    return [p for p in paths if not os.path.basename(p).startswith('~$')]
+
+
+def day_labels(paths):
+    """
+    Which day each workbook is from. If every file name has a day number in it (sundae_day_5_...) that number is the
+    label, otherwise each file is labelled with its name (minus the extension).
+    """
+    numbers = [re.search(r'day[_ -]?(\d+)', os.path.basename(p), re.IGNORECASE) for p in paths]
+    if all(numbers):
+        return [int(match.group(1)) for match in numbers]
+    return [os.path.splitext(os.path.basename(p))[0] for p in paths]
+
+
+def _build_caches(paths, max_workers=None):
+    # Each workbook gets parsed by this file run as a script in a fresh interpreter, which doesn't import the caller's
+    # script and is safe to start from a threaded process. One that fails stays stale and the caller raises its error.
+    command = [sys.executable, os.path.abspath(__file__)]
+    with ThreadPoolExecutor(max_workers=min(max_workers or os.cpu_count() or 1, len(paths))) as executor:
+        list(executor.map(lambda path: subprocess.run(command + [os.path.abspath(path)]), paths))
+
+
+def load_iv_workbooks(path, max_workers=None, mmap=True):
+    """
+    Load every workbook matching `path` (a file, folder or glob) into one IVCurveStore with a 'day' column. Stale ones
+    get parsed in parallel. One workbook stays memory-mapped; several get merged in memory.
+    """
+    paths = find_workbooks(path)
+    if not paths:
+        raise FileNotFoundError('No IV workbooks found at {}'.format(path))
+    days = day_labels(paths)
+    paths = [p for _, p in sorted(zip(days, paths))]  # Ordered by day so the merged store is already sorted by it
+    days = sorted(days)
+
+    stale = [p for p in paths if not is_cache_fresh(p, _read_meta(cache_dir_for(p)))[0]]
+    if len(stale) > 1:
+        _build_caches(stale, max_workers)
+
+    # Single stale workbooks just get parsed here, and fresh ones get memory-mapped
+    stores = [load_iv_curves(p, mmap=mmap) for p in paths]
+    stores = [store.insert('day', np.full(len(store), day)) for store, day in zip(stores, days)]
+    return stores[0] if len(stores) == 1 else IVCurveStore.concat(stores)
+
+
+if __name__ == '__main__':
+    # Parse workbooks and write their caches, e.g. `python iv_store.py data/sundae_day_5_iv_curves.xlsx`
+    for workbook in sys.argv[1:]:
+        load_iv_curves(workbook, mmap=False)
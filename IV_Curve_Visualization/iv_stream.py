@@ -0,0 +1,341 @@
+"""
+Live (streaming) ingest of IV sweeps.
+
+The dashboards normally load a fixed workbook once at startup. For live array/vehicle telemetry, the logger instead
+appends rows to a file as sweeps are measured. This module tails that file, appends the new points to a growing curve
+store and fits IV parameters (see iv_extract.py) for only the curves that have just finished, so the cost of each poll
+depends on how much new data came in, not on how much is already loaded.
+
+The file has the same columns as the workbooks ('time', 'voltage', 'current', 'power', 'mppt_id', 'curve_num'), either
+as newline-delimited JSON (.ndjson/.jsonl, one object per line) or as CSV with a header line. Only complete lines are
+read, so it's fine for the logger to be partway through writing one. Each line is checked on its own: one that doesn't
+parse, or is missing a column or has a value that isn't a number/time where one should be, gets skipped (and logged
+with the logging module) without losing the good lines read along with it.
+
+A curve counts as finished once a row for the same MPPT with a different curve_num shows up, or once its MPPT has been
+quiet for complete_after seconds (so the last sweep doesn't wait forever for the next one to start).
+
+How to use this:
+    live = LiveIngest('data/live_iv_curves.ndjson', poll_interval=2).start()  # Polls in a background thread
+    live.start()  # Again after a fork (e.g. in a gunicorn worker): the parent's polling thread didn't come along
+    new_rows, cursor = live.params_since('A0', cursor)  # Fitted params of the curves after the client's last one
+    curve = live.get_curve('A0', 12)  # Same as CurveIndex.get
+
+References:
+    * https://dash.plotly.com/live-updates (dcc.Interval)
+    * https://plotly.com/javascript/plotlyjs-function-reference/#plotlyextendtraces (what dcc.Graph extendData does)
+
+"""
+
+import csv
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from iv_extract import extract_params, pad_curves
+from iv_store import IV_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+# dtypes of the live store's columns
+LIVE_DTYPES = {
+    'time': 'datetime64[ns]',
+    'voltage': np.float64,
+    'current': np.float64,
+    'power': np.float64,
+    'mppt_id': object,
+    'curve_num': np.int64,
+}
+
+
+class FileTailer:
+    """
+    Reads rows appended to an NDJSON or CSV file since the last call. Remembers the byte offset it got to, holds on to
+    any half-written last line until it's finished, and starts over if the file gets truncated or replaced.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.partial = b''
+        self.header = None  # CSV header line
+        self.is_csv = os.path.splitext(path)[1].lower() == '.csv'
+
+    def read_new_rows(self):
+        """DataFrame of the complete rows appended since the last call (empty if there aren't any)."""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return pd.DataFrame(columns=IV_COLUMNS)  # Logger hasn't created the file yet
+        if size < self.offset:
+            self.offset, self.partial, self.header = 0, b'', None  # Truncated/rotated, so start from the top
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            chunk = f.read()
+        self.offset += len(chunk)
+
+        data = self.partial + chunk
+        complete, _, self.partial = data.rpartition(b'\n')
+        if not complete:
+            return pd.DataFrame(columns=IV_COLUMNS)
+        lines = [line for line in complete.decode('utf-8', errors='replace').split('\n') if line.strip()]
+
+        if self.is_csv and self.header is None:
+            if not lines:
+                return pd.DataFrame(columns=IV_COLUMNS)
+            self.header = next(csv.reader([lines.pop(0)]))
+
+        # One line at a time, so a bad one only costs itself rather than the whole batch
+        records, bad = [], []
+        for line in lines:
+            if self.is_csv:
+                fields = next(csv.reader([line]), [])
+                record = dict(zip(self.header, fields)) if len(fields) == len(self.header) else None
+            else:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+            if isinstance(record, dict):
+                records.append(record)
+            else:
+                bad.append(line)
+        return clean_rows(pd.DataFrame.from_records(records), bad, self.path)
+
+
+def clean_rows(rows, bad_lines=(), path=''):
+    """
+    rows (one per parsed line) with every IV column converted to its type, minus the rows where a column is missing
+    or doesn't convert. Those get logged as a warning, together with bad_lines (lines that didn't parse at all).
+    """
+    rows = rows.reindex(columns=IV_COLUMNS)
+    cleaned = pd.DataFrame({
+        'time': pd.to_datetime(rows['time'], errors='coerce'),
+        'voltage': pd.to_numeric(rows['voltage'], errors='coerce'),
+        'current': pd.to_numeric(rows['current'], errors='coerce'),
+        'power': pd.to_numeric(rows['power'], errors='coerce'),
+        'mppt_id': rows['mppt_id'].where(rows['mppt_id'].notna() & (rows['mppt_id'].astype(str) != '')),
+        'curve_num': pd.to_numeric(rows['curve_num'], errors='coerce'),
+    }, index=rows.index)
+    ok = cleaned.notna().all(axis=1) & (cleaned['curve_num'] % 1 == 0)
+
+    n_bad = len(bad_lines) + int((~ok).sum())
+    if n_bad:
+        example = bad_lines[0] if len(bad_lines) else rows[~ok].iloc[0].to_dict()
+        logger.warning('Live IV ingest: skipped %d bad line(s) in %s, e.g. %.200s', n_bad, path, example)
+    cleaned = cleaned[ok]
+    return cleaned.astype({'curve_num': np.int64}).reset_index(drop=True)
+
+
+class GrowableColumns:
+    """Append-only column arrays with amortized doubling, like a list but for NumPy arrays."""
+
+    def __init__(self, dtypes, capacity=4096):
+        self.columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in dtypes.items()}
+        self.n_rows = 0
+
+    def append(self, values):
+        n_new = len(next(iter(values.values())))
+        needed = self.n_rows + n_new
+        capacity = len(next(iter(self.columns.values())))
+        if needed > capacity:
+            while capacity < needed:
+                capacity *= 2
+            for name, column in self.columns.items():
+                grown = np.empty(capacity, dtype=column.dtype)
+                grown[:self.n_rows] = column[:self.n_rows]
+                self.columns[name] = grown
+        for name, column in self.columns.items():
+            column[self.n_rows:needed] = values[name]
+        start, self.n_rows = self.n_rows, needed
+        return start, needed
+
+    def __getitem__(self, name):
+        return self.columns[name][:self.n_rows]
+
+
+class LiveIngest:
+    """
+    Tails a live IV file into a growing curve store and keeps fitted params for every finished curve. Thread-safe:
+    poll() can run in a background thread (start()) while Dash callbacks read from it.
+    """
+
+    def __init__(self, path, poll_interval=2.0, complete_after=30.0):
+        self.tailer = FileTailer(path)
+        self.poll_interval = poll_interval
+        self.complete_after = complete_after
+
+        self.store = GrowableColumns(LIVE_DTYPES)
+        self.offsets = {}  # (mppt_id, curve_num) -> (start, stop) rows in the store, for finished curves
+        self.open_curves = {}  # mppt_id -> [curve_num, list of row chunks, wall time of last row]
+        self.params = {}  # mppt_id -> dataframe of fitted params, one row per finished curve, in time order
+
+        self._lock = threading.RLock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._pid = os.getpid()  # Process the thread runs in (see start)
+
+    # Ingest
+
+    def poll(self):
+        """Read whatever's new, finish any curves that are done, and fit them. Returns the new params rows."""
+        rows = self.tailer.read_new_rows()
+        now = time.monotonic()
+        with self._lock:
+            finished = self._add_rows(rows, now) if len(rows) else []
+            finished += self._finish_idle(now)
+            return self._fit(finished)
+
+    def _add_rows(self, rows, now):
+        rows = rows[IV_COLUMNS]  # Already checked and converted, see clean_rows
+        mppt = rows['mppt_id'].astype(str).to_numpy()
+        curve = rows['curve_num'].to_numpy(dtype=np.int64)
+        columns = {
+            'time': rows['time'].to_numpy(dtype='datetime64[ns]'),
+            'voltage': rows['voltage'].to_numpy(dtype=np.float64),
+            'current': rows['current'].to_numpy(dtype=np.float64),
+            'power': rows['power'].to_numpy(dtype=np.float64),
+            'mppt_id': mppt.astype(object),
+            'curve_num': curve,
+        }
+
+        # Split the batch into runs of rows with the same key. There's one run per (partial) curve, so this loop is
+        # over curves rather than over points.
+        run_starts = np.flatnonzero(np.r_[True, (mppt[1:] != mppt[:-1]) | (curve[1:] != curve[:-1])])
+        run_stops = np.r_[run_starts[1:], len(mppt)]
+        finished = []
+        for start, stop in zip(run_starts, run_stops):
+            key_mppt, key_curve = mppt[start], int(curve[start])
+            chunk = {name: values[start:stop] for name, values in columns.items()}
+            open_curve = self.open_curves.get(key_mppt)
+            if open_curve is not None and open_curve[0] != key_curve:
+                finished.append(self._close(key_mppt))
+                open_curve = None
+            if open_curve is None:
+                self.open_curves[key_mppt] = [key_curve, [chunk], now]
+            else:
+                open_curve[1].append(chunk)
+                open_curve[2] = now
+        return finished
+
+    def _finish_idle(self, now):
+        idle = [mppt for mppt, (_, _, last) in self.open_curves.items() if now - last >= self.complete_after]
+        return [self._close(mppt) for mppt in idle]
+
+    def flush(self):
+        """Treat every open curve as finished (e.g. once the logger has stopped). Returns the new params rows."""
+        with self._lock:
+            return self._fit([self._close(mppt) for mppt in list(self.open_curves)])
+
+    def _close(self, mppt):
+        """Move an open curve into the store as one contiguous run of rows. Returns its key."""
+        curve_num, chunks, _ = self.open_curves.pop(mppt)
+        values = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in LIVE_DTYPES}
+        key = (mppt, curve_num)
+        self.offsets[key] = self.store.append(values)
+        return key
+
+    def _fit(self, keys):
+        """Fit params for just the given (finished) curves and add them to self.params."""
+        if not keys:
+            return pd.DataFrame()
+        starts = np.array([self.offsets[key][0] for key in keys], dtype=np.int64)
+        stops = np.array([self.offsets[key][1] for key in keys], dtype=np.int64)
+        voltage, current, lengths = pad_curves(starts, stops, self.store['voltage'], self.store['current'])
+
+        new_params = pd.DataFrame({
+            'mppt_id': [key[0] for key in keys],
+            'curve_num': [key[1] for key in keys],
+            'time': self.store['time'][starts],
+        })
+        for name, values in extract_params(voltage, current, lengths).items():
+            new_params[name] = values
+        new_params['n_points'] = lengths
+
+        # Curves of one MPPT finish in the order they were measured, so appending keeps each MPPT's params in time
+        # order and lets clients keep track of what they've already seen with the time of the last one (params_since)
+        for mppt, rows in new_params.groupby('mppt_id', sort=False):
+            existing = self.params.get(mppt)
+            self.params[mppt] = rows.reset_index(drop=True) if existing is None else \
+                pd.concat([existing, rows], ignore_index=True)
+        return new_params
+
+    # Background polling
+
+    def start(self):
+        """
+        Poll every poll_interval seconds in a daemon thread. Returns self so it can be chained. Does nothing if it's
+        already polling, so it's fine to call on every live update. After a fork, the thread (and whatever it held)
+        stayed in the parent, so the child starts its own. Stop it before forking (see serve.py), so the child doesn't
+        copy a poll that was halfway through.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = None
+            self._lock = threading.RLock()
+            self._stop = threading.Event()
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='iv-live-ingest', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()  # Bad lines get skipped (and logged) one by one in read_new_rows
+            except Exception:  # Anything else shouldn't kill live updates for good either. Log it and keep tailing.
+                logger.exception('Live IV ingest: polling %s failed', self.tailer.path)
+            self._stop.wait(self.poll_interval)
+
+    # Reading (for the Dash callbacks)
+
+    def params_for(self, mppt):
+        with self._lock:
+            return self.params.get(mppt, pd.DataFrame())
+
+    def all_params(self):
+        """Params of every finished curve of every MPPT."""
+        with self._lock:
+            return pd.concat(list(self.params.values()), ignore_index=True) if self.params else pd.DataFrame()
+
+    def params_since(self, mppt, cursor=None):
+        """
+        Params rows for mppt of the curves that started after the time `cursor` (all of them for None), plus the new
+        cursor: the start time of the last one, as text. It's a time rather than a row count so that it means the same
+        curve to every process tailing the file (e.g. each gunicorn worker), however far along each one has read.
+        """
+        with self._lock:
+            params = self.params.get(mppt, pd.DataFrame())
+        if len(params) and cursor is not None:
+            params = params.iloc[params['time'].searchsorted(pd.Timestamp(cursor), side='right'):]
+        return params, str(params['time'].iloc[-1]) if len(params) else cursor
+
+    def span(self, mppt, curve_num):
+        """(start, stop) rows of one finished curve in the store, or (0, 0) if there's no such curve."""
+        try:
+            return self.offsets.get((mppt, int(float(curve_num))), (0, 0))
+        except (TypeError, ValueError):
+            return 0, 0
+
+    def get_curve(self, mppt, curve_num):
+        """Dict of column name -> array for one finished curve (empty arrays if there isn't one), like CurveIndex"""
+        with self._lock:
+            start, stop = self.span(mppt, curve_num)
+            return {name: self.store[name][start:stop] for name in LIVE_DTYPES}
+
+    def __contains__(self, key):
+        with self._lock:
+            return self.span(*key) != (0, 0)
@@ -0,0 +1,196 @@
+"""
+Server-side paging, sorting and filtering of iv_params for a Dash DataTable.
+
+With page_action/sort_action/filter_action='custom', the DataTable sends its page number, sort columns and filter
+string to a callback instead of doing it all in the browser, so only one page of rows ever gets sent. That only helps
+if answering is fast on the server too, so every column's sort order is computed once up front (a presorted index):
+    * no filter, sorted by one column: the page is just a slice of that column's sort order, no matter how many rows
+    * filtered: one vectorized mask over the matching columns, then the presorted order is walked with the mask
+    * sorted by several columns: lexsort of only the rows that passed the filter
+
+The filter string is the one the DataTable builds from its filter row, e.g. '{Isc (A)} > 5 && {MPPT ID} contains A'.
+Numbers support =, !=, <, <=, >, >= (a bare number means =), text supports =, != and contains, and times also support
+datestartswith (e.g. '2017-10-12 07' for everything in that hour). Any column supports 'is blank' (missing or empty
+text), 'is nil' (missing) and their 'is not' versions. A quoted empty value is blank too, so '{Anomaly} != ""' is every
+flagged curve.
+
+How to use this:
+    params_query = ParamQuery(iv_params)
+    records, page_count = params_query.page(filter_query, sort_by, page_current, page_size)
+
+References:
+    * https://dash.plotly.com/datatable/callbacks (the custom paging/sorting/filtering callback, and the filter syntax)
+
+"""
+
+import numpy as np
+import pandas as pd
+
+# DataTable filter operators, longest first so '>=' isn't read as '>'. Each maps to the comparison it stands for.
+FILTER_OPERATORS = [
+    ('is not blank', 'notblank'), ('is not nil', 'notnil'), ('is blank', 'blank'), ('is nil', 'nil'),
+    ('datestartswith', 'startswith'), ('contains', 'contains'),
+    ('>=', 'ge'), ('<=', 'le'), ('!=', 'ne'), ('s>', 'gt'), ('s<', 'lt'),
+    ('ge', 'ge'), ('le', 'le'), ('ne', 'ne'), ('gt', 'gt'), ('lt', 'lt'), ('eq', 'eq'),
+    ('>', 'gt'), ('<', 'lt'), ('=', 'eq'),
+]
+
+# Operators that don't take a value
+UNARY_OPERATORS = {'blank', 'notblank', 'nil', 'notnil'}
+
+
+def parse_filter(filter_query):
+    """
+    Split a DataTable filter_query into a list of (column, operator, value) clauses (they're all ANDed together, and
+    value is None for the unary operators). Clauses it can't make sense of are skipped rather than raising, since the
+    filter row sends partial input as it's being typed.
+    """
+    clauses = []
+    for part in (filter_query or '').split(' && '):
+        part = part.strip()
+        if not part.startswith('{') or '}' not in part:
+            continue
+        column, rest = part[1:].split('}', 1)
+        rest = rest.strip()
+        for token, operator in FILTER_OPERATORS:
+            if rest.startswith(token):
+                value = rest[len(token):].strip()
+                break
+        else:
+            operator, value = 'eq', rest  # A bare value means equals
+        if operator in UNARY_OPERATORS:
+            clauses.append((column, operator, None))
+        elif len(value) >= 2 and value[0] == value[-1] and value[0] in '\'"`':
+            clauses.append((column, operator, value[1:-1]))  # Quoted ('...', "..." or `...`), which can be empty
+        elif value:
+            clauses.append((column, operator, value))  # Unquoted and empty is a clause still being typed
+    return clauses
+
+
+class ParamQuery:
+    """Presorted column indexes over a dataframe (one row per IV curve), answering DataTable page requests."""
+
+    def __init__(self, df):
+        self.df = df.reset_index(drop=True)
+        self.columns = {name: self.df[name].to_numpy() for name in self.df.columns}
+        self.order = {}  # Ascending order of every column, with missing values (NaN/NaT/None) last
+        self.rank = {}  # Dense rank of each row's value in its column (ties share a rank, missing values rank last)
+        self.n_distinct = {}  # Number of distinct non-missing values, i.e. the rank of the missing values
+        self.categories = {}  # Text (and bool) columns: (distinct values as text, code of each row into them)
+        self.missing = {}  # Which rows are NaN/NaT/None in every column
+        for name, values in self.columns.items():
+            missing = self.missing[name] = pd.isna(values)
+            present = np.flatnonzero(~missing)
+            keys = values[present]
+            if keys.dtype == object or keys.dtype == bool:
+                keys = keys.astype(str)  # Mixed types (e.g. ints and strings) don't sort otherwise
+                self.categories[name] = np.unique(values.astype(str), return_inverse=True)
+            by_value = np.argsort(keys, kind='stable')
+            self.order[name] = np.concatenate([present[by_value], np.flatnonzero(missing)])
+
+            sorted_keys = keys[by_value]
+            dense = np.cumsum(np.concatenate([[len(keys) > 0], sorted_keys[1:] != sorted_keys[:-1]])) - 1
+            self.n_distinct[name] = int(dense[-1]) + 1 if len(dense) else 0
+            self.rank[name] = np.full(len(values), self.n_distinct[name], dtype=np.int64)
+            self.rank[name][present[by_value]] = dense
+
+    def __len__(self):
+        return len(self.df)
+
+    def sorted_order(self, name, ascending=True):
+        """Row numbers in order of column `name`, missing values last either way."""
+        order = self.order[name]
+        if ascending:
+            return order
+        n_valid = np.count_nonzero(self.rank[name] < self.n_distinct[name])
+        return np.concatenate([order[:n_valid][::-1], order[n_valid:]])
+
+    def sort_key(self, name, ascending=True):
+        """Per-row dense rank to sort column `name` by (missing values last either way), for multi-column sorts."""
+        rank, n_distinct = self.rank[name], self.n_distinct[name]
+        return rank if ascending else np.where(rank < n_distinct, n_distinct - 1 - rank, rank)
+
+    def mask(self, clauses):
+        """Boolean array of the rows that match every (column, operator, value) clause (None if there are none)."""
+        mask = None
+        for column, operator, value in clauses:
+            if column not in self.columns:
+                continue
+            match = self._match(column, operator, value)
+            mask = match if mask is None else mask & match
+        return mask
+
+    def _match(self, column, operator, value):
+        values = self.columns[column]
+        n_rows = len(values)
+
+        # Missing values, and empty text for blank (which is what an empty value compares against too)
+        if operator in ('nil', 'notnil'):
+            return self.missing[column] if operator == 'nil' else ~self.missing[column]
+        if operator in ('blank', 'notblank') or (value == '' and operator in ('eq', 'ne')):
+            blank = self.missing[column]
+            if column in self.categories:
+                distinct, codes = self.categories[column]
+                blank = blank | (np.char.strip(distinct) == '')[codes]
+            return blank if operator in ('blank', 'eq') else ~blank
+
+        # Text: test each distinct value once, then look the rows up by their code
+        if column in self.categories:
+            distinct, codes = self.categories[column]
+            if operator == 'contains':
+                return np.char.find(distinct, value)[codes] >= 0
+            if operator == 'startswith':
+                return np.char.startswith(distinct, value)[codes]
+            if operator in ('eq', 'ne'):
+                equal = (distinct == value)[codes]
+                return equal if operator == 'eq' else ~equal
+            return np.zeros(n_rows, dtype=bool)
+
+        is_time = np.issubdtype(values.dtype, np.datetime64)
+        if operator in ('contains', 'startswith'):
+            if is_time and operator == 'startswith':
+                # A date prefix is a time range: '2017-10-12 07' is everything from 07:00 up to (not including) 08:00
+                try:
+                    period = pd.Period(value)
+                except ValueError:
+                    period = None
+                if period is not None and str(period.start_time).startswith(value):
+                    lo, hi = period.start_time.to_datetime64(), (period + 1).start_time.to_datetime64()
+                    return (values >= lo) & (values < hi)
+            text = pd.Series(values).astype(str)  # Anything else (rare) falls back to matching the text of every row
+            if operator == 'contains':
+                return text.str.contains(value, regex=False).to_numpy()
+            return text.str.startswith(value).to_numpy()
+
+        try:
+            value = pd.Timestamp(value).to_datetime64() if is_time else float(value)
+        except ValueError:
+            return np.full(n_rows, operator == 'ne')  # e.g. text typed into a number column's filter
+        compare = {'eq': np.equal, 'ne': np.not_equal, 'lt': np.less, 'le': np.less_equal, 'gt': np.greater,
+                   'ge': np.greater_equal}[operator]
+        return compare(values, value)
+
+    def rows(self, filter_query=None, sort_by=None):
+        """Row numbers that pass filter_query, in the order of sort_by (the DataTable's list of column/direction)."""
+        mask = self.mask(parse_filter(filter_query))
+        sort_by = [s for s in (sort_by or []) if s['column_id'] in self.columns]
+
+        if len(sort_by) > 1:
+            rows = np.arange(len(self.df)) if mask is None else np.flatnonzero(mask)
+            # Precomputed ranks of just these rows in every sort column, lexsorted (it sorts by the last key first)
+            keys = [self.sort_key(s['column_id'], s['direction'] == 'asc')[rows] for s in reversed(sort_by)]
+            return rows[np.lexsort(keys)]
+
+        order = self.sorted_order(sort_by[0]['column_id'], sort_by[0]['direction'] == 'asc') if sort_by \
+            else np.arange(len(self.df))
+        return order if mask is None else order[mask[order]]
+
+    def page_records(self, rows, page_current=0, page_size=25):
+        """(records for one page of `rows`, page count). Only this page's rows are ever turned into dicts."""
+        page_count = max(1, -(-len(rows) // page_size))
+        start = (page_current or 0) * page_size
+        return self.df.iloc[rows[start:start + page_size]].to_dict('records'), page_count
+
+    def page(self, filter_query=None, sort_by=None, page_current=0, page_size=25):
+        """(records for the DataTable's current page, page count) for the given filter/sort."""
+        return self.page_records(self.rows(filter_query, sort_by), page_current, page_size)
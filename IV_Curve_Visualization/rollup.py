@@ -0,0 +1,142 @@
+"""
+Precomputed time-bucketed rollups of the IV params, for views of every MPPT at once.
+
+A fleet-wide view (e.g. a heatmap of power for every MPPT over the day) would otherwise mean re-grouping all of
+iv_params on every request. Instead, the mean/min/max of each value (Pmax, Isc, Voc, ...) per MPPT per time bucket is
+computed once at startup, at several bucket widths that each divide evenly into the next, like an image pyramid:
+    1 min -> 5 min -> 15 min -> 1 h
+Only the finest level is computed from the params themselves; each coarser level is a reshape-and-reduce of the one
+below it. Each level is a dense (MPPT x bucket) grid, so a heatmap can use it as is.
+
+When the graph is zoomed, level_for picks the finest level that still fits the visible window in max_buckets columns,
+and window slices that time range out of it. Neither looks at the raw rows again.
+
+How to use this:
+    pyramid = RollupPyramid(iv_params, 'Time (Australian)', 'MPPT ID', ['Power (W)', 'Isc (A)', 'Voc (V)'])
+    level = pyramid.level_for(x_range, max_buckets=400)  # x_range=None for the whole day
+    times, mppts, z = pyramid.window(level, 'Power (W)', 'mean', x_range)
+
+References:
+    * https://en.wikipedia.org/wiki/Pyramid_(image_processing)
+    * https://numpy.org/doc/stable/reference/generated/numpy.bincount.html
+
+"""
+
+import numpy as np
+import pandas as pd
+
+# Bucket widths of each level, in seconds. Each one has to be a whole multiple of the one before it.
+ROLLUP_WIDTHS = (60, 5 * 60, 15 * 60, 60 * 60)
+ROLLUP_STATS = ('mean', 'min', 'max')
+
+
+class RollupLevel:
+    """
+    One level of the pyramid: per (group, bucket) count, sum, min and max of every value column, as 2-D arrays of shape
+    (number of groups, number of buckets). Bucket i covers [t0 + i * width, t0 + (i + 1) * width).
+    """
+
+    def __init__(self, width, t0, counts, sums, mins, maxs):
+        self.width = width  # Seconds
+        self.t0 = t0  # datetime64[ns] of the start of the first bucket
+        self.counts = counts  # value column -> (groups, buckets) number of (non-NaN) values
+        self.sums = sums
+        self.mins = mins
+        self.maxs = maxs
+
+    @property
+    def n_buckets(self):
+        return next(iter(self.counts.values())).shape[1] if self.counts else 0
+
+    def coarsen(self, factor):
+        """The level `factor` times wider, made by merging every `factor` neighbouring buckets of this one."""
+        n_groups = next(iter(self.counts.values())).shape[0] if self.counts else 0
+        n_buckets = self.n_buckets // factor  # The pyramid pads the finest level so this always divides evenly
+
+        def merge(table, reduce):
+            return {col: reduce(values.reshape(n_groups, n_buckets, factor), axis=2) for col, values in table.items()}
+
+        return RollupLevel(self.width * factor, self.t0, merge(self.counts, np.sum), merge(self.sums, np.sum),
+                           merge(self.mins, np.fmin.reduce), merge(self.maxs, np.fmax.reduce))
+
+    def bucket_times(self, start=0, stop=None):
+        """Start time of each bucket (datetime64[ns])."""
+        stop = self.n_buckets if stop is None else stop
+        return self.t0 + np.arange(start, stop) * np.timedelta64(self.width, 's')
+
+    def stat(self, col, stat='mean'):
+        """(groups, buckets) array of one statistic of one value column. NaN where a bucket has no values."""
+        if stat == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.where(self.counts[col] > 0, self.sums[col] / self.counts[col], np.nan)
+        return {'min': self.mins, 'max': self.maxs}[stat][col]
+
+
+class RollupPyramid:
+    """Mean/min/max of value_cols per group and time bucket, at each of the bucket widths (see the top of the file)."""
+
+    def __init__(self, params, time_col, group_col, value_cols, widths=ROLLUP_WIDTHS):
+        widths = sorted(widths)
+        for finer, coarser in zip(widths, widths[1:]):
+            if coarser % finer:
+                raise ValueError('Rollup widths must each divide evenly into the next, got {}'.format(widths))
+        self.value_cols = list(value_cols)
+
+        times = params[time_col].to_numpy().astype('datetime64[ns]')
+        self.groups, group_idx = np.unique(params[group_col].to_numpy().astype(str), return_inverse=True)
+        n_groups = len(self.groups)
+
+        # Line the buckets up with the coarsest width (so e.g. hour buckets start on the hour), and pad the finest
+        # level out to a whole number of coarsest buckets so every level is an exact reshape of the one below
+        coarsest = np.timedelta64(widths[-1], 's')
+        t0 = (times.min() - (times.min() - np.datetime64(0, 's')) % coarsest) if len(times) else np.datetime64(0, 'ns')
+        per_coarsest = widths[-1] // widths[0]
+        bucket = ((times - t0) // np.timedelta64(widths[0], 's')).astype(np.int64)
+        n_buckets = -(-(int(bucket.max()) + 1) // per_coarsest) * per_coarsest if len(times) else 0
+
+        # Finest level straight from the params: one bincount (or ufunc.at) over flat (group, bucket) cells per column
+        flat = group_idx * n_buckets + bucket
+        shape = (n_groups, n_buckets)
+        counts, sums, mins, maxs = {}, {}, {}, {}
+        for col in self.value_cols:
+            values = params[col].to_numpy(dtype=np.float64)
+            ok = np.isfinite(values)
+            cells, values = flat[ok], values[ok]
+            counts[col] = np.bincount(cells, minlength=n_groups * n_buckets).reshape(shape)
+            sums[col] = np.bincount(cells, weights=values, minlength=n_groups * n_buckets).reshape(shape)
+            mins[col] = np.full(n_groups * n_buckets, np.nan)
+            maxs[col] = np.full(n_groups * n_buckets, np.nan)
+            np.fmin.at(mins[col], cells, values)
+            np.fmax.at(maxs[col], cells, values)
+            mins[col], maxs[col] = mins[col].reshape(shape), maxs[col].reshape(shape)
+
+        self.levels = [RollupLevel(widths[0], t0, counts, sums, mins, maxs)]
+        for finer, coarser in zip(widths, widths[1:]):
+            self.levels.append(self.levels[-1].coarsen(coarser // finer))
+
+    def level_for(self, x_range=None, max_buckets=400):
+        """The finest level that shows x_range (or everything) in at most max_buckets buckets (else the coarsest)."""
+        finest = self.levels[0]
+        if x_range is None:
+            span = finest.n_buckets * finest.width
+        else:
+            span = (pd.Timestamp(x_range[1]) - pd.Timestamp(x_range[0])).total_seconds()
+        for level in self.levels:
+            if span / level.width <= max_buckets:
+                return level
+        return self.levels[-1]
+
+    def window(self, level, col, stat='mean', x_range=None):
+        """
+        (bucket midpoint times, groups, (groups, buckets) values) of one statistic for the buckets that overlap
+        x_range, or all of them. Midpoints, so that heatmap cells (which are centered on their x) line up with their
+        buckets.
+        """
+        start, stop = 0, level.n_buckets
+        if x_range is not None:
+            lo, hi = (pd.Timestamp(x).to_datetime64() for x in x_range)
+            width = np.timedelta64(level.width, 's')
+            start = int(np.clip((lo - level.t0) // width, 0, level.n_buckets))
+            stop = int(np.clip((hi - level.t0) // width + 1, start, level.n_buckets))
+        midpoints = level.bucket_times(start, stop) + np.timedelta64(level.width * 500, 'ms')
+        return midpoints, self.groups, level.stat(col, stat)[:, start:stop]
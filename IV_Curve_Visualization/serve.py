@@ -0,0 +1,150 @@
+"""
+Production entry point for the IV dashboards.
+
+app.run_server() at the bottom of the dashboards runs Flask's single-threaded development server, which handles one
+request at a time. This runs the same Dash app under gunicorn instead, with one worker process per core, so requests
+from several engineers at once get spread across cores.
+
+The dataset is loaded once, in the gunicorn master process, before it forks the workers (preload_app). For a single
+workbook, the raw IV curves are memory-mapped straight out of the .npy cache in data/.iv_cache (see iv_store.py), so
+every worker reads the same pages of the OS page cache: N workers don't cost N copies of the dataset. A whole race
+(several workbooks) gets merged into one in-memory store instead, which, like everything else the dashboard computes
+at startup (iv_params, the indexes, the figure templates), is shared with the workers copy-on-write by the fork. Either
+way it's one copy of the data, not one per worker.
+
+03_Semi-Final_Graphs.py loads its data in a background thread, so that run directly it's answering (with a loading page)
+straight away. Threads don't survive a fork though, so here the master waits for that thread (and the anomaly scan) to
+finish before forking. The thread tailing the live file (see iv_stream.py) is stopped in the master before each fork and
+started again in the worker after it (the dashboard's prepare_fork/after_fork, from gunicorn's pre_fork/post_fork
+hooks). So every worker tails the file on its own, but the browser keeps track of which live curves it has by time (not
+by how far one worker has read), so any worker can answer its next live update. Every worker, including the ones
+gunicorn starts later to replace a recycled or crashed one, is forked with all the data already in memory and answers
+its first request right away. With --lazy the master doesn't load anything: it binds and forks immediately, and each
+worker loads the data itself in the background (showing the loading page until it's done). That's the quickest cold
+start, at the cost of a copy of iv_params and the indexes per worker.
+
+How to use this (from anywhere, the working directory is switched to this folder so the data paths resolve):
+    python serve.py                          # 03_Semi-Final_Graphs.py on 0.0.0.0:8050, one worker per core
+    python serve.py --workers 4 --bind 127.0.0.1:8000 --dashboard 02_Dash_Graphs.py
+    python serve.py --lazy                   # Bind first, load the data in every worker afterwards
+    gunicorn --preload -w 4 -b 0.0.0.0:8050 serve:server   # If you'd rather call gunicorn directly (without the
+                                                           # fork hooks, a worker starts tailing the live file on its
+                                                           # first live update instead)
+
+Each worker times its own callbacks (see callback_metrics.py), so serve.py gives them a temporary folder to write their
+totals to (DASH_METRICS_DIR), and /metrics adds up every worker's whichever one gets the scrape. Calling gunicorn
+directly, set DASH_METRICS_DIR to an empty folder yourself to get the same.
+
+gunicorn only runs on Linux/macOS. On Windows, stick with running the dashboard scripts directly.
+
+References:
+    * https://dash.plotly.com/deployment
+    * https://docs.gunicorn.org/en/stable/custom.html (running gunicorn from Python)
+    * https://docs.gunicorn.org/en/stable/settings.html#preload-app
+
+"""
+
+import argparse
+import atexit
+import importlib.util
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DASHBOARD = os.environ.get('IV_DASHBOARD', '03_Semi-Final_Graphs.py')
+
+
+def load_dashboard(filename=DEFAULT_DASHBOARD, wait=True):
+    """
+    Import one of the dashboard scripts as a module and return it. The script names start with numbers and have
+    dashes in them, so they can't be imported with a normal import statement. With wait=True, also wait for a
+    dashboard that loads its data in the background (one with a wait_until_loaded function) to finish.
+    """
+    os.chdir(HERE)  # The dashboards load 'data/...' relative to this folder
+    spec = importlib.util.spec_from_file_location('iv_dashboard', os.path.join(HERE, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if wait and hasattr(module, 'wait_until_loaded') and not module.wait_until_loaded():
+        raise SystemExit('{} failed to load its data: {}'.format(filename, getattr(module, 'data_error', None)))
+    return module
+
+
+def share_callback_metrics():
+    """
+    Point DASH_METRICS_DIR at a new temporary folder (unless it's already set), so the workers' CallbackMetrics all
+    report each other's numbers. The folder is removed when this process (the gunicorn master) exits.
+    """
+    if os.environ.get('DASH_METRICS_DIR'):
+        return
+    master, folder = os.getpid(), tempfile.mkdtemp(prefix='dash-metrics-')
+    os.environ['DASH_METRICS_DIR'] = folder
+    atexit.register(lambda: os.getpid() == master and shutil.rmtree(folder, ignore_errors=True))  # Not the workers'
+
+
+def run_gunicorn(load_server, bind='0.0.0.0:8050', workers=None, threads=1, timeout=60, preload=True,
+                 pre_fork=None, post_fork=None):
+    """
+    Serve a WSGI app (the Flask server under the Dash app) with gunicorn's pre-fork worker model. load_server returns
+    the app: with preload it's called once in the master before forking, otherwise once in each worker. pre_fork is
+    called in the master before each worker is forked, and post_fork in the worker right after.
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit('gunicorn is needed for the production server (pip install gunicorn). '
+                         'It only runs on Linux/macOS; on Windows run the dashboard script directly instead.')
+
+    options = {
+        'bind': bind,
+        'workers': workers or multiprocessing.cpu_count(),
+        'threads': threads,
+        'timeout': timeout,
+        'preload_app': preload,  # Load the data once in the master, then fork (see the top of this file)
+    }
+    if pre_fork is not None:
+        options['pre_fork'] = lambda server, worker: pre_fork()
+    if post_fork is not None:
+        options['post_fork'] = lambda server, worker: post_fork()
+
+    class DashApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return load_server()
+
+    DashApplication().run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve an IV dashboard with gunicorn (one process per core)')
+    parser.add_argument('--bind', default='0.0.0.0:8050', help='Address to listen on (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: number of cores)')
+    parser.add_argument('--threads', type=int, default=1, help='Threads per worker (default: %(default)s)')
+    parser.add_argument('--timeout', type=int, default=60, help='Worker timeout in seconds (default: %(default)s)')
+    parser.add_argument('--dashboard', default=DEFAULT_DASHBOARD,
+                        help='Dashboard script to serve (default: %(default)s, or set IV_DASHBOARD)')
+    parser.add_argument('--lazy', action='store_true',
+                        help='Start answering before the data is loaded, loading it in each worker instead of once')
+    args = parser.parse_args()
+
+    dashboard = {}
+    share_callback_metrics()
+
+    def load_server():
+        dashboard['module'] = load_dashboard(args.dashboard, wait=not args.lazy)
+        return dashboard['module'].app.server
+
+    def fork_hook(name):
+        # The dashboard's prepare_fork/after_fork, if it has them and is loaded in this process (only with preload)
+        return lambda: getattr(dashboard.get('module'), name, lambda: None)()
+
+    run_gunicorn(load_server, bind=args.bind, workers=args.workers, threads=args.threads, timeout=args.timeout,
+                 preload=not args.lazy, pre_fork=fork_hook('prepare_fork'), post_fork=fork_hook('after_fork'))
+else:
+    # The WSGI app, for `gunicorn serve:server`. Loading it at import (rather than in a gunicorn hook) is what lets
+    # --preload share the data with every worker.
+    server = load_dashboard().app.server
@@ -0,0 +1,57 @@
+import os
+
+import dash
+from dash import html
+from dash.dependencies import Input, Output
+
+from callback_metrics import CallbackMetrics
+
+
+def metric(text, prefix):
+    return [line for line in text.splitlines() if line.startswith(prefix)]
+
+
+def worker_app(shared_dir):
+    app = dash.Dash(__name__)
+    metrics = CallbackMetrics(shared_dir=shared_dir).instrument(app)
+    app.layout = html.Div([html.Div(id='in'), html.Div(id='out')])
+
+    @app.callback(Output('out', 'children'), Input('in', 'children'))
+    def echo(value):
+        return value
+
+    return app, metrics
+
+
+def call(app, value):
+    payload = {'output': 'out.children', 'outputs': {'id': 'out', 'property': 'children'},
+               'inputs': [{'id': 'in', 'property': 'children', 'value': value}], 'changedPropIds': ['in.children']}
+    assert app.server.test_client().post('/_dash-update-component', json=payload).status_code == 200
+
+
+def test_metrics_add_up_across_processes(tmp_path):
+    # Stand-ins for two gunicorn workers: each records its own calls, and either one's /metrics has both
+    (app_a, metrics_a), (app_b, metrics_b) = worker_app(str(tmp_path)), worker_app(str(tmp_path))
+    metrics_b._shared_path = lambda pid: os.path.join(str(tmp_path), 'metrics_b.json')  # They share a pid here
+    for n in range(3):
+        call(app_a, n)
+    call(app_b, 'x')
+
+    for app in (app_a, app_b):
+        text = app.server.test_client().get('/metrics').data.decode()
+        assert metric(text, 'dash_callback_duration_seconds_count') == [
+            'dash_callback_duration_seconds_count{callback="echo"} 4']
+        assert metric(text, 'dash_callback_calls_total') == [
+            'dash_callback_calls_total{callback="echo",outcome="ok"} 4']
+        assert metric(text, 'dash_callback_duration_seconds_bucket{callback="echo",le="+Inf"}') == [
+            'dash_callback_duration_seconds_bucket{callback="echo",le="+Inf"} 4']
+
+
+def test_without_shared_dir(monkeypatch):
+    monkeypatch.delenv('DASH_METRICS_DIR', raising=False)
+    app, metrics = worker_app(None)
+    call(app, 1)
+    assert metrics.summary()[0]['Calls'] == 1
+    text = app.server.test_client().get('/metrics').data.decode()
+    assert metric(text, 'dash_callback_response_bytes_count') == [
+        'dash_callback_response_bytes_count{callback="echo"} 1']
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+from downsample import lttb_indices, selection_mask
+
+
+def test_lttb_keeps_the_ends_and_n_out_points():
+    x = np.arange(1000)
+    y = np.sin(x / 50)
+    indices = lttb_indices(x, y, 100)
+    assert len(indices) == 100
+    assert indices[0] == 0 and indices[-1] == 999
+    assert np.all(np.diff(indices) > 0)
+
+
+def test_lttb_keeps_a_spike():
+    y = np.zeros(1000)
+    y[517] = 50
+    assert 517 in lttb_indices(np.arange(1000), y, 50)
+
+
+def test_lttb_short_series_is_kept_whole():
+    np.testing.assert_array_equal(lttb_indices(np.arange(10), np.arange(10), 10), np.arange(10))
+    np.testing.assert_array_equal(lttb_indices(np.arange(10), np.arange(10), 50), np.arange(10))
+
+
+def test_lttb_datetime_x():
+    x = pd.date_range('2024-01-01', periods=500, freq='s').to_numpy()
+    indices = lttb_indices(x, np.random.default_rng(0).normal(size=500), 40)
+    assert len(indices) == 40 and indices[0] == 0 and indices[-1] == 499
+
+
+def test_selection_mask_box():
+    x, y = np.array([0, 1, 2, 3, 4]), np.array([0, 5, 1, 5, 0])
+    mask = selection_mask(x, y, {'range': {'x': [0.5, 3.5], 'y': [-1, 2]}, 'points': []})
+    assert mask.tolist() == [False, False, True, False, False]
+
+
+def test_selection_mask_lasso():
+    # Triangle (0, 0), (4, 0), (0, 4): (1, 1) is inside, (3, 3) is inside its bounding box but not the triangle
+    x, y = np.array([1.0, 3.0, 5.0]), np.array([1.0, 3.0, 1.0])
+    mask = selection_mask(x, y, {'lassoPoints': {'x': [0, 4, 0], 'y': [0, 0, 4]}})
+    assert mask.tolist() == [True, False, False]
+
+
+def test_selection_mask_datetime_x():
+    x = pd.date_range('2024-01-01 10:00', periods=6, freq='min').to_numpy()
+    mask = selection_mask(x, np.ones(6), {'range': {'x': ['2024-01-01 10:01:30', '2024-01-01 10:03:00'],
+                                                    'y': [0, 2]}})
+    assert mask.tolist() == [False, False, True, True, False, False]
+
+
+def test_selection_mask_without_outline():
+    assert selection_mask([1, 2], [1, 2], None) is None
+    assert selection_mask([1, 2], [1, 2], {'points': [{'x': 1, 'y': 1}]}) is None
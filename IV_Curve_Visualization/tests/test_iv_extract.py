@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from iv_extract import MPP_FIT_TOLERANCE, extract_params
+
+
+def single_diode(n, rs=0.5, rsh=50.0, iph=5.0, i0=1e-9, nvt=1.1):
+    """Single-diode curve sampled evenly in diode voltage, from short circuit to a little past open circuit."""
+    vd = np.linspace(0, nvt * np.log(iph / i0) * 1.001, n)
+    i = iph - i0 * np.expm1(vd / nvt) - vd / rsh
+    return vd - i * rs, i
+
+
+def extract(*curves):
+    width = max(len(v) for v, _ in curves)
+    voltage, current = np.full((2, len(curves), width), np.nan)
+    for row, (v, i) in enumerate(curves):
+        voltage[row, :len(v)], current[row, :len(i)] = v, i
+    params = extract_params(voltage, current, np.array([len(v) for v, _ in curves]))
+    return {k: float(x[0]) for k, x in params.items()} if len(curves) == 1 else params
+
+
+# Mppt A0, curve 50 from the short workbook: almost every point is bunched around the knee, with one point near Isc
+SPARSE_V = [4.09, 23.49, 23.65, 23.65, 23.65, 23.69, 23.79, 23.79, 23.81, 23.81, 23.81, 23.81, 23.81, 23.83, 23.85,
+            23.85, 23.91, 23.96, 23.98, 23.98, 23.98, 23.98, 23.98, 23.98, 24.0, 24.0, 24.06, 24.1, 24.3, 24.3, 24.3,
+            24.34, 24.36, 24.95, 25.44, 25.44, 25.93, 26.26, 26.26, 26.28]
+SPARSE_I = [1.681, 1.458, 1.23, 1.236, 1.229, 1.213, 1.235, 1.317, 1.239, 1.237, 1.274, 1.204, 1.243, 1.233, 1.172,
+            1.171, 1.27, 1.277, 1.305, 1.22, 1.288, 1.293, 1.199, 1.199, 1.178, 1.226, 1.254, 1.22, 1.209, 1.176, 1.172,
+            1.244, 1.244, 1.002, 0.753, 0.751, 0.32, 0.0, 0.0, 0.0]
+
+
+def test_sparse_real_curve_stays_physical():
+    v, i = np.array(SPARSE_V), np.array(SPARSE_I)
+    params = extract((v, i))
+    assert params['pmp'] <= (v * i).max() * (1 + MPP_FIT_TOLERANCE)
+    assert params['imp'] <= params['isc']
+    assert params['pmp'] <= params['isc'] * params['voc']
+    assert 0 < params['ff'] <= 1
+
+
+def test_clean_curve_mpp():
+    v, i = single_diode(4000)
+    p = v * i
+    params = extract(single_diode(40))
+    assert params['pmp'] == pytest.approx(p.max(), rel=2e-3)
+    assert params['vmp'] == pytest.approx(v[p.argmax()], rel=0.02)
+    assert params['isc'] == pytest.approx(i[0], rel=0.01)
+    assert params['voc'] == pytest.approx(np.interp(0, i[::-1], v[::-1]), rel=0.01)
+
+
+@pytest.mark.parametrize('rs, rsh', [(0.2, 200.0), (0.5, 50.0), (1.0, 20.0)])
+def test_known_rs_rsh_are_finite(rs, rsh):
+    params = extract(single_diode(40, rs=rs, rsh=rsh))
+    assert np.isfinite(params['rs']) and np.isfinite(params['rsh'])
+    assert params['rsh'] == pytest.approx(rsh, rel=0.05)
+    # The slope at Voc includes the diode's own resistance, so it only bounds Rs from above
+    assert rs <= params['rs'] < rs + 0.5
+
+
+def test_rs_tracks_series_resistance():
+    fitted = [extract(single_diode(40, rs=rs))['rs'] for rs in (0.2, 0.5, 1.0)]
+    assert fitted == sorted(fitted)
+
+
+def test_truncated_sweeps_are_nan():
+    v, i = single_diode(40)
+    knee = np.argmax(v * i)
+    to_voc, from_isc = extract((v[knee - 5:], i[knee - 5:])), extract((v[:knee], i[:knee]))
+    assert np.isnan(to_voc['isc']) and np.isnan(to_voc['ff']) and np.isfinite(to_voc['voc'])
+    assert np.isnan(from_isc['voc']) and np.isnan(from_isc['ff']) and np.isfinite(from_isc['isc'])
+
+
+def test_padded_rows_are_independent():
+    together = extract(single_diode(40), single_diode(25, rs=1.0))
+    for row, curve in enumerate([single_diode(40), single_diode(25, rs=1.0)]):
+        alone = extract(curve)
+        for key, value in alone.items():
+            assert together[key][row] == pytest.approx(value, nan_ok=True)
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+from iv_store import CurveIndex, IVCurveStore
+
+
+def interleaved_curves():
+    # Two MPPTs sweeping at the same time, so their rows come in mixed together
+    rows = []
+    for curve_num in (2, 1):
+        for n in range(4):
+            for mppt in ('B1', 'A0'):
+                rows.append({'mppt_id': mppt, 'curve_num': curve_num, 'voltage': float(n), 'current': 10.0 - n})
+    return pd.DataFrame(rows)
+
+
+def test_curves_are_contiguous_and_keep_their_point_order():
+    index = CurveIndex(IVCurveStore.from_frame(interleaved_curves()), ('mppt_id', 'curve_num'))
+    assert len(index) == 4
+    assert list(index.key_columns['mppt_id']) == ['A0', 'A0', 'B1', 'B1']
+    assert list(index.key_columns['curve_num']) == [1, 2, 1, 2]
+
+    curve = index.get('B1', 2)
+    assert curve['voltage'].tolist() == [0, 1, 2, 3]
+    assert curve['current'].tolist() == [10, 9, 8, 7]
+    assert set(curve['mppt_id']) == {'B1'}
+
+
+def test_keys_from_the_browser_are_normalized():
+    index = CurveIndex.from_frame(interleaved_curves(), ('mppt_id', 'curve_num'))
+    assert index.span('A0', 1) == index.span('A0', 1.0) == index.span('A0', '1') == (0, 4)
+    assert ('A0', '2') in index
+    assert ('A0', 3) not in index and ('C2', 1) not in index and ('A0', 'x') not in index
+
+
+def test_missing_curve_is_empty():
+    index = CurveIndex.from_frame(interleaved_curves(), ('mppt_id', 'curve_num'))
+    assert index.span('A0', 7) == (0, 0)
+    assert all(len(values) == 0 for values in index.get('A0', 7).values())
+
+
+def test_take_curves_concatenates_in_the_order_asked():
+    index = CurveIndex.from_frame(interleaved_curves(), ('mppt_id', 'curve_num'))
+    columns, lengths = index.take_curves([('B1', 1), ('A0', 9), ('A0', 2)], columns=('voltage', 'mppt_id'))
+    assert lengths.tolist() == [4, 0, 4]
+    assert columns['voltage'].tolist() == [0, 1, 2, 3, 0, 1, 2, 3]
+    assert columns['mppt_id'].tolist() == ['B1'] * 4 + ['A0'] * 4
+
+    columns, lengths = index.take_curves([])
+    assert lengths.tolist() == [] and len(columns['voltage']) == 0
+
+
+def test_sorted_store_is_not_copied():
+    df = interleaved_curves().sort_values(['mppt_id', 'curve_num'], kind='stable')
+    store = IVCurveStore.from_frame(df)
+    index = CurveIndex(store, ('mppt_id', 'curve_num'))
+    assert index.store is store
+    np.testing.assert_array_equal(index.order, np.arange(len(df)))
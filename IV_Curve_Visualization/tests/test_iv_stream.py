@@ -0,0 +1,41 @@
+import json
+
+from iv_stream import LiveIngest
+
+
+def write_curves(path, curve_nums, mppt='A0'):
+    with open(path, 'a') as f:
+        for curve_num in curve_nums:
+            for n in range(20):
+                f.write(json.dumps({'time': '2024-01-01T00:{:02d}:{:02d}'.format(curve_num, n), 'voltage': 40 - 2 * n,
+                                    'current': n / 4, 'power': (40 - 2 * n) * n / 4, 'mppt_id': mppt,
+                                    'curve_num': curve_num}) + '\n')
+
+
+def curve_nums(rows):
+    return rows['curve_num'].tolist() if len(rows) else []
+
+
+def test_params_since_works_across_processes(tmp_path):
+    # Two workers tailing the same file, one further along than the other, with the browser's ticks going to either
+    path = str(tmp_path / 'live.ndjson')
+    write_curves(path, [1, 2, 3])  # Curve 3 isn't finished until curve 4 starts
+    ahead, behind = LiveIngest(path), LiveIngest(path)
+    ahead.poll()
+
+    rows, cursor = ahead.params_since('A0')
+    assert curve_nums(rows) == [1, 2]
+
+    rows, same_cursor = behind.params_since('A0', cursor)  # Hasn't read anything yet
+    assert curve_nums(rows) == [] and same_cursor == cursor
+
+    write_curves(path, [4, 5])
+    behind.poll()
+    rows, cursor = behind.params_since('A0', cursor)
+    assert curve_nums(rows) == [3, 4]
+
+    ahead.poll()
+    rows, cursor = ahead.params_since('A0', cursor)
+    assert curve_nums(rows) == []
+    assert curve_nums(behind.flush()) == [5]
+    assert curve_nums(behind.params_since('A0', cursor)[0]) == [5]
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+
+from param_query import ParamQuery, parse_filter
+
+
+def params():
+    return pd.DataFrame({
+        'MPPT ID': ['A0', 'A0', 'B1', 'B1', 'C2'],
+        'Isc (A)': [5.2, np.nan, 4.1, 5.2, 3.0],
+        'Time': pd.to_datetime(['2017-10-12 07:10', '2017-10-12 07:50', '2017-10-12 08:05', None, '2017-10-12 07:30']),
+        'Anomaly': [np.nan, 'Isc low', '', np.nan, 'FF drop'],
+    })
+
+
+def rows(filter_query=None, sort_by=None):
+    return ParamQuery(params()).rows(filter_query, sort_by).tolist()
+
+
+def test_parse_filter():
+    assert parse_filter('{Isc (A)} >= 5 && {MPPT ID} contains A') == [('Isc (A)', 'ge', '5'),
+                                                                      ('MPPT ID', 'contains', 'A')]
+    assert parse_filter('{Isc (A)} 5') == [('Isc (A)', 'eq', '5')]
+    assert parse_filter('{Isc (A)} > && {MPPT') == []  # Still being typed
+    assert parse_filter('{Anomaly} != ""') == [('Anomaly', 'ne', '')]
+    assert parse_filter('{Anomaly} is not blank && {Isc (A)} is nil') == [('Anomaly', 'notblank', None),
+                                                                          ('Isc (A)', 'nil', None)]
+
+
+def test_numeric_and_text_filters():
+    assert rows('{Isc (A)} >= 5') == [0, 3]
+    assert rows('{Isc (A)} != 5.2') == [1, 2, 4]
+    assert rows('{MPPT ID} contains B && {Isc (A)} < 5') == [2]
+    assert rows('{MPPT ID} = A0') == [0, 1]
+    assert rows('{Isc (A)} > abc') == []
+
+
+def test_time_prefix_is_a_range():
+    assert rows('{Time} datestartswith 2017-10-12 07') == [0, 1, 4]
+
+
+def test_blank_and_nil():
+    assert rows('{Anomaly} is blank') == [0, 2, 3]
+    assert rows('{Anomaly} is not blank') == [1, 4]
+    assert rows('{Anomaly} != ""') == [1, 4]
+    assert rows('{Anomaly} = ""') == [0, 2, 3]
+    assert rows('{Anomaly} is nil') == [0, 3]
+    assert rows('{Isc (A)} is nil') == [1]
+    assert rows('{Time} is not nil') == [0, 1, 2, 4]
+
+
+def test_sorting_puts_missing_last():
+    assert rows(sort_by=[{'column_id': 'Isc (A)', 'direction': 'asc'}]) == [4, 2, 0, 3, 1]
+    descending = rows(sort_by=[{'column_id': 'Isc (A)', 'direction': 'desc'}])
+    assert sorted(descending[:2]) == [0, 3] and descending[2:] == [2, 4, 1]  # 0 and 3 tie
+    assert rows('{Isc (A)} > 4', [{'column_id': 'Time', 'direction': 'desc'}]) == [2, 0, 3]
+
+
+def test_multi_column_sort():
+    sort_by = [{'column_id': 'Isc (A)', 'direction': 'desc'}, {'column_id': 'MPPT ID', 'direction': 'desc'}]
+    assert rows(sort_by=sort_by) == [3, 0, 2, 4, 1]
+
+
+def test_page_records():
+    records, page_count = ParamQuery(params()).page(sort_by=[{'column_id': 'MPPT ID', 'direction': 'desc'}],
+                                                    page_current=1, page_size=2)
+    assert page_count == 3
+    assert [r['MPPT ID'] for r in records] == ['B1', 'A0']
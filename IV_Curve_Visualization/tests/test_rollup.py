@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from rollup import RollupPyramid
+
+
+def params_table():
+    rng = np.random.default_rng(3)
+    n = 2000
+    params = pd.DataFrame({
+        'time': pd.Timestamp('2024-06-01 06:07:11') + pd.to_timedelta(np.sort(rng.uniform(0, 6 * 3600, n)), unit='s'),
+        'mppt_id': rng.choice(['A0', 'A1', 'B0'], n),
+        'max_power': rng.uniform(0, 400, n),
+    })
+    params.loc[rng.choice(n, 100, replace=False), 'max_power'] = np.nan
+    return params
+
+
+def expected(params, width, stat):
+    buckets = params['time'].dt.floor('{}s'.format(width))
+    return params.groupby(['mppt_id', buckets])['max_power'].agg(stat).dropna()
+
+
+@pytest.mark.parametrize('stat', ['mean', 'min', 'max'])
+def test_every_level_matches_a_groupby(stat):
+    params = params_table()
+    pyramid = RollupPyramid(params, 'time', 'mppt_id', ['max_power'])
+    assert [level.width for level in pyramid.levels] == [60, 300, 900, 3600]
+    for level in pyramid.levels:
+        midpoints, groups, z = pyramid.window(level, 'max_power', stat)
+        starts = pd.to_datetime(midpoints - np.timedelta64(level.width * 500, 'ms'))
+        got = pd.DataFrame(z, index=groups, columns=starts).stack().dropna()
+        want = expected(params, level.width, stat)
+        np.testing.assert_allclose(got.to_numpy(), want.to_numpy())
+        assert list(got.index) == list(want.index)
+
+
+def test_window_and_level_for():
+    params = params_table()
+    pyramid = RollupPyramid(params, 'time', 'mppt_id', ['max_power'])
+    assert pyramid.level_for(max_buckets=420).width == 60  # 06:00 to 13:00, padded to whole hours
+    assert pyramid.level_for(max_buckets=400).width == 300
+    assert pyramid.level_for(max_buckets=10).width == 3600
+    assert pyramid.level_for(('2024-06-01 08:00', '2024-06-01 09:00'), max_buckets=20).width == 300
+
+    level = pyramid.levels[1]
+    midpoints, groups, z = pyramid.window(level, 'max_power', 'mean', ('2024-06-01 08:00', '2024-06-01 09:00'))
+    assert list(groups) == ['A0', 'A1', 'B0']
+    assert z.shape == (3, len(midpoints)) == (3, 13)  # 08:00 up to and including the bucket 09:00 falls in
+    assert midpoints[0] == np.datetime64('2024-06-01T08:02:30')
+
+
+def test_widths_must_divide():
+    with pytest.raises(ValueError):
+        RollupPyramid(params_table(), 'time', 'mppt_id', ['max_power'], widths=(60, 90))
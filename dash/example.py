@@ -4,14 +4,28 @@
 # Date: 2020-09-15
 
 import dash
-import dash_core_components as dcc
-import dash_html_components as html
+from dash import dcc, html
 import plotly.graph_objs as go
 import pandas as pd
 from dash.dependencies import Input, Output
 import random  # SHould be numpy.random, not the base random!
 import numpy as np
 
+# Callback timing (served at /metrics) and the hover engine come from the IV dashboards' folder, so that folder needs to
+# be on the Python path. Run this from this folder with:
+#     PYTHONPATH=../IV_Curve_Visualization python example.py              (Linux/macOS)
+#     set PYTHONPATH=..\IV_Curve_Visualization && python example.py       (Windows)
+try:
+    from callback_metrics import CallbackMetrics
+    from fig_cache import FigureCache
+    from hover_engine import HoverDetails, PointTable, hover_field
+except ImportError:
+    raise SystemExit('example.py uses modules from ../IV_Curve_Visualization. Run it with that folder on the path: '
+                     'PYTHONPATH=../IV_Curve_Visualization python example.py')
+
+# Callback timings are always recorded and served at /metrics. This also shows them in a table under the graphs.
+show_callback_metrics = False
+
 df = pd.read_csv('data/dash_example_data_mpg.csv')
 
 ######### Hello World Example  ##############
@@ -103,6 +117,7 @@ df = pd.read_csv('data/dash_example_data_mpg.csv')
 # Note: Made some modifications in an effort to make it look nice
 
 app = dash.Dash()
+callback_metrics = CallbackMetrics().instrument(app)  # Times every callback below (see /metrics)
 
 # df = pd.read_csv('Data/mpg.csv')
 df['year'] = np.random.randint(-4, 5, len(df)) * 0.10 + df['model_year']  # Plays nice with code above
@@ -144,37 +159,49 @@ app.layout = html.Div([
 
     html.Div([
         dcc.Markdown(id='mpg-metrics')
-    ], style={'width': '20%', 'display': 'inline-block'})
+    ], style={'width': '20%', 'display': 'inline-block'}),
 ])
 
+if show_callback_metrics:
+    app.layout.children.append(callback_metrics.debug_panel(app))  # Table of the callback timings
+
+
+# Both panes show the car being hovered over. Rather than a callback each that digs through hoverData and slices df
+# with df.iloc for every value it shows, they're declared on a HoverDetails (see hover_engine.py): one callback looks
+# the car up once (by pointIndex, its row number) and hands its row to each of the functions below. Cars already
+# hovered over come out of the cache.
+cars = PointTable(df)
+max_acceleration = 60 / df['acceleration'].min()
 
-@app.callback(Output('mpg-acceleration', 'figure'),
-              [Input('mpg-scatter', 'hoverData')])
-def callback_graph(hoverData):
-    df_index = hoverData['points'][0]['pointIndex']
+
+def callback_graph(car):
     figure = {'data': [go.Scatter(x=[0, 1],
-                                  y=[0, 60 / df.iloc[df_index]['acceleration']],
+                                  y=[0, 60 / car['acceleration']],
                                   mode='lines', )],
-              'layout': go.Layout(title='{} Acceleration'.format(df.iloc[df_index]['name']),
+              'layout': go.Layout(title='{} Acceleration'.format(car['name']),
                                   xaxis={'visible': False},
-                                  yaxis={'visible': False, 'range': [0, 60 / df['acceleration'].min()]},
+                                  yaxis={'visible': False, 'range': [0, max_acceleration]},
                                   margin={'l': 0},
                                   height=300
                                   )}
     return figure
 
 
-@app.callback(Output('mpg-metrics', 'children'),
-              [Input('mpg-scatter', 'hoverData')])
-def callback_stats(hoverData):
-    df_index = hoverData['points'][0]['pointIndex']
+def callback_stats(car):
     metrics = """
             {}cc displacement,
             0 to 60mph in {} seconds
-            """.format(df.iloc[df_index]['displacement'],
-                       df.iloc[df_index]['acceleration'])
+            """.format(car['displacement'],
+                       car['acceleration'])
     return metrics
 
 
+car_hover = HoverDetails(app, 'mpg-scatter', key=hover_field('pointIndex'), points=cars,
+                         cache=FigureCache(max_entries=len(df) * 2), metrics=callback_metrics)
+car_hover.add(Output('mpg-acceleration', 'figure'), callback_graph)
+car_hover.add(Output('mpg-metrics', 'children'), callback_stats)
+callback_hover = car_hover.register('callback_hover')
+
+
 if __name__ == '__main__':
     app.run_server()
\ No newline at end of file